@@ -1,9 +1,9 @@
 from django.contrib import admin
-from .models import Expenses, ExpenseShare, User
+from .models import Expenses, ExpenseShare, Group, GroupMembership, PeriodClose, User, UserBalance
 
 @admin.register(Expenses)
 class ExpensesAdmin(admin.ModelAdmin):
-    list_display = ('id', 'description', 'total_amount', 'split_method', 'date')
+    list_display = ('id', 'description', 'total_amount', 'split_method', 'date', 'paid_by', 'group')
 
 @admin.register(ExpenseShare)
 class ExpenseShareAdmin(admin.ModelAdmin):
@@ -12,3 +12,20 @@ class ExpenseShareAdmin(admin.ModelAdmin):
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
     list_display = ('id', 'email', 'name', 'mobile_number')
+
+@admin.register(UserBalance)
+class UserBalanceAdmin(admin.ModelAdmin):
+    list_display = ('user', 'total_owed', 'expense_count', 'total_paid', 'net_balance')
+
+class GroupMembershipInline(admin.TabularInline):
+    model = GroupMembership
+    raw_id_fields = ('user',)
+
+@admin.register(Group)
+class GroupAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'created_at')
+    inlines = [GroupMembershipInline]
+
+@admin.register(PeriodClose)
+class PeriodCloseAdmin(admin.ModelAdmin):
+    list_display = ('cutoff', 'closed_at', 'expense_count', 'share_count')
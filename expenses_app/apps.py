@@ -3,3 +3,7 @@ from django.apps import AppConfig
 class ExpensesAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'expenses_app'
+
+    def ready(self):
+        # Register the cache invalidation signal handlers and the system checks
+        from . import checks, signals
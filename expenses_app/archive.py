@@ -0,0 +1,157 @@
+from collections import defaultdict
+
+from django.db import connections, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .cache import response_cache
+from .ledger import (
+    UPDATE_CHUNK_SIZE, add_balances, aggregate_balances, archive_daily_totals, empty_balance, latest_period,
+    snapshot_balances, touch_users,
+)
+from .models import (
+    Expenses, ExpenseShare, PeriodClose, BalanceSnapshot, DebtSnapshot, SplitMethodSnapshot, ArchivedExpense,
+    ArchivedExpenseShare,
+)
+from .routers import active_shard
+
+# Period close.
+# Closing a period writes every user's balances, what every participant owes every payer
+# and the totals per split method as of a cutoff date to snapshots and moves the expenses dated up to the cutoff, with their shares, from the live tables to
+# the archive tables. The live tables then only hold the open period, so full scans of
+# the listings, the balance sheet and the reports stop growing with the history, and
+# whole-history totals and reports are the snapshots plus the open period. Archived rows keep their
+# ids and stay readable through the `include_archived` flag of the read endpoints.
+# Every expense shard closes its own periods (see the close_period command).
+
+
+def archived_querysets():
+    # (expenses, shares) of the archive tables, for `ExpenseArrays.load`
+    return ArchivedExpense.objects.all(), ArchivedExpenseShare.objects.all()
+
+
+def share_counts(shares):
+    # {user_id: number of shares} of a shares queryset
+    rows = shares.values('user').annotate(count=Count('id')).order_by()
+    return {row['user']: row['count'] for row in rows}
+
+
+def aggregate_debts(shares):
+    # {(debtor, creditor): amount} owed to the payers of the expenses of a shares
+    # queryset, before netting; payers' own shares owe nothing
+    rows = (
+        shares.filter(expense__paid_by__isnull=False).exclude(user=F('expense__paid_by'))
+        .values_list('user', 'expense__paid_by').annotate(total=Sum('amount')).order_by()
+    )
+    return {(debtor, creditor): total or 0 for debtor, creditor, total in rows}
+
+
+def aggregate_split_methods(expenses, shares):
+    # {split method: {expense_count, total_amount, share_count}} of an expenses and a
+    # shares queryset
+    methods = defaultdict(lambda: {'expense_count': 0, 'total_amount': 0, 'share_count': 0})
+    rows = expenses.values_list('split_method').annotate(count=Count('id'), total=Sum('total_amount')).order_by()
+    for method, count, total in rows:
+        methods[method]['expense_count'] = count
+        methods[method]['total_amount'] = total or 0
+    for method, count in shares.values_list('expense__split_method').annotate(count=Count('id')).order_by():
+        methods[method]['share_count'] = count
+    return methods
+
+
+def copy_rows(cursor, queryset, target):
+    # INSERT INTO target SELECT ... FROM the live table, in one statement; the archive
+    # models have the columns of the live ones. Returns the number of rows copied.
+    # The SELECT is compiled for the shard being written to.
+    connection = connections[active_shard()]
+    columns = [field.column for field in target._meta.concrete_fields]
+    rows = queryset.values_list(*[field.attname for field in target._meta.concrete_fields])
+    sql, params = rows.query.get_compiler(using=connection.alias).as_sql()
+    quoted = ', '.join(connection.ops.quote_name(column) for column in columns)
+    cursor.execute(f'INSERT INTO {connection.ops.quote_name(target._meta.db_table)} ({quoted}) {sql}', params)
+    return cursor.rowcount
+
+
+def delete_rows(cursor, model, column, ids):
+    # DELETE the rows of `model` whose `column` is in the `ids` subquery. Plain DELETEs
+    # as in `flush_dataset`: the ORM would load every row to send delete signals.
+    connection = connections[active_shard()]
+    sql, params = ids.query.get_compiler(using=connection.alias).as_sql()
+    table = connection.ops.quote_name(model._meta.db_table)
+    cursor.execute(f'DELETE FROM {table} WHERE {connection.ops.quote_name(column)} IN ({sql})', params)
+
+
+def close_period(cutoff):
+    # Close the period ending on `cutoff` (a date) on the expense shard selected with
+    # `use_shard` and return its PeriodClose.
+    # Raises ValueError for a cutoff that is not after the last closed period or not in the past.
+    if cutoff >= timezone.localdate():
+        raise ValueError("The cutoff must be in the past.")
+    alias = active_shard()
+    with transaction.atomic(using=alias):
+        previous = latest_period()
+        if previous is not None and cutoff <= previous.cutoff:
+            raise ValueError(f"The cutoff must be after {previous.cutoff.isoformat()}, the last closed period.")
+
+        expenses = Expenses.objects.filter(date__lte=cutoff)
+        # Shares follow their expense whatever their copy of its date says
+        shares = ExpenseShare.objects.filter(expense_id__in=expenses.values('id'))
+
+        # Cumulative balances: the previous snapshot plus the expenses being archived
+        balances = defaultdict(empty_balance)
+        counts = defaultdict(int)
+        if previous is not None:
+            add_balances(balances, snapshot_balances(previous))
+            for user_id, count in previous.snapshots.values_list('user_id', 'share_count'):
+                counts[user_id] += count
+        archived = aggregate_balances(expenses, shares)
+        add_balances(balances, archived)
+        for user_id, count in share_counts(shares).items():
+            counts[user_id] += count
+
+        # Debts and split method totals add up the same way
+        debts = defaultdict(int)
+        methods = aggregate_split_methods(expenses, shares)
+        if previous is not None:
+            for debtor, creditor, amount in previous.debts.values_list('debtor_id', 'creditor_id', 'amount'):
+                debts[debtor, creditor] += amount
+            for row in previous.split_methods.values('split_method', 'expense_count', 'total_amount', 'share_count'):
+                for field in ('expense_count', 'total_amount', 'share_count'):
+                    methods[row['split_method']][field] += row[field]
+        for pair, amount in aggregate_debts(shares).items():
+            debts[pair] += amount
+
+        period = PeriodClose.objects.create(cutoff=cutoff)
+        BalanceSnapshot.objects.bulk_create(
+            [
+                BalanceSnapshot(period=period, user_id=user_id, share_count=counts[user_id], **balances[user_id])
+                for user_id in sorted(balances)
+            ],
+            batch_size=1000,
+        )
+        DebtSnapshot.objects.bulk_create(
+            [
+                DebtSnapshot(period=period, debtor_id=debtor, creditor_id=creditor, amount=debts[debtor, creditor])
+                for debtor, creditor in sorted(debts)
+            ],
+            batch_size=1000,
+        )
+        SplitMethodSnapshot.objects.bulk_create([
+            SplitMethodSnapshot(period=period, split_method=method, **methods[method]) for method in sorted(methods)
+        ])
+
+        with connections[alias].cursor() as cursor:
+            period.expense_count = copy_rows(cursor, expenses, ArchivedExpense)
+            period.share_count = copy_rows(cursor, shares, ArchivedExpenseShare)
+            delete_rows(cursor, ExpenseShare, 'expense_id', expenses.values('id'))
+            delete_rows(cursor, Expenses, 'id', expenses.values('id'))
+        period.save(update_fields=['expense_count', 'share_count'])
+        archive_daily_totals(cutoff)
+
+        # Totals are unchanged, but the live listings of everyone involved lose rows
+        user_ids = sorted(archived)
+        for start in range(0, len(user_ids), UPDATE_CHUNK_SIZE):
+            touch_users(user_ids[start:start + UPDATE_CHUNK_SIZE])
+        response_cache.invalidate_users_on_commit(user_ids)
+        response_cache.invalidate_global_on_commit()
+    return period
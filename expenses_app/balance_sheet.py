@@ -0,0 +1,158 @@
+import csv
+import heapq
+import io
+from itertools import chain
+from operator import itemgetter
+
+from .models import User, Expenses, ExpenseShare, ArchivedExpense, ArchivedExpenseShare
+from .money import format_minor
+from .routers import expense_shards
+from .sharding import on_shard, shard_streams
+
+# Number of rows fetched per round trip from the database cursor
+FETCH_CHUNK_SIZE = 2000
+# Number of CSV rows buffered before a chunk is handed to the response
+FLUSH_EVERY = 500
+
+INDIVIDUAL_HEADER = ['User', 'Description', 'Total_Amount', 'Split_Method', 'Date', 'Share_Amount', 'Share_Percentage']
+OVERALL_HEADER = ['Description', 'Total_Amount', 'Split_Method', 'Date']
+
+
+USER_FIELDS = ('id', 'name')
+SHARE_FIELDS = (
+    'user_id',
+    'expense__description',
+    'expense__total_amount',
+    'expense__split_method',
+    'expense__date',
+    'amount',
+    'percentage',
+)
+EXPENSE_FIELDS = ('description', 'total_amount', 'split_method', 'date')
+
+
+def user_rows():
+    return User.objects.order_by('id')
+
+
+def share_rows():
+    return ExpenseShare.objects.order_by('user_id', 'expense_id', 'id')
+
+
+def expense_rows():
+    return Expenses.objects.order_by('id')
+
+
+def archived_share_rows():
+    return ArchivedExpenseShare.objects.order_by('user_id', 'expense_id', 'id')
+
+
+def archived_expense_rows():
+    return ArchivedExpense.objects.order_by('id')
+
+
+def iter_rows(queryset, fields):
+    return queryset.values_list(*fields).iterator(chunk_size=FETCH_CHUNK_SIZE)
+
+
+def iter_shard_rows(queryset, fields, shards=None, by_user=False):
+    # `iter_rows` over the expense shards (every one of them by default). Each shard is
+    # read ahead by a thread of its own; the streams are chained in shard order, which is
+    # the order of the ids, or merged on the user id for `by_user` (share rows).
+    shards = expense_shards() if shards is None else shards
+    if len(shards) == 1:
+        return iter_rows(on_shard(queryset, shards[0]), fields)
+    streams = shard_streams(lambda alias: iter_rows(on_shard(queryset, alias), fields), shards)
+    return heapq.merge(*streams, key=itemgetter(0)) if by_user else chain(*streams)
+
+
+def money(value):
+    # Integer minor units as the decimal string of the sheet; missing amounts stay empty
+    return format_minor(value) if value is not None else None
+
+
+def share_row(user_name, share):
+    _, description, total_amount, split_method, date, amount, percentage = share
+    return [user_name, description, money(total_amount), split_method, date, money(amount), percentage]
+
+
+def expense_row(expense):
+    description, total_amount, split_method, date = expense
+    return [description, money(total_amount), split_method, date]
+
+
+def iter_balance_sheet_rows(users=None, shares=None, expenses=None, include_archived=False, shards=None):
+    # Yield the balance sheet rows in the same layout as the original export.
+    # Users and shares are read as ordered streams and merged, so the whole sheet costs
+    # three queries (five with `include_archived`) per shard regardless of the number of
+    # users or expenses. Exports pass filtered versions of `user_rows()`, `share_rows()` and
+    # `expense_rows()`, group sheets the shard of their group as `shards`. Archived shares
+    # and expenses are listed before the live ones.
+    yield ['Individual Expenses']
+    yield []
+    yield INDIVIDUAL_HEADER
+
+    users = iter_rows(user_rows() if users is None else users, USER_FIELDS)
+    streams = [iter_shard_rows(archived_share_rows(), SHARE_FIELDS, shards, by_user=True)] if include_archived else []
+    streams.append(iter_shard_rows(share_rows() if shares is None else shares, SHARE_FIELDS, shards, by_user=True))
+
+    heads = [next(stream, None) for stream in streams]
+    for user_id, user_name in users:
+        for index, stream in enumerate(streams):
+            share = heads[index]
+            # Skip shares whose user sorts before the current one (cannot normally happen)
+            while share is not None and share[0] < user_id:
+                share = next(stream, None)
+            while share is not None and share[0] == user_id:
+                yield share_row(user_name, share)
+                share = next(stream, None)
+            heads[index] = share
+        yield []
+
+    # Write overall expenses
+    yield []
+    yield ['Overall Expenses']
+    yield OVERALL_HEADER
+
+    if include_archived:
+        for expense in iter_shard_rows(archived_expense_rows(), EXPENSE_FIELDS, shards):
+            yield expense_row(expense)
+    for expense in iter_shard_rows(expense_rows() if expenses is None else expenses, EXPENSE_FIELDS, shards):
+        yield expense_row(expense)
+
+
+# Encodes rows as CSV and hands them out in chunks of `flush_every` rows, so memory
+# use stays constant and the first bytes are sent as soon as they are ready
+class CSVChunker:
+
+    def __init__(self, flush_every=FLUSH_EVERY):
+        self.flush_every = flush_every
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending = 0
+
+    def add(self, row):
+        # Returns a chunk once enough rows are buffered, None otherwise
+        self.writer.writerow(row)
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            return self.flush()
+        return None
+
+    def flush(self):
+        chunk = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate(0)
+        self.pending = 0
+        return chunk
+
+
+def stream_csv(rows, flush_every=FLUSH_EVERY):
+    chunker = CSVChunker(flush_every)
+    for row in rows:
+        chunk = chunker.add(row)
+        if chunk is not None:
+            yield chunk
+    if chunker.pending:
+        yield chunker.flush()
+
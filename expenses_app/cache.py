@@ -0,0 +1,103 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .routers import active_shard, reading_from_replica, sticky_seconds
+
+GLOBAL_VERSION_KEY = 'expenses:version:global'
+USER_VERSION_KEY = 'expenses:version:user:{}'
+
+
+# Response cache for the read endpoints.
+# Every key embeds the current global version and the versions of the users the
+# response depends on, so bumping a version invalidates every dependent entry at once
+# without having to find or delete them.
+class ResponseCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'EXPENSES_CACHE_ALIAS', 'default')]
+
+    @property
+    def timeout(self):
+        timeout = getattr(settings, 'EXPENSES_CACHE_TIMEOUT', 300)
+        if reading_from_replica():
+            # The invalidation of a write can reach the cache before the write reaches
+            # the replica, so what was read there is only kept for as long as it may lag
+            return min(timeout, sticky_seconds())
+        return timeout
+
+    def versions(self, user_ids=()):
+        # Current global and per-user versions. Missing versions are created from the
+        # clock, so a version that was evicted never comes back with an old value.
+        keys = [GLOBAL_VERSION_KEY] + [USER_VERSION_KEY.format(user_id) for user_id in user_ids]
+        found = self.cache.get_many(keys)
+        for key in keys:
+            if key not in found:
+                self.cache.add(key, time.time_ns(), timeout=None)
+                found[key] = self.cache.get(key)
+        return [found[key] for key in keys]
+
+    def versioned_key(self, name, user_ids=()):
+        versions = '.'.join(str(version) for version in self.versions(user_ids))
+        return f'expenses:{name}:{versions}'
+
+    def key(self, name, request, user_ids=()):
+        # Responses embed absolute `next` links, so the full URL is part of the key
+        url = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+        return self.versioned_key(f'response:{name}:{url}', user_ids)
+
+    def get(self, key):
+        data = self.cache.get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def set(self, key, data):
+        self.cache.set(key, data, timeout=self.timeout)
+
+    def bump(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, time.time_ns(), timeout=None)
+
+    def bump_users(self, user_ids):
+        for user_id in set(user_ids):
+            self.bump(USER_VERSION_KEY.format(user_id))
+
+    def bump_global(self):
+        self.bump(GLOBAL_VERSION_KEY)
+
+    def invalidate_users_on_commit(self, user_ids):
+        # Bump the versions once the surrounding transaction commits, on the expense shard
+        # being written to
+        user_ids = set(user_ids)
+        transaction.on_commit(lambda: self.bump_users(user_ids), using=active_shard())
+
+    def invalidate_global_on_commit(self):
+        transaction.on_commit(self.bump_global, using=active_shard())
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,184 @@
+import base64
+import binascii
+import datetime
+import heapq
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef
+from django.utils import timezone
+
+from .fast_serializers import SHARE_FIELDS, archived_share_rows, decimal_string, money_string, share_rows
+from .models import ExpenseChange, ChangeCompaction
+from .routers import active_shard, expense_shards
+from .sharding import gather, id_shard
+
+# Change feed of the users' expense listings.
+# Every write to a user's shares appends (user, expense) to ExpenseChange in the
+# transaction that makes it. A client syncing from a token gets the current state of the
+# expenses changed since: its share of those that still exist (live or archived) and the
+# ids of those that were deleted. The cost depends on the number of changes, not on the
+# length of the listing. Every expense shard keeps the entries of its own expenses, so
+# a token holds one position per shard, in the order of EXPENSES_SHARDS.
+
+
+class ChangesExpired(Exception):
+    pass
+
+
+def encode_token(positions):
+    return base64.urlsafe_b64encode('.'.join(map(str, positions)).encode()).decode().rstrip('=')
+
+
+def decode_token(token):
+    # The positions of a token, one per expense shard
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        positions = [int(position) for position in base64.urlsafe_b64decode(padded.encode()).decode().split('.')]
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid token.")
+    if min(positions) < 0:
+        raise ValueError("Invalid token.")
+    return positions
+
+
+def record_changes(pairs):
+    # Append (user_id, expense_id) pairs to the feed. Must run inside the transaction that
+    # writes the shares.
+    now = timezone.now()
+    ExpenseChange.objects.bulk_create(
+        [
+            ExpenseChange(user_id=user_id, expense_id=expense_id, created_at=now)
+            for user_id, expense_id in sorted(set(pairs))
+        ],
+        batch_size=1000,
+    )
+
+
+def horizon():
+    # Tokens below this position have expired
+    return ChangeCompaction.objects.aggregate(through=Max('through'))['through'] or 0
+
+
+def shard_head():
+    # Position of the latest change of the selected shard that can be served. With
+    # concurrent writers (not SQLite) an entry can commit after one with a higher id, so
+    # the entries of the last EXPENSES_CHANGES_SETTLE_SECONDS are held back to give such
+    # stragglers time to commit.
+    entries = ExpenseChange.objects.all()
+    settle = getattr(settings, 'EXPENSES_CHANGES_SETTLE_SECONDS', 0)
+    if settle:
+        entries = entries.filter(created_at__lte=timezone.now() - datetime.timedelta(seconds=settle))
+    return max(entries.aggregate(last=Max('id'))['last'] or 0, horizon())
+
+
+def head():
+    # `shard_head` of every expense shard
+    return gather(lambda alias: shard_head())
+
+
+def share_change(row):
+    # A share as listed for a single user, with the expense it belongs to and its date
+    return {
+        'expense': row['expense'],
+        'user': row['user'],
+        'amount': money_string(row['amount']),
+        'percentage': decimal_string(row['percentage']),
+        'description': row['expense__description'],
+        'date': row['date'].isoformat(),
+    }
+
+
+def changes_since(user_id, since, limit):
+    # The changes to a user's listing after the `since` positions, at most `limit` entries
+    # of them. Raises ChangesExpired when the feed of a shard no longer goes back that far,
+    # or when the token was issued for other shards.
+    shards = expense_shards()
+    if len(since) != len(shards):
+        raise ChangesExpired()
+
+    def shard_entries(alias):
+        position = since[shards.index(alias)]
+        if position < horizon():
+            return None
+        # Everything up to `bound` is settled; entries written while this runs are left
+        # to the next sync
+        bound = shard_head()
+        entries = list(
+            ExpenseChange.objects.filter(user_id=user_id, id__gt=position, id__lte=bound)
+            .order_by('id').values_list('created_at', 'id', 'expense_id')[:limit + 1]
+        )
+        return bound, entries
+
+    parts = gather(shard_entries)
+    if None in parts:
+        raise ChangesExpired()
+    # The entries of every shard in the order they were written, each shard's in id order
+    merged = heapq.merge(
+        *[[(index, entry) for entry in entries] for index, (_, entries) in enumerate(parts)],
+        key=lambda item: item[1][0],
+    )
+    page = list(islice(merged, limit))
+    taken = [0] * len(shards)
+    for index, _ in page:
+        taken[index] += 1
+    positions = []
+    for index, (bound, entries) in enumerate(parts):
+        if taken[index] < len(entries):
+            # The rest of the shard's entries are left to the next page
+            positions.append(entries[taken[index] - 1][1] if taken[index] else since[index])
+        else:
+            positions.append(max(since[index], bound))
+    has_more = any(count < len(entries) for count, (_, entries) in zip(taken, parts))
+
+    # Latest entry per expense, in the order of the entries
+    expense_ids = list(dict.fromkeys(entry[2] for _, entry in reversed(page)))[::-1]
+
+    def shard_rows(alias):
+        rows = {}
+        missing = [expense_id for expense_id in expense_ids if id_shard(expense_id) == alias]
+        for queryset in (share_rows(), archived_share_rows()):
+            if not missing:
+                break
+            for row in queryset.filter(user_id=user_id, expense_id__in=missing).values(*SHARE_FIELDS, 'expense'):
+                rows[row['expense']] = row
+            missing = [expense_id for expense_id in missing if expense_id not in rows]
+        return rows
+
+    rows = {}
+    for part in gather(shard_rows):
+        rows.update(part)
+    return {
+        'token': encode_token(positions),
+        'has_more': has_more,
+        'changed': [share_change(rows[expense_id]) for expense_id in expense_ids if expense_id in rows],
+        'deleted': [expense_id for expense_id in expense_ids if expense_id not in rows],
+    }
+
+
+def compact_changes(before):
+    # Drop entries superseded by a later one for the same user and expense, which syncs
+    # read in their place, and every entry written before `before`, which expires the
+    # tokens older than them. Returns the number of entries dropped.
+    with transaction.atomic(using=active_shard()):
+        later = ExpenseChange.objects.filter(
+            user_id=OuterRef('user_id'), expense_id=OuterRef('expense_id'), id__gt=OuterRef('id'),
+        )
+        removed, _ = ExpenseChange.objects.filter(Exists(later)).delete()
+        through = ExpenseChange.objects.filter(created_at__lt=before).aggregate(last=Max('id'))['last']
+        if through is not None:
+            expired, _ = ExpenseChange.objects.filter(id__lte=through).delete()
+            removed += expired
+            ChangeCompaction.objects.create(through=through, removed=expired)
+    return removed
+
+
+def reset_changes():
+    # Expire every token issued so far, after a bulk load that wrote expenses without
+    # entries: clients download their listings again. The position is taken from a
+    # throwaway entry so that it is above every token and below every later entry.
+    with transaction.atomic(using=active_shard()):
+        marker = ExpenseChange.objects.create(user_id=0, expense_id=0)
+        ChangeCompaction.objects.create(through=marker.id)
+        marker.delete()
@@ -0,0 +1,24 @@
+from django.core.checks import Error, register
+from django.db import connections
+
+from .routers import expense_shards
+from .sharding import SHARD_ID_VENDORS
+
+# System checks, run by runserver, migrate, test and `manage.py check`
+
+
+@register()
+def check_shard_databases(app_configs, **kwargs):
+    # Every shard after the first hands out ids from its own range, which
+    # `reserve_shard_ids` sets up on SQLite and PostgreSQL only
+    errors = []
+    for alias in expense_shards()[1:]:
+        vendor = connections[alias].vendor
+        if vendor not in SHARD_ID_VENDORS:
+            errors.append(Error(
+                f"Expense shard '{alias}' is a {vendor} database; expense shards are not supported on {vendor}.",
+                hint=f"Use SQLite or PostgreSQL databases in EXPENSES_SHARDS, or remove '{alias}' from it.",
+                obj=alias,
+                id='expenses_app.E001',
+            ))
+    return errors
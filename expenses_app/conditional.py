@@ -0,0 +1,150 @@
+import hashlib
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from .cache import response_cache
+from .models import Expenses, UserBalance, UserTableVersion
+from .sharding import gather
+
+
+# ETag / Last-Modified support for the listing endpoints.
+# Validators come from cheap lookups (one cached ledger row per user, or two index-only
+# MAX queries for the global listings), so a 304 never runs the listing query itself.
+# Balance sheets also embed user names, so theirs add the version of the user table.
+
+def _variant(request):
+    # Every page and page size of a listing gets its own ETag
+    return hashlib.md5(request.GET.urlencode().encode()).hexdigest()[:12]
+
+
+def _user_state(request, user_id):
+    # (version, updated_at) of a user's ledger row, memoized on the request so the
+    # ETag and Last-Modified functions share one lookup. The row is also kept in the
+    # response cache under the user's cache version, which moves on with every change.
+    state = getattr(request, '_expenses_user_state', None)
+    if state is None:
+        key = response_cache.versioned_key('validators', user_ids=[user_id])
+        state = response_cache.cache.get(key)
+        if state is None:
+            state = ledger_state(user_id)
+            response_cache.cache.set(key, state, timeout=response_cache.timeout)
+        request._expenses_user_state = state
+    return state
+
+
+def latest(values):
+    return max((value for value in values if value is not None), default=None)
+
+
+def ledger_state(user_id):
+    # (version, updated_at) of a user's ledger rows, (None, None) without any. With several
+    # expense shards, the sum of their versions and the last of their updates.
+    rows = gather(lambda alias: UserBalance.objects.filter(user_id=user_id).values_list('version', 'updated_at').first())
+    rows = [row for row in rows if row is not None]
+    if not rows:
+        return None, None
+    return sum(version for version, _ in rows), latest(updated_at for _, updated_at in rows)
+
+
+def touch_user_table():
+    # Move the version of the user table on. Runs in the transaction that writes the users.
+    now = timezone.now()
+    if UserTableVersion.objects.filter(pk=1).update(version=F('version') + 1, updated_at=now):
+        return
+    try:
+        with transaction.atomic():
+            UserTableVersion.objects.create(pk=1, version=1, updated_at=now)
+    except IntegrityError:
+        # Created by a concurrent write in the meantime
+        UserTableVersion.objects.filter(pk=1).update(version=F('version') + 1, updated_at=now)
+
+
+def user_table_state():
+    # (version, updated_at) of the user table
+    return UserTableVersion.objects.filter(pk=1).values_list('version', 'updated_at').first() or (0, None)
+
+
+def data_state():
+    # (last expense id, last ledger update) across all users and shards; moves on with
+    # every change to the expenses
+    states = gather(lambda alias: (
+        Expenses.objects.aggregate(last=Max('id'))['last'],
+        UserBalance.objects.aggregate(last=Max('updated_at'))['last'],
+    ))
+    return latest(last_expense for last_expense, _ in states), latest(last_update for _, last_update in states)
+
+
+def sheet_state():
+    # (last expense id, last update, user table version) of the data of a balance sheet;
+    # moves on with every change to the expenses and to the users
+    last_expense, last_update = data_state()
+    users_version, users_updated_at = user_table_state()
+    return last_expense, latest([last_update, users_updated_at]), users_version
+
+
+def _global_state(request):
+    # `data_state()` memoized on the request
+    state = getattr(request, '_expenses_global_state', None)
+    if state is None:
+        state = request._expenses_global_state = data_state()
+    return state
+
+
+def user_expenses_etag(request, user_id):
+    version, _ = _user_state(request, user_id)
+    if version is None:
+        return None
+    return f'user-{user_id}-{version}-{_variant(request)}'
+
+
+def user_expenses_last_modified(request, user_id):
+    return _user_state(request, user_id)[1]
+
+
+def global_etag(request, *args, **kwargs):
+    last_expense, last_update = _global_state(request)
+    if last_expense is None:
+        return None
+    stamp = last_update.timestamp() if last_update else 0
+    return f'all-{last_expense}-{stamp}-{_variant(request)}'
+
+
+def global_last_modified(request, *args, **kwargs):
+    return _global_state(request)[1]
+
+
+def _sheet_state(request):
+    # `sheet_state()` memoized on the request
+    state = getattr(request, '_expenses_sheet_state', None)
+    if state is None:
+        state = request._expenses_sheet_state = sheet_state()
+    return state
+
+
+def sheet_etag(request, *args, **kwargs):
+    last_expense, last_update, users_version = _sheet_state(request)
+    if last_expense is None:
+        return None
+    stamp = last_update.timestamp() if last_update else 0
+    return f'sheet-{last_expense}-{stamp}-{users_version}-{_variant(request)}'
+
+
+def sheet_last_modified(request, *args, **kwargs):
+    return _sheet_state(request)[1]
+
+
+# Method decorators for the class-based views
+user_expenses_condition = method_decorator(
+    condition(etag_func=user_expenses_etag, last_modified_func=user_expenses_last_modified)
+)
+global_condition = method_decorator(
+    condition(etag_func=global_etag, last_modified_func=global_last_modified)
+)
+sheet_condition = method_decorator(
+    condition(etag_func=sheet_etag, last_modified_func=sheet_last_modified)
+)
+
@@ -0,0 +1,143 @@
+import copy
+
+import django
+from django.conf import settings
+
+# Database configuration.
+# `database_settings` builds DATABASES['default'], `replica_settings` the read replicas
+# and `shard_settings` the expense shards from environment variables. They are imported
+# by the settings module, so they must not touch models or settings themselves.
+# `apply_sqlite_pragmas` tunes every new SQLite connection (see signals.py).
+
+ENGINES = {
+    'sqlite': 'django.db.backends.sqlite3',
+    'postgresql': 'django.db.backends.postgresql',
+}
+
+# Applied to every new SQLite connection, in this order; EXPENSES_SQLITE_PRAGMAS replaces them
+SQLITE_PRAGMAS = {
+    # Readers no longer block the writer and a commit appends to the log instead of
+    # rewriting pages in place
+    'journal_mode': 'wal',
+    # With WAL, fsync at checkpoints instead of on every commit. A power loss can lose
+    # the last commits but cannot corrupt the database.
+    'synchronous': 'normal',
+    # Wait up to 5 s for the write lock instead of failing with "database is locked"
+    'busy_timeout': 5000,
+    # 64 MB page cache per connection (negative values are KiB)
+    'cache_size': -64000,
+    # Read the database file through a 256 MB memory map
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+}
+
+
+def env_flag(environ, name, default):
+    value = environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_int(environ, name, default):
+    value = environ.get(name)
+    return default if value in (None, '') else int(value)
+
+
+def database_settings(environ, default_name):
+    # The default database from EXPENSES_DB_* environment variables:
+    #   EXPENSES_DB_ENGINE         sqlite (default) or postgresql
+    #   EXPENSES_DB_NAME           file of the SQLite database, or name of the PostgreSQL one
+    #   EXPENSES_DB_HOST, _PORT, _USER, _PASSWORD    PostgreSQL server
+    #   EXPENSES_DB_CONN_MAX_AGE   seconds a connection is kept across requests (default 60;
+    #                              0 closes it after every request, as under ASGI)
+    #   EXPENSES_DB_POOL           PostgreSQL: use a psycopg connection pool instead of
+    #                              persistent connections (needs psycopg[pool])
+    #   EXPENSES_DB_POOL_MIN_SIZE, EXPENSES_DB_POOL_MAX_SIZE    bounds of that pool
+    engine = environ.get('EXPENSES_DB_ENGINE', 'sqlite')
+    if engine not in ENGINES:
+        raise ValueError(f"EXPENSES_DB_ENGINE must be one of {', '.join(ENGINES)}, not '{engine}'.")
+    database = {
+        'ENGINE': ENGINES[engine],
+        'NAME': environ.get('EXPENSES_DB_NAME') or default_name,
+        'CONN_MAX_AGE': env_int(environ, 'EXPENSES_DB_CONN_MAX_AGE', 60),
+        # Reused connections are checked before a request uses them
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
+    }
+    if engine == 'sqlite':
+        database['OPTIONS'] = sqlite_options()
+    else:
+        database.update({
+            'HOST': environ.get('EXPENSES_DB_HOST', 'localhost'),
+            'PORT': environ.get('EXPENSES_DB_PORT', '5432'),
+            'USER': environ.get('EXPENSES_DB_USER', ''),
+            'PASSWORD': environ.get('EXPENSES_DB_PASSWORD', ''),
+        })
+        if env_flag(environ, 'EXPENSES_DB_POOL', False):
+            if django.VERSION < (5, 1):
+                raise ValueError("EXPENSES_DB_POOL needs Django 5.1 or later.")
+            # Pooled connections go back to the pool after every request and cannot also
+            # be persistent
+            database['CONN_MAX_AGE'] = 0
+            database['OPTIONS']['pool'] = {
+                'min_size': env_int(environ, 'EXPENSES_DB_POOL_MIN_SIZE', 2),
+                'max_size': env_int(environ, 'EXPENSES_DB_POOL_MAX_SIZE', 20),
+            }
+    return database
+
+
+def replica_settings(environ, primary):
+    # Read replica aliases ('replica1', 'replica2', ...) from EXPENSES_DB_REPLICAS, a comma
+    # separated list of SQLite files or of PostgreSQL hosts (host or host:port). Replicas
+    # share every other setting with the primary, and test runs point them at the test
+    # database of the primary.
+    replicas = {}
+    entries = [entry.strip() for entry in environ.get('EXPENSES_DB_REPLICAS', '').split(',') if entry.strip()]
+    for index, entry in enumerate(entries, start=1):
+        replica = copy.deepcopy(primary)
+        if primary['ENGINE'] == ENGINES['sqlite']:
+            replica['NAME'] = entry
+        else:
+            host, _, port = entry.partition(':')
+            replica.update(HOST=host, PORT=port or primary['PORT'])
+        replica['TEST'] = {'MIRROR': 'default'}
+        replicas[f'replica{index}'] = replica
+    return replicas
+
+
+def shard_settings(environ, primary):
+    # Expense shard aliases ('shard1', 'shard2', ...) from EXPENSES_DB_SHARDS, a comma
+    # separated list of SQLite files or of PostgreSQL hosts (host or host:port), in the
+    # same format as EXPENSES_DB_REPLICAS. The default database is the first shard. Unlike
+    # replicas, shards hold data of their own and get test databases of their own.
+    shards = {}
+    entries = [entry.strip() for entry in environ.get('EXPENSES_DB_SHARDS', '').split(',') if entry.strip()]
+    for index, entry in enumerate(entries, start=1):
+        shard = copy.deepcopy(primary)
+        if primary['ENGINE'] == ENGINES['sqlite']:
+            shard['NAME'] = entry
+        else:
+            host, _, port = entry.partition(':')
+            shard.update(HOST=host, PORT=port or primary['PORT'])
+        shards[f'shard{index}'] = shard
+    return shards
+
+
+def sqlite_options():
+    # Take the write lock when a transaction starts (Django 5.1+). Deferred transactions
+    # that read before they write cannot wait for the lock once another connection has
+    # written, and fail with "database is locked" whatever the busy timeout.
+    return {'transaction_mode': 'IMMEDIATE'} if django.VERSION >= (5, 1) else {}
+
+
+def sqlite_pragmas():
+    return getattr(settings, 'EXPENSES_SQLITE_PRAGMAS', SQLITE_PRAGMAS)
+
+
+def apply_sqlite_pragmas(connection):
+    # Run on the raw connection, before Django or the query instrumentation sees it
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in sqlite_pragmas().items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
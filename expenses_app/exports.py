@@ -0,0 +1,253 @@
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.utils import timezone
+
+from .balance_sheet import (
+    EXPENSE_FIELDS, SHARE_FIELDS, expense_rows, iter_balance_sheet_rows, iter_shard_rows, money, share_rows, user_rows,
+)
+from .conditional import sheet_state
+from .models import ExportJob
+from .sharding import gather, on_shard
+
+# Export jobs: the balance sheet (optionally limited to a date range and a user) written
+# to a file by a background worker, for tenants whose sheet takes longer to produce than
+# a proxy lets a request run. A finished file is handed out again to identical requests
+# until the expenses change.
+
+EXTENSIONS = {'csv': 'csv', 'csv.gz': 'csv.gz', 'jsonl': 'jsonl'}
+CONTENT_TYPES = {'csv': 'text/csv', 'csv.gz': 'application/gzip', 'jsonl': 'application/x-ndjson'}
+
+# Progress (and the worker heartbeat) is saved every this many rows
+PROGRESS_EVERY = 5000
+
+JSONL_SHARE_FIELDS = ('user_id', 'user__name', *SHARE_FIELDS[1:])
+JSONL_SHARE_KEYS = ('user_id', 'user', 'description', 'total_amount', 'split_method', 'date', 'amount', 'percentage')
+JSONL_EXPENSE_FIELDS = ('id', *EXPENSE_FIELDS, 'paid_by_id')
+JSONL_EXPENSE_KEYS = ('id', 'description', 'total_amount', 'split_method', 'date', 'paid_by')
+
+
+def export_dir():
+    return str(getattr(settings, 'EXPENSES_EXPORT_DIR', os.path.join(settings.BASE_DIR, 'exports')))
+
+
+def export_path(job):
+    return os.path.join(export_dir(), job.file_name)
+
+
+def download_name(job):
+    return f'balance_sheet.{EXTENSIONS[job.format]}'
+
+
+def sendfile_location(job, header):
+    # Value of the `header` (EXPENSES_EXPORT_SENDFILE_HEADER) that makes the web server
+    # send the file: a URL under EXPENSES_EXPORT_SENDFILE_URL for nginx, the path otherwise
+    if header.lower() == 'x-accel-redirect':
+        return getattr(settings, 'EXPENSES_EXPORT_SENDFILE_URL', '/protected-exports/') + job.file_name
+    return export_path(job)
+
+
+def job_key(params, state):
+    # Identical parameters over identical data share one job
+    user = params.get('user')
+    values = [
+        params.get('format', 'csv'),
+        params.get('date_from'),
+        params.get('date_to'),
+        user.pk if user is not None else None,
+        *state,
+    ]
+    return hashlib.sha256(json.dumps(values, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def job_querysets(job):
+    # The users, shares and expenses of the export, in balance sheet order
+    users, shares, expenses = user_rows(), share_rows(), expense_rows()
+    if job.user_id is not None:
+        users = users.filter(id=job.user_id)
+        shares = shares.filter(user_id=job.user_id)
+        expenses = expenses.filter(shares__user_id=job.user_id).distinct()
+    if job.date_from is not None:
+        shares = shares.filter(date__gte=job.date_from)
+        expenses = expenses.filter(date__gte=job.date_from)
+    if job.date_to is not None:
+        shares = shares.filter(date__lte=job.date_to)
+        expenses = expenses.filter(date__lte=job.date_to)
+    return users, shares, expenses
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+def jsonl_lines(users, shares, expenses):
+    encoder = DjangoJSONEncoder()
+    for row in iter_shard_rows(shares, JSONL_SHARE_FIELDS, by_user=True):
+        line = dict(zip(JSONL_SHARE_KEYS, row))
+        line['total_amount'], line['amount'] = money(line['total_amount']), money(line['amount'])
+        yield encoder.encode({'type': 'share', **line}) + '\n'
+    for row in iter_shard_rows(expenses, JSONL_EXPENSE_FIELDS):
+        line = dict(zip(JSONL_EXPENSE_KEYS, row))
+        line['total_amount'] = money(line['total_amount'])
+        yield encoder.encode({'type': 'expense', **line}) + '\n'
+
+
+def export_lines(job):
+    # (lines of the file, number of data rows they hold)
+    users, shares, expenses = job_querysets(job)
+    rows = sum(gather(lambda alias: on_shard(shares, alias).count() + on_shard(expenses, alias).count()))
+    if job.format == 'jsonl':
+        return jsonl_lines(users, shares, expenses), rows
+    lines = csv_lines(iter_balance_sheet_rows(users, shares, expenses))
+    return lines, users.count() + rows
+
+
+def open_artifact(job, path):
+    if job.format == 'csv.gz':
+        return gzip.open(path, 'wt', newline='')
+    return open(path, 'w', newline='')
+
+
+def save_progress(job, **fields):
+    fields['updated_at'] = timezone.now()
+    ExportJob.objects.filter(id=job.id).update(**fields)
+
+
+def write_export(job):
+    # Write the artifact under a temporary name and move it in place once complete
+    os.makedirs(export_dir(), exist_ok=True)
+    job.file_name = f'export-{job.id}.{EXTENSIONS[job.format]}'
+    path = export_path(job)
+    temporary = f'{path}.part'
+    lines, total = export_lines(job)
+    save_progress(job, rows_total=total)
+    written = 0
+    try:
+        with open_artifact(job, temporary) as f:
+            for line in lines:
+                f.write(line)
+                written += 1
+                if written % PROGRESS_EVERY == 0:
+                    save_progress(job, rows_written=min(written, total))
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    save_progress(
+        job, status='done', rows_written=total, file_name=job.file_name,
+        size=os.path.getsize(path), finished_at=timezone.now(),
+    )
+    expire_superseded(job)
+
+
+def expire_superseded(job):
+    # Artifacts of the same export over older data are no longer handed out
+    older = ExportJob.objects.filter(
+        status='done', format=job.format, date_from=job.date_from, date_to=job.date_to,
+        user_id=job.user_id, id__lt=job.id,
+    )
+    for old in older:
+        path = export_path(old)
+        if old.file_name and os.path.exists(path):
+            os.remove(path)
+    older.update(status='expired', updated_at=timezone.now())
+
+
+def run_export(job_id):
+    # Claim the job and write it; a job claimed elsewhere is left alone
+    if not ExportJob.objects.filter(id=job_id, status='pending').update(status='running', updated_at=timezone.now()):
+        return
+    job = ExportJob.objects.get(id=job_id)
+    try:
+        write_export(job)
+    except Exception as e:
+        save_progress(job, status='failed', error=str(e), finished_at=timezone.now())
+
+
+def is_stale(job):
+    # Queued or running jobs whose worker stopped (e.g. the process was restarted)
+    if job.status not in ('pending', 'running'):
+        return False
+    limit = datetime.timedelta(seconds=getattr(settings, 'EXPENSES_EXPORT_STALE_SECONDS', 600))
+    return timezone.now() - job.updated_at > limit
+
+
+def refresh(job):
+    # Fail jobs whose worker is gone and expire finished jobs whose file was removed,
+    # so they no longer stand in for new requests
+    if is_stale(job):
+        job.status, job.error = 'failed', "The export worker stopped."
+    elif job.status == 'done' and not os.path.exists(export_path(job)):
+        job.status = 'expired'
+    else:
+        return job
+    save_progress(job, status=job.status, error=job.error)
+    return job
+
+
+def start_export(params):
+    # The job exporting `params` over the current data: an identical queued, running or
+    # finished job when there is one, a new queued job otherwise. Returns (job, created).
+    key = job_key(params, sheet_state())
+    for _ in range(2):
+        job = ExportJob.objects.filter(key=key, status__in=ExportJob.ACTIVE_STATUSES).first()
+        if job is not None and refresh(job).status in ExportJob.ACTIVE_STATUSES:
+            return job, False
+        try:
+            with transaction.atomic():
+                job = ExportJob.objects.create(key=key, **params)
+        except IntegrityError:
+            # An identical request created it in the meantime
+            continue
+        transaction.on_commit(lambda: export_runner.submit(job.id))
+        return job, True
+    return ExportJob.objects.get(key=key, status__in=ExportJob.ACTIVE_STATUSES), False
+
+
+def run_in_worker(job_id):
+    close_old_connections()
+    try:
+        run_export(job_id)
+    finally:
+        # Worker threads have their own connections
+        connections.close_all()
+
+
+# Bounded pool of worker threads writing the exports. EXPENSES_EXPORT_WORKERS = 0 runs
+# every export in the thread that queued it, once its transaction commits.
+class ExportRunner:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def submit(self, job_id):
+        # Returns the future of the export, or None when it already ran
+        workers = getattr(settings, 'EXPENSES_EXPORT_WORKERS', 2)
+        if not workers:
+            run_export(job_id)
+            return None
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='expenses-export')
+        return self.executor.submit(run_in_worker, job_id)
+
+
+export_runner = ExportRunner()
@@ -0,0 +1,112 @@
+from collections import defaultdict
+
+from .models import Expenses, ExpenseShare, ArchivedExpense, ArchivedExpenseShare
+from .money import CENT, format_minor
+from .sharding import fetch_all, id_shard, on_shard
+
+# Read-only serialization for the listing endpoints.
+# Builds the same structures as ExpenseSerializer / ExpenseShareSerializer straight from
+# `.values()` rows, skipping model instances and DRF's field-by-field `to_representation`.
+
+EXPENSE_FIELDS = ('id', 'description', 'total_amount', 'split_method', 'date', 'paid_by', 'group')
+SHARE_FIELDS = ('id', 'user', 'amount', 'percentage', 'expense__description', 'date')
+
+
+def decimal_string(value):
+    # Same as DRF's DecimalField output for two decimal places
+    if value is None:
+        return None
+    return '{:f}'.format(value.quantize(CENT))
+
+
+def money_string(value):
+    # Same as MoneyField's output for integer minor units
+    if value is None:
+        return None
+    return format_minor(value)
+
+
+def expense_rows():
+    # Queryset of expense rows for `serialize_expenses`, ready to be paginated
+    return Expenses.objects.values(*EXPENSE_FIELDS)
+
+
+def share_rows():
+    # Queryset of share rows for `serialize_shares`, ready to be paginated
+    return ExpenseShare.objects.values(*SHARE_FIELDS)
+
+
+def archived_expense_rows():
+    # Same as `expense_rows()` over the archive table of closed periods
+    return ArchivedExpense.objects.values(*EXPENSE_FIELDS)
+
+
+def archived_share_rows():
+    # Same as `share_rows()` over the archive table of closed periods
+    return ArchivedExpenseShare.objects.values(*SHARE_FIELDS)
+
+
+def expense_dict(row):
+    return {
+        'id': row['id'],
+        'description': row['description'],
+        'total_amount': money_string(row['total_amount']),
+        'split_method': row['split_method'],
+        'date': row['date'].isoformat(),
+        'paid_by': row['paid_by'],
+        'group': row['group'],
+        'shares': [],
+    }
+
+
+def page_shares(expense_ids, include_archived=False):
+    # Querysets of every share of a page of expenses, in the order they are listed in.
+    # Pages that may hold archived expenses also read the archived shares, and pages of
+    # several expense shards read the shares of each of them.
+    models = (ExpenseShare, ArchivedExpenseShare) if include_archived else (ExpenseShare,)
+    by_shard = defaultdict(list)
+    for expense_id in expense_ids:
+        by_shard[id_shard(expense_id)].append(expense_id)
+    return [
+        on_shard(model.objects.filter(expense_id__in=ids), alias)
+        .order_by('id')
+        .values_list('expense_id', 'user_id', 'amount', 'percentage')
+        for alias, ids in by_shard.items()
+        for model in models
+    ]
+
+
+def add_share(by_id, share):
+    expense_id, user_id, amount, percentage = share
+    expense = by_id[expense_id]
+    expense['shares'].append({
+        'user': user_id,
+        'amount': money_string(amount),
+        'percentage': decimal_string(percentage),
+        'description': expense['description'],
+    })
+
+
+def serialize_expenses(rows, include_archived=False):
+    # Expenses with their shares nested under them, loading every share of the page with
+    # one query (two with `include_archived`, per shard) and grouping them in a single pass
+    expenses = [expense_dict(row) for row in rows]
+    by_id = {expense['id']: expense for expense in expenses}
+    if by_id:
+        for shares in fetch_all(page_shares(by_id, include_archived)):
+            for share in shares:
+                add_share(by_id, share)
+    return expenses
+
+
+def serialize_shares(rows):
+    # Shares with the description of their expense, as listed for a single user
+    return [
+        {
+            'user': row['user'],
+            'amount': money_string(row['amount']),
+            'percentage': decimal_string(row['percentage']),
+            'description': row['expense__description'],
+        }
+        for row in rows
+    ]
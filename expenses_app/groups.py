@@ -0,0 +1,58 @@
+from .balance_sheet import expense_rows as sheet_expense_rows, share_rows as sheet_share_rows, user_rows
+from .fast_serializers import expense_rows
+from .models import Expenses, ExpenseShare, GroupMembership, ArchivedExpense, ArchivedExpenseShare
+from .reports import ExpenseArrays
+from .sharding import group_shard, on_shard
+
+# Group-scoped reads. Every query filters on the group first so it runs on the
+# (group, date, id) index of expenses or the (group, user) index of shares and
+# its cost follows the size of the group rather than the size of the database. All the
+# expenses of a group are on the shard of the group (see sharding.py).
+
+
+def group_expense_rows(group_id):
+    # `expense_rows()` limited to a group, for the keyset-paginated listing
+    return on_shard(expense_rows().filter(group_id=group_id), group_shard(group_id))
+
+
+def member_ids(group_id):
+    return list(GroupMembership.objects.filter(group_id=group_id).order_by('user_id').values_list('user_id', flat=True))
+
+
+def group_balances(group_id):
+    # Owed, paid and net amounts of every member over the expenses of the group,
+    # in the layout of the user totals report. Snapshots are not kept per group, so the
+    # group's archived expenses are read too, from the group indexes of the archive tables.
+    alias = group_shard(group_id)
+    arrays = ExpenseArrays.load(
+        on_shard(Expenses.objects.filter(group_id=group_id), alias),
+        on_shard(ExpenseShare.objects.filter(group_id=group_id), alias),
+        archived=(
+            on_shard(ArchivedExpense.objects.filter(group_id=group_id), alias),
+            on_shard(ArchivedExpenseShare.objects.filter(group_id=group_id), alias),
+        ),
+    )
+    totals = {row['user']: row for row in arrays.user_totals()}
+    balances = []
+    for user_id in member_ids(group_id):
+        balances.append(totals.pop(user_id, {
+            "user": user_id, "total_owed": "0.00", "total_paid": "0.00", "net_balance": "0.00", "share_count": 0,
+        }))
+    # Users who took part in the group's expenses before leaving it
+    balances.extend(totals[user_id] for user_id in sorted(totals))
+    return balances
+
+
+def group_sheet_querysets(group_id):
+    # The users, shares and expenses of a group's balance sheet, for `iter_balance_sheet_rows`
+    # with the shard of the group. The users are the members and the users with shares in
+    # the group, so the shares of former members are listed too, as in `group_balances`.
+    share_user_ids = on_shard(
+        ExpenseShare.objects.filter(group_id=group_id).order_by().values_list('user_id', flat=True).distinct(),
+        group_shard(group_id),
+    )
+    return (
+        user_rows().filter(id__in=sorted(set(member_ids(group_id)).union(share_user_ids))),
+        sheet_share_rows().filter(group_id=group_id),
+        sheet_expense_rows().filter(group_id=group_id),
+    )
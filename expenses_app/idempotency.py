@@ -0,0 +1,210 @@
+import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+# Idempotency keys of the expense creation endpoints.
+# A client retrying a POST with the Idempotency-Key header of the first attempt gets the
+# response of that attempt back (with an Idempotent-Replayed header) instead of creating
+# the expenses again; the retry neither validates nor touches the expense tables.
+#
+# The first request claims the key by inserting its row: the unique constraint lets a
+# single request win, and duplicates wait for it to store its response. Within a process
+# they wait on the lock of their key, across processes they poll the row. Stored responses are also kept
+# in an in-process LRU, so most replays run no query at all. Keys expire after
+# EXPENSES_IDEMPOTENCY_TTL seconds; `purge_idempotency_keys` deletes the expired rows.
+#
+# The response is stored in the transaction that writes the expenses, so a request that
+# dies halfway leaves neither. Its claim is taken over by a retry once it is older than
+# EXPENSES_IDEMPOTENCY_LOCK_SECONDS. With several expense shards the expenses commit
+# first, on their shard.
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+# Seconds between two looks at a key claimed by a request of another process
+POLL_SECONDS = 0.05
+
+
+class IdempotencyError(Exception):
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def ttl():
+    return datetime.timedelta(seconds=getattr(settings, 'EXPENSES_IDEMPOTENCY_TTL', 24 * 3600))
+
+
+def request_hash(request):
+    # The parsed body, whatever its key order or whitespace
+    body = json.dumps(request.data, sort_keys=True, cls=JSONEncoder)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+# Bounded LRU of the stored responses: (endpoint, key) -> (request hash, status, data,
+# expiry). Stored responses never change, so entries are only dropped when they expire or
+# are evicted. It also holds a lock per key the requests of this process are using,
+# dropped once none of them holds or waits for it.
+class ReplayCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.key_locks = {}
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'EXPENSES_IDEMPOTENCY_CACHE_SIZE', 10000)
+
+    def get(self, endpoint, key):
+        with self.lock:
+            entry = self.entries.get((endpoint, key))
+            if entry is None:
+                return None
+            if entry[3] <= timezone.now():
+                del self.entries[(endpoint, key)]
+                return None
+            self.entries.move_to_end((endpoint, key))
+            return entry
+
+    def put(self, endpoint, key, entry):
+        with self.lock:
+            self.entries[(endpoint, key)] = entry
+            self.entries.move_to_end((endpoint, key))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @contextmanager
+    def key_lock(self, endpoint, key):
+        # Serializes the requests of this process made with the same key, and only those
+        with self.lock:
+            entry = self.key_locks.setdefault((endpoint, key), [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.key_locks[(endpoint, key)]
+
+
+replay_cache = ReplayCache()
+
+
+def stored_entry(row):
+    return row.request_hash, row.status_code, row.response, row.expires_at
+
+
+def claim(endpoint, key, fingerprint):
+    # (row, claimed): the row inserted (or taken over) for this request, or the row of
+    # another request once it stored its response, or once EXPENSES_IDEMPOTENCY_WAIT_SECONDS
+    # passed without it doing so
+    deadline = time.monotonic() + getattr(settings, 'EXPENSES_IDEMPOTENCY_WAIT_SECONDS', 10)
+    lock_timeout = datetime.timedelta(seconds=getattr(settings, 'EXPENSES_IDEMPOTENCY_LOCK_SECONDS', 60))
+    while True:
+        now = timezone.now()
+        row = IdempotencyKey.objects.filter(endpoint=endpoint, key=key).first()
+        if row is None or row.expires_at <= now:
+            try:
+                with transaction.atomic():
+                    if row is not None:
+                        IdempotencyKey.objects.filter(pk=row.pk, expires_at__lte=now).delete()
+                    row = IdempotencyKey.objects.create(
+                        endpoint=endpoint, key=key, request_hash=fingerprint, claimed_at=now, expires_at=now + ttl(),
+                    )
+                return row, True
+            except IntegrityError:
+                # A duplicate claimed it in the meantime
+                continue
+        if row.status_code is not None or row.request_hash != fingerprint:
+            return row, False
+        if row.claimed_at <= now - lock_timeout:
+            # The request that claimed it died before storing a response
+            taken = IdempotencyKey.objects.filter(pk=row.pk, status_code=None, claimed_at=row.claimed_at).update(claimed_at=now)
+            if taken:
+                row.claimed_at = now
+                return row, True
+            continue
+        if time.monotonic() >= deadline:
+            return row, False
+        time.sleep(POLL_SECONDS)
+
+
+def replay(entry, fingerprint):
+    stored_hash, status_code, data, _ = entry
+    if stored_hash != fingerprint:
+        raise IdempotencyError(
+            "This Idempotency-Key was already used for a different request.", status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    if status_code is None:
+        raise IdempotencyError("A request with this Idempotency-Key is still being processed.", status.HTTP_409_CONFLICT)
+    return Response(data, status=status_code, headers={REPLAYED_HEADER: 'true'})
+
+
+def run_once(endpoint, key, fingerprint, handler):
+    entry = replay_cache.get(endpoint, key)
+    if entry is not None:
+        return replay(entry, fingerprint)
+    row, claimed = claim(endpoint, key, fingerprint)
+    if not claimed:
+        if row.status_code is not None:
+            replay_cache.put(endpoint, key, stored_entry(row))
+        return replay(stored_entry(row), fingerprint)
+    with transaction.atomic():
+        response = handler()
+        if response.status_code >= 500:
+            # Not stored: a retry runs the request again
+            IdempotencyKey.objects.filter(pk=row.pk).delete()
+            return response
+        row.status_code, row.response = response.status_code, response.data
+        row.save(update_fields=['status_code', 'response'])
+    replay_cache.put(endpoint, key, stored_entry(row))
+    return response
+
+
+def idempotent(request, endpoint, handler):
+    # The Response of handler() for a request without an Idempotency-Key. With one, the
+    # Response of the first request made with it to `endpoint`, handler() running only for
+    # that request. Responses with a 5xx status are not kept.
+    key = request.META.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return handler()
+    if not 0 < len(key) <= MAX_KEY_LENGTH:
+        return Response(
+            {"errors": {"Idempotency-Key": [f"Ensure this header has 1 to {MAX_KEY_LENGTH} characters."]}},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    try:
+        fingerprint = request_hash(request)
+        with replay_cache.key_lock(endpoint, key):
+            return run_once(endpoint, key, fingerprint, handler)
+    except IdempotencyError as e:
+        return Response({"errors": str(e)}, status=e.status_code)
+    except Exception as e:
+        return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def purge_expired_keys():
+    # Delete the expired keys; returns how many
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
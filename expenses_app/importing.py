@@ -0,0 +1,398 @@
+import csv
+import json
+import multiprocessing
+import os
+from collections import defaultdict, deque
+
+import django
+from django.db import connections
+from rest_framework import serializers
+from rest_framework.fields import empty
+
+from .ingest import save_expenses, shard_chunks, share_error, split_error
+from .models import User, Expenses, ExpenseShare
+from .serializers import ExpenseSerializer, ExpenseShareSerializer
+from .sharding import atomic_on, id_shard, on_shard, use_shard
+
+# Streaming import of expense history from CSV or JSONL files.
+# Records flow through generators (read, validate, insert one batch per transaction), so
+# memory is bounded by the batch size and not by the size of the file. Every record
+# carries the byte offset where the next one starts; checkpoints store the offset after
+# the last committed batch, which is where an interrupted import resumes. With several
+# expense shards every expense goes to the shard of its payer, like those of the API.
+#
+# JSONL: one expense per line, users given by email:
+#   {"description": "Dinner", "total_amount": "30.00", "split_method": "exact",
+#    "date": "2019-05-01", "paid_by": "a@example.com",
+#    "shares": [{"user": "a@example.com", "amount": "10.00"}, {"user": "b@example.com", "amount": "20.00"}]}
+#
+# CSV: one share per row. Consecutive rows with the same `expense` key form one expense,
+# whose columns are read from its first row:
+#   expense,description,total_amount,split_method,date,paid_by,user,amount,percentage
+
+FORMATS = ('csv', 'jsonl')
+CSV_REQUIRED_COLUMNS = ('expense', 'description', 'total_amount', 'split_method', 'user')
+CSV_EXPENSE_COLUMNS = ('description', 'total_amount', 'split_method', 'date', 'paid_by')
+CSV_SHARE_COLUMNS = ('user', 'amount', 'percentage')
+
+# Largest number of ids in one `id IN (...)` filter
+ID_CHUNK_SIZE = 500
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    raise ValueError(f"Cannot tell the format of '{path}'; expected a .csv or .jsonl file.")
+
+
+def read_lines(f, offset):
+    # (line, offset after the line) of the binary file `f`, from `offset` on
+    f.seek(offset)
+    for line in f:
+        offset += len(line)
+        yield line, offset
+
+
+def jsonl_records(f, offset):
+    # Raw records are the undecoded lines; they are parsed where they are validated
+    for line, end in read_lines(f, offset):
+        if line.strip():
+            yield line, end
+
+
+def csv_header(f):
+    # (column names, offset of the first data row)
+    f.seek(0)
+    line = f.readline()
+    header = [name.strip() for name in next(csv.reader([line.decode('utf-8-sig')]), [])]
+    missing = [name for name in CSV_REQUIRED_COLUMNS if name not in header]
+    if missing:
+        raise ValueError(f"The CSV header lacks the columns: {', '.join(missing)}.")
+    return header, len(line)
+
+
+def csv_rows(f, offset):
+    # (row, offset after the row). The reader only pulls the lines of the row it returns,
+    # so the offset is exact even for quoted values spanning several lines.
+    position = [offset]
+
+    def lines():
+        for line, end in read_lines(f, offset):
+            position[0] = end
+            yield line.decode('utf-8')
+
+    for row in csv.reader(lines()):
+        yield row, position[0]
+
+
+def csv_records(f, offset):
+    # Raw records are the rows ({column: value}) of one expense
+    header, data_offset = csv_header(f)
+    group, key, end = [], None, max(offset, data_offset)
+    for row, row_end in csv_rows(f, end):
+        if not any(value.strip() for value in row):
+            continue
+        row = dict(zip(header, row))
+        if group and row['expense'] != key:
+            yield group, end
+            group = []
+        group.append(row)
+        key, end = row['expense'], row_end
+    if group:
+        yield group, end
+
+
+def read_records(f, fmt, offset):
+    return csv_records(f, offset) if fmt == 'csv' else jsonl_records(f, offset)
+
+
+def parse_record(fmt, raw):
+    # Raw record -> expense item in the JSONL shape
+    if fmt == 'jsonl':
+        return json.loads(raw)
+    first = raw[0]
+    item = {name: first[name].strip() for name in CSV_EXPENSE_COLUMNS if (first.get(name) or '').strip()}
+    item['shares'] = [
+        {name: row[name].strip() for name in CSV_SHARE_COLUMNS if (row.get(name) or '').strip()}
+        for row in raw
+    ]
+    return item
+
+
+# Validates import items with the fields and split rules of ExpenseSerializer, resolving
+# user emails through `users` ({email: id}) instead of querying the database
+class ItemValidator:
+
+    def __init__(self, users):
+        self.users = users
+        fields = ExpenseSerializer().fields
+        share_fields = ExpenseShareSerializer().fields
+        self.fields = {name: fields[name] for name in ('description', 'total_amount', 'split_method')}
+        self.share_fields = {name: share_fields[name] for name in ('amount', 'percentage')}
+        # `date` is read-only through the API; history keeps its original dates
+        self.date_field = serializers.DateField()
+
+    def resolve(self, email):
+        user_id = self.users.get(email) if isinstance(email, str) else None
+        if user_id is None:
+            raise serializers.ValidationError(f"No user with the email '{email}'.")
+        return user_id
+
+    def validate(self, item):
+        # (validated data, None) or (None, errors). Users are given by id in the data.
+        if not isinstance(item, dict):
+            return None, {"non_field_errors": ["Invalid data. Expected a dictionary."]}
+        data, errors = {}, {}
+        for name, field in self.fields.items():
+            try:
+                data[name] = field.run_validation(item.get(name, empty))
+            except serializers.ValidationError as e:
+                errors[name] = e.detail
+        if item.get('date') is not None:
+            try:
+                data['date'] = self.date_field.run_validation(item['date'])
+            except serializers.ValidationError as e:
+                errors['date'] = e.detail
+        data['paid_by'] = None
+        if item.get('paid_by') not in (None, ''):
+            try:
+                data['paid_by'] = self.resolve(item['paid_by'])
+            except serializers.ValidationError as e:
+                errors['paid_by'] = e.detail
+
+        shares = item.get('shares', empty)
+        if shares is empty:
+            errors['shares'] = ["This field is required."]
+        elif not isinstance(shares, list):
+            errors['shares'] = [f'Expected a list of items but got type "{type(shares).__name__}".']
+        elif not shares:
+            errors['shares'] = ["This list may not be empty."]
+        else:
+            data['shares'] = []
+            share_errors = {}
+            for index, share in enumerate(shares):
+                share_data, error = self.validate_share(share, item.get('split_method'))
+                data['shares'].append(share_data)
+                if error is not None:
+                    share_errors[index] = error
+            if share_errors:
+                # Keyed by position, as the nested serializer reports them
+                errors['shares'] = share_errors
+
+        if not errors:
+            error = split_error(data['split_method'], data['total_amount'], data['shares'])
+            if error is not None:
+                errors['non_field_errors'] = [error]
+        if errors:
+            return None, errors
+        return data, None
+
+    def validate_share(self, share, split_method):
+        if not isinstance(share, dict):
+            return None, {"non_field_errors": ["Invalid data. Expected a dictionary."]}
+        data, errors = {}, {}
+        try:
+            data['user'] = self.resolve(share.get('user'))
+        except serializers.ValidationError as e:
+            errors['user'] = e.detail
+        for name, field in self.share_fields.items():
+            if name in share:
+                try:
+                    data[name] = field.run_validation(share[name])
+                except serializers.ValidationError as e:
+                    errors[name] = e.detail
+        if not errors:
+            error = share_error(split_method, data)
+            if error is not None:
+                errors = error if isinstance(error, dict) else {"non_field_errors": [error]}
+        return data, errors or None
+
+
+def validate_batch(validator, fmt, batch):
+    # [((validated data, errors), end offset)] of a batch of (raw record, end offset)
+    results = []
+    for raw, end in batch:
+        try:
+            item = parse_record(fmt, raw)
+        except ValueError as e:
+            results.append(((None, {"non_field_errors": [f"Invalid record: {e}"]}), end))
+            continue
+        results.append((validator.validate(item), end))
+    return results
+
+
+worker_validator = None
+
+
+def init_worker(users):
+    global worker_validator
+    # Workers started with `spawn` begin with a fresh interpreter
+    django.setup()
+    worker_validator = ItemValidator(users)
+
+
+def validate_in_worker(fmt, batch):
+    return validate_batch(worker_validator, fmt, batch)
+
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def validated_batches(records, fmt, users, batch_size, workers=0):
+    # Validated batches in file order. With `workers`, batches are validated by a pool of
+    # processes while the current one is inserted; at most two batches per worker are in
+    # flight, so a slow database does not let parsed records pile up in memory.
+    if not workers:
+        validator = ItemValidator(users)
+        for batch in batches(records, batch_size):
+            yield validate_batch(validator, fmt, batch)
+        return
+    # Forked workers must not share the parent's database connections
+    connections.close_all()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(users,)) as pool:
+        pending = deque()
+        for batch in batches(records, batch_size):
+            pending.append(pool.apply_async(validate_in_worker, (fmt, batch)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def load_user_emails():
+    # {email: id} of every user, built once per import
+    return dict(User.objects.values_list('email', 'id').iterator(chunk_size=10000))
+
+
+def import_chunks(items):
+    # (shard, [(index, expense data)]) pairs of validated items, one per shard their
+    # expenses go to, in the shape `save_expenses` expects
+    stubs = {}
+
+    def user(user_id):
+        if user_id not in stubs:
+            stubs[user_id] = User(id=user_id)
+        return stubs[user_id]
+
+    data = [
+        {
+            'description': item['description'],
+            'total_amount': item['total_amount'],
+            'split_method': item['split_method'],
+            'paid_by': user(item['paid_by']) if item['paid_by'] is not None else None,
+            'shares': [{**share, 'user': user(share['user'])} for share in item['shares']],
+        }
+        for item in items
+    ]
+    return list(shard_chunks(enumerate(data), len(data)))
+
+
+def save_items(items, chunks):
+    # Insert the `import_chunks` of validated items and give them their original dates.
+    # Must run inside a transaction on every shard of the chunks. The ledger is left to
+    # `rebuild_ledger` once the whole file is in. Returns the first expense of every shard.
+    first = []
+    for alias, chunk in chunks:
+        with use_shard(alias):
+            expenses = save_expenses([data for _, data in chunk], bulk_load=True)
+            # `date` is filled in on insert; shares carry a copy of it
+            dates = defaultdict(list)
+            for (index, _), expense in zip(chunk, expenses):
+                if 'date' in items[index]:
+                    dates[items[index]['date']].append(expense.id)
+            for date, ids in dates.items():
+                for start in range(0, len(ids), ID_CHUNK_SIZE):
+                    chunk_ids = ids[start:start + ID_CHUNK_SIZE]
+                    Expenses.objects.filter(id__in=chunk_ids).update(date=date)
+                    ExpenseShare.objects.filter(expense_id__in=chunk_ids).update(date=date)
+        first.append(expenses[0])
+    return first
+
+
+def new_state():
+    return {'offset': 0, 'records': 0, 'expenses': 0, 'shares': 0, 'errors': 0, 'complete': False}
+
+
+# Import progress kept in a JSON file. While a batch commits, the file also holds the
+# state after the batch and the id of its first expense on every shard; if the process
+# dies in between, `load` finds out from the database whether the batch made it.
+class Checkpoint:
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        pending = state.pop('pending', None)
+        if pending and all(
+            on_shard(Expenses.objects.all(), id_shard(expense_id)).filter(id=expense_id, description=description).exists()
+            for expense_id, description in pending['expenses']
+        ):
+            state = pending['state']
+        return state
+
+    def save(self, state, pending=None):
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({**state, 'pending': pending} if pending else state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+
+def import_expenses(path, fmt, state, checkpoint=None, batch_size=1000, workers=0, users=None):
+    # Import the records of `path` from `state['offset']` on, one transaction per batch.
+    # Yields (state, errors) after every batch, `errors` listing the invalid records of
+    # the batch; invalid records are skipped. `state` is updated in place.
+    users = load_user_emails() if users is None else users
+    with open(path, 'rb') as f:
+        records = read_records(f, fmt, state['offset'])
+        for batch in validated_batches(records, fmt, users, batch_size, workers):
+            errors = []
+            items = []
+            start = state['offset']
+            for number, ((data, record_errors), end) in enumerate(batch, state['records'] + 1):
+                if record_errors is None:
+                    items.append(data)
+                else:
+                    errors.append({'record': number, 'offset': start, 'errors': record_errors})
+                start = end
+
+            after = {
+                **state,
+                'offset': batch[-1][1],
+                'records': state['records'] + len(batch),
+                'expenses': state['expenses'] + len(items),
+                'shares': state['shares'] + sum(len(item['shares']) for item in items),
+                'errors': state['errors'] + len(errors),
+            }
+            if items:
+                chunks = import_chunks(items)
+                with atomic_on({alias for alias, _ in chunks}):
+                    expenses = save_items(items, chunks)
+                    if checkpoint is not None:
+                        checkpoint.save(state, pending={
+                            'expenses': [[expense.id, expense.description] for expense in expenses],
+                            'state': after,
+                        })
+            state.update(after)
+            if checkpoint is not None:
+                checkpoint.save(state)
+            yield state, errors
+    state['complete'] = True
+    if checkpoint is not None:
+        checkpoint.save(state)
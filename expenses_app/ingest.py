@@ -0,0 +1,178 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Expenses, ExpenseShare
+from .ledger import apply_expenses
+from .cache import response_cache
+from .changes import record_changes
+from .money import MINOR_UNITS, allocate, to_minor
+from .sharding import atomic_on, expense_shard, use_shard
+
+# 100% in hundredths of a percent, the precision of `ExpenseShare.percentage`
+WHOLE = 100 * MINOR_UNITS
+
+BATCH_MODES = ('all_or_nothing', 'best_effort')
+
+
+def share_error(split_method, share):
+    # The error of a share that does not carry the fields its split method needs, or None
+    if split_method == 'exact' and 'amount' not in share:
+        return {"amount": "This field is required for the exact split method."}
+    elif split_method == 'percentage' and 'percentage' not in share:
+        return {"percentage": "This field is required for the percentage split method."}
+    elif split_method == 'equal' and ('amount' in share or 'percentage' in share):
+        return "For equal split, only the user field is required."
+    return None
+
+
+def split_error(split_method, total_amount, shares):
+    # The error of an expense whose shares do not add up, or None
+    if split_method == 'percentage':
+        total_percentage = sum(share.get('percentage', 0) for share in shares)
+        if total_percentage != 100:
+            return "Total percentage must equal 100%."
+    elif split_method == 'exact':
+        total = sum(share.get('amount', 0) for share in shares)
+        if total != total_amount:
+            return "Total exact amounts must equal the total expense amount."
+    return None
+
+
+def build_shares(expense, shares_data):
+    # Build the (unsaved) share rows of an expense based on its split method.
+    # Amounts are integer minor units split with `allocate`, so the shares always add up
+    # to the total exactly; derived percentages add up to 100.00 the same way.
+    if expense.split_method == 'equal':
+        amounts = allocate(expense.total_amount, [1] * len(shares_data))
+        percentages = allocate(WHOLE, [1] * len(shares_data))
+    elif expense.split_method == 'exact':
+        amounts = [share_data['amount'] for share_data in shares_data]
+        percentages = allocate(WHOLE, amounts)
+    elif expense.split_method == 'percentage':
+        percentages = [to_minor(share_data['percentage']) for share_data in shares_data]
+        amounts = allocate(expense.total_amount, percentages)
+    else:
+        return []
+    return [
+        ExpenseShare(
+            expense=expense, user=share_data['user'], amount=amount,
+            percentage=Decimal(percentage) / MINOR_UNITS,
+            group_id=expense.group_id, date=expense.date,
+        )
+        for share_data, amount, percentage in zip(shares_data, amounts, percentages)
+    ]
+
+
+def save_expenses(validated_items, bulk_load=False):
+    # Insert validated expenses and all of their shares with two bulk inserts and
+    # update the balance ledger. Callers are responsible for wrapping this in a transaction.
+    # Bulk loaders pass `bulk_load=True`: they rebuild the ledger and reset the change feed
+    # once at the end, and as they touch most users the whole response cache is
+    # invalidated instead of per user.
+    expenses = []
+    shares_data = []
+    for data in validated_items:
+        data = dict(data)
+        shares_data.append(data.pop('shares'))
+        expenses.append(Expenses(**data))
+
+    Expenses.objects.bulk_create(expenses)
+    shares = []
+    for expense, expense_shares in zip(expenses, shares_data):
+        shares.extend(build_shares(expense, expense_shares))
+    ExpenseShare.objects.bulk_create(shares)
+    if bulk_load:
+        response_cache.invalidate_global_on_commit()
+        return expenses
+    apply_expenses(expenses, shares)
+    record_changes((share.user_id, share.expense_id) for share in shares)
+    # Only the cached responses of the users involved are invalidated
+    involved = {share.user_id for share in shares}
+    involved.update(expense.paid_by_id for expense in expenses if expense.paid_by_id is not None)
+    response_cache.invalidate_users_on_commit(involved)
+    return expenses
+
+
+def parse_ids(references):
+    # The integer ids among raw references, ignoring anything that is not one
+    ids = set()
+    for reference in references:
+        if isinstance(reference, bool):
+            continue
+        try:
+            ids.add(int(reference))
+        except (TypeError, ValueError):
+            continue
+    return ids
+
+
+def collect_user_ids(items):
+    # Gather every user id referenced by the payers and shares of a raw batch payload
+    references = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        references.append(item.get('paid_by'))
+        shares = item.get('shares')
+        if isinstance(shares, list):
+            references.extend(share.get('user') for share in shares if isinstance(share, dict))
+    return parse_ids(references)
+
+
+def collect_group_ids(items):
+    # Gather every group id referenced by the expenses of a raw batch payload
+    return parse_ids(item.get('group') for item in items if isinstance(item, dict))
+
+
+def shard_chunks(valid, chunk_size):
+    # (shard, chunk) pairs covering the valid (index, data) items: the items of every shard
+    # in chunks of up to `chunk_size`
+    by_shard = defaultdict(list)
+    for index, data in valid:
+        by_shard[expense_shard(data)].append((index, data))
+    for alias, items in by_shard.items():
+        for start in range(0, len(items), chunk_size):
+            yield alias, items[start:start + chunk_size]
+
+
+def write_batch(validated, mode='all_or_nothing', chunk_size=None):
+    # Insert a validated batch given as (validated_data, errors) pairs in chunks, each on
+    # the shard of its expenses. Returns one result dict per item, in input order.
+    chunk_size = chunk_size or getattr(settings, 'EXPENSES_BATCH_CHUNK_SIZE', 500)
+    results = [
+        {"index": index, "status": "error", "errors": errors} if errors is not None else None
+        for index, (_, errors) in enumerate(validated)
+    ]
+    valid = [(index, data) for index, (data, errors) in enumerate(validated) if errors is None]
+
+    if mode == 'all_or_nothing':
+        if len(valid) != len(validated):
+            # Nothing is written when any item is invalid
+            for index, _ in valid:
+                results[index] = {"index": index, "status": "skipped"}
+            return results
+        chunks = list(shard_chunks(valid, chunk_size))
+        # One transaction per shard involved, committed together at the end
+        with atomic_on({alias for alias, _ in chunks}):
+            for alias, chunk in chunks:
+                with use_shard(alias):
+                    expenses = save_expenses([data for _, data in chunk])
+                for (index, _), expense in zip(chunk, expenses):
+                    results[index] = {"index": index, "status": "created", "id": expense.id}
+        return results
+
+    # Best effort: every chunk commits on its own, a failing chunk only fails its own items
+    for alias, chunk in shard_chunks(valid, chunk_size):
+        try:
+            with use_shard(alias), transaction.atomic(using=alias):
+                expenses = save_expenses([data for _, data in chunk])
+        except Exception as e:
+            for index, _ in chunk:
+                results[index] = {"index": index, "status": "error", "errors": str(e)}
+            continue
+        for (index, _), expense in zip(chunk, expenses):
+            results[index] = {"index": index, "status": "created", "id": expense.id}
+    return results
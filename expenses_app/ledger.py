@@ -0,0 +1,307 @@
+from collections import defaultdict
+
+from django.db import connections, transaction
+from django.db.models import BigIntegerField, Case, F, IntegerField, Min, Sum, Count, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import (
+    Expenses, ExpenseShare, ArchivedExpense, ArchivedExpenseShare, UserBalance, DailyUserTotal, DailySplitMethodTotal,
+    PeriodClose, BalanceSnapshot,
+)
+from .routers import active_shard
+from .sharding import gather
+
+# Upper bound on the number of users updated by a single UPDATE statement
+UPDATE_CHUNK_SIZE = 400
+
+# Ledger columns and the output field used for their increments; amounts are in
+# integer minor units
+LEDGER_FIELDS = {
+    'total_owed': BigIntegerField(),
+    'expense_count': IntegerField(),
+    'total_paid': BigIntegerField(),
+    'net_balance': BigIntegerField(),
+}
+
+# Per-day rollups read by the period summaries: (model, key column, the live and the
+# archive table they add up, amount column of those)
+DAILY_TOTALS = [
+    (DailyUserTotal, 'user_id', ExpenseShare, ArchivedExpenseShare, 'amount'),
+    (DailySplitMethodTotal, 'split_method', Expenses, ArchivedExpense, 'total_amount'),
+]
+
+
+def empty_balance():
+    return {
+        'total_owed': 0,
+        'expense_count': 0,
+        'total_paid': 0,
+        'net_balance': 0,
+    }
+
+
+def apply_expenses(expenses, shares):
+    # Add newly created expenses and their shares to the balances of the users involved.
+    # Must run inside the transaction that inserts them.
+    #
+    # `net_balance` only counts expenses with a payer: the payer is credited with what
+    # the other participants owe and every participant is debited with their share.
+    payers = {expense.id: expense.paid_by_id for expense in expenses}
+    deltas = defaultdict(empty_balance)
+    participants = defaultdict(set)
+    for expense in expenses:
+        if expense.paid_by_id is not None:
+            deltas[expense.paid_by_id]['total_paid'] += expense.total_amount
+    for share in shares:
+        amount = share.amount or 0
+        deltas[share.user_id]['total_owed'] += amount
+        participants[share.user_id].add(share.expense_id)
+        payer_id = payers.get(share.expense_id)
+        if payer_id is not None:
+            deltas[share.user_id]['net_balance'] -= amount
+            deltas[payer_id]['net_balance'] += amount
+    for user_id, expense_ids in participants.items():
+        deltas[user_id]['expense_count'] = len(expense_ids)
+    if deltas:
+        increment_balances(deltas)
+    apply_daily_totals(expenses, shares)
+
+
+def increment_balances(deltas):
+    # Add `deltas` ({user_id: {field: delta}}) to the ledger with one UPDATE per chunk of users
+    UserBalance.objects.bulk_create(
+        [UserBalance(user_id=user_id) for user_id in deltas],
+        ignore_conflicts=True,
+    )
+    now = timezone.now()
+    user_ids = list(deltas)
+    for start in range(0, len(user_ids), UPDATE_CHUNK_SIZE):
+        chunk = user_ids[start:start + UPDATE_CHUNK_SIZE]
+        updates = {
+            field: F(field) + Case(
+                *[When(user_id=user_id, then=Value(deltas[user_id][field])) for user_id in chunk],
+                output_field=output_field,
+            )
+            for field, output_field in LEDGER_FIELDS.items()
+        }
+        UserBalance.objects.filter(user_id__in=chunk).update(
+            **updates, version=F('version') + 1, updated_at=now,
+        )
+
+
+def apply_daily_totals(expenses, shares):
+    # Add newly created expenses and their shares to the per-day rollups
+    owed = defaultdict(lambda: [0, 0])
+    for share in shares:
+        row = owed[share.date, share.user_id]
+        row[0] += share.amount or 0
+        row[1] += 1
+    methods = defaultdict(lambda: [0, 0])
+    for expense in expenses:
+        row = methods[expense.date, expense.split_method]
+        row[0] += expense.total_amount
+        row[1] += 1
+    increment_daily_totals(DailyUserTotal, 'user_id', owed)
+    increment_daily_totals(DailySplitMethodTotal, 'split_method', methods)
+
+
+def increment_daily_totals(model, key, deltas, archived=False):
+    # Add `deltas` ({(date, key): (total, count)}) to the rows of a rollup with one upsert
+    # per chunk of rows: missing rows are inserted with the deltas, the others added to.
+    # SQLite and PostgreSQL share the ON CONFLICT syntax.
+    connection = connections[active_shard()]
+    quote = connection.ops.quote_name
+    table, column = quote(model._meta.db_table), quote(model._meta.get_field(key).column)
+    keys = list(deltas)
+    with connection.cursor() as cursor:
+        for start in range(0, len(keys), UPDATE_CHUNK_SIZE):
+            chunk = keys[start:start + UPDATE_CHUNK_SIZE]
+            cursor.execute(
+                f'INSERT INTO {table} ("date", {column}, "archived", "total", "count") '
+                f'VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(chunk))} '
+                f'ON CONFLICT ("date", {column}, "archived") DO UPDATE SET '
+                f'"total" = {table}."total" + excluded."total", "count" = {table}."count" + excluded."count"',
+                [
+                    param
+                    for date, value in chunk
+                    for param in (connection.ops.adapt_datefield_value(date), value, archived, *deltas[date, value])
+                ],
+            )
+
+
+def refresh_daily_totals(dates):
+    # Recompute the rollup rows of `dates` from the live and archive tables, after writes
+    # that bypassed `apply_expenses` (admin, shell, cascades)
+    dates = set(dates) - {None}
+    if dates:
+        for model, *_ in DAILY_TOTALS:
+            model.objects.filter(date__in=dates).delete()
+        write_daily_totals(date__in=dates)
+
+
+def rebuild_daily_totals():
+    # Recompute every rollup row from the live and archive tables
+    for model, *_ in DAILY_TOTALS:
+        model.objects.all().delete()
+    write_daily_totals()
+
+
+def write_daily_totals(**filters):
+    # Insert the rollup rows of the live and archive table rows matching `filters`, with
+    # one INSERT ... SELECT per table
+    connection = connections[active_shard()]
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for model, key, live, archive, amount in DAILY_TOTALS:
+            table, column = quote(model._meta.db_table), quote(model._meta.get_field(key).column)
+            for archived, source in ((False, live), (True, archive)):
+                totals = (
+                    source.objects.filter(**filters).values_list('date', key)
+                    .annotate(total=Coalesce(Sum(amount), 0), count=Count('*')).order_by()
+                )
+                sql, params = totals.query.get_compiler(using=connection.alias).as_sql()
+                cursor.execute(
+                    f'INSERT INTO {table} ("archived", "date", {column}, "total", "count") '
+                    f'SELECT %s, rollup.* FROM ({sql}) rollup',
+                    [archived, *params],
+                )
+
+
+def archive_daily_totals(cutoff):
+    # Move the rollup rows of the live expenses dated up to `cutoff` to the archived ones
+    # as their period is closed. Only a live day that already has archived rows (one
+    # edited back into a closed period) needs adding up.
+    for model, key, *_ in DAILY_TOTALS:
+        live = model.objects.filter(archived=False, date__lte=cutoff)
+        earliest = live.aggregate(earliest=Min('date'))['earliest']
+        if earliest is None:
+            continue
+        archived = set(model.objects.filter(archived=True, date__gte=earliest).values_list('date', key))
+        if archived:
+            latest = max(date for date, _ in archived)
+            merged, deltas = [], {}
+            for row_id, date, value, total, count in (
+                live.filter(date__lte=latest).values_list('id', 'date', key, 'total', 'count')
+            ):
+                if (date, value) in archived:
+                    merged.append(row_id)
+                    deltas[date, value] = (total, count)
+            increment_daily_totals(model, key, deltas, archived=True)
+            for start in range(0, len(merged), UPDATE_CHUNK_SIZE):
+                model.objects.filter(id__in=merged[start:start + UPDATE_CHUNK_SIZE]).delete()
+        live.update(archived=True)
+
+
+def user_balance(user_id):
+    # The ledger row of a user, None without any. With several expense shards, an unsaved
+    # row adding theirs up.
+    rows = [row for row in gather(lambda alias: UserBalance.objects.filter(user_id=user_id).first()) if row is not None]
+    if len(rows) < 2:
+        return rows[0] if rows else None
+    balance = UserBalance(
+        user_id=user_id,
+        version=sum(row.version for row in rows),
+        updated_at=max((row.updated_at for row in rows if row.updated_at is not None), default=None),
+    )
+    for field in LEDGER_FIELDS:
+        setattr(balance, field, sum(getattr(row, field) for row in rows))
+    return balance
+
+
+def touch_users(user_ids):
+    # Record a change for users whose expenses were modified without going through
+    # the ledger (admin, shell), so their ETag / Last-Modified move on. Users without a
+    # ledger row have never been given an ETag and are left alone.
+    UserBalance.objects.filter(user_id__in=set(user_ids)).update(version=F('version') + 1, updated_at=timezone.now())
+
+
+def aggregate_balances(expenses, shares):
+    # Ledger totals of every user over `expenses` and `shares` (querysets of the live or
+    # of the archive tables)
+    balances = defaultdict(empty_balance)
+
+    owed = (
+        shares.values('user')
+        .annotate(total_owed=Sum('amount'), expense_count=Count('expense', distinct=True))
+        .order_by()
+    )
+    for row in owed:
+        balances[row['user']]['total_owed'] = row['total_owed'] or 0
+        balances[row['user']]['expense_count'] = row['expense_count']
+
+    paid = (
+        expenses.filter(paid_by__isnull=False)
+        .values('paid_by').annotate(total=Sum('total_amount')).order_by()
+    )
+    for row in paid:
+        balances[row['paid_by']]['total_paid'] = row['total'] or 0
+
+    paid_shares = shares.filter(expense__paid_by__isnull=False)
+    credits = paid_shares.values('expense__paid_by').annotate(total=Sum('amount')).order_by()
+    for row in credits:
+        balances[row['expense__paid_by']]['net_balance'] += row['total'] or 0
+    debits = paid_shares.values('user').annotate(total=Sum('amount')).order_by()
+    for row in debits:
+        balances[row['user']]['net_balance'] -= row['total'] or 0
+    return balances
+
+
+def latest_period():
+    # The most recently closed period, or None
+    return PeriodClose.objects.order_by('-cutoff').first()
+
+
+def snapshot_balances(period):
+    # {user_id: ledger fields} of the balance snapshot of a closed period
+    rows = BalanceSnapshot.objects.filter(period=period).values('user_id', *LEDGER_FIELDS)
+    return {row.pop('user_id'): row for row in rows.iterator(chunk_size=2000)}
+
+
+def add_balances(balances, other):
+    # Add the ledger totals of `other` into `balances`, both {user_id: fields}
+    for user_id, fields in other.items():
+        balance = balances[user_id]
+        for field in LEDGER_FIELDS:
+            balance[field] += fields[field]
+    return balances
+
+
+def compute_balances():
+    # Recompute every user's ledger row: the snapshot of the last closed period plus the
+    # expenses and shares still in the live tables
+    balances = defaultdict(empty_balance)
+    period = latest_period()
+    if period is not None:
+        add_balances(balances, snapshot_balances(period))
+    add_balances(balances, aggregate_balances(Expenses.objects.all(), ExpenseShare.objects.all()))
+    return dict(balances)
+
+
+def replace_balances(balances, versions):
+    # Rewrite the whole ledger with `balances` ({user_id: fields}), keeping a row for every
+    # user in `versions` ({user_id: version}). Versions keep moving forward so clients
+    # never see an old ETag again.
+    now = timezone.now()
+    UserBalance.objects.all().delete()
+    UserBalance.objects.bulk_create(
+        [
+            UserBalance(
+                user_id=user_id,
+                version=versions.get(user_id, 0) + 1,
+                updated_at=now,
+                **balances.get(user_id, empty_balance()),
+            )
+            for user_id in set(balances) | set(versions)
+        ],
+        batch_size=1000,
+    )
+
+
+def rebuild_ledger():
+    # Recompute the whole ledger and the per-day rollups after a bulk load that skipped
+    # `apply_expenses`
+    with transaction.atomic(using=active_shard()):
+        versions = dict(UserBalance.objects.values_list('user_id', 'version'))
+        replace_balances(compute_balances(), versions)
+        rebuild_daily_totals()
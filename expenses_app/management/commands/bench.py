@@ -0,0 +1,338 @@
+import datetime
+import json
+import platform
+import random
+import tempfile
+import time
+
+import django
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from expenses_app import urls
+from expenses_app.cache import response_cache
+from expenses_app.exports import start_export
+from expenses_app.models import User, Group, ExpenseShare
+from expenses_app.seeding import DEFAULT_MIX, flush_dataset, seed_dataset
+
+
+def user_kwargs(name):
+    def kwargs(context, index):
+        return {name: context['user_ids'][index % len(context['user_ids'])]}
+    return kwargs
+
+
+def create_user_payload(context, index):
+    return {
+        'email': f'bench-user-{context["run"]}-{index}@example.com',
+        'name': f'Bench User {index}',
+        'mobile_number': f'8{index:09d}',
+    }
+
+
+def bulk_users_payload(context, index):
+    return {'users': [
+        {
+            'email': f'bench-bulk-user-{context["run"]}-{index}-{item}@example.com',
+            'name': f'Bench Bulk User {item}',
+            'mobile_number': f'7{index * 100 + item:09d}',
+        }
+        for item in range(100)
+    ]}
+
+
+def expense_payload(context, index):
+    users = context['user_ids']
+    members = [users[(index + offset) % len(users)] for offset in range(3)]
+    return {
+        'description': f'Bench expense {index}',
+        'total_amount': '90.00',
+        'split_method': 'equal',
+        'paid_by': members[0],
+        'shares': [{'user': user} for user in dict.fromkeys(members)],
+    }
+
+
+def search_params(context, index):
+    # A word of every seeded description and one that picks a single expense
+    return {'q': f'expense {index + 1}'}
+
+
+def group_kwargs(context, index):
+    return {'pk': context['group_ids'][index % len(context['group_ids'])]}
+
+
+def group_payload(context, index):
+    users = context['user_ids']
+    return {
+        'name': f'Bench group {context["run"]} {index}',
+        'members': list(dict.fromkeys(users[(index + offset) % len(users)] for offset in range(3))),
+    }
+
+
+def member_payload(context, index):
+    users = context['user_ids']
+    return {'user': users[index % len(users)]}
+
+
+def export_kwargs(context, index):
+    # The export routes read one finished export of the whole dataset
+    if 'export_id' not in context:
+        context['export_id'] = start_export({'format': 'csv'})[0].id
+    return {'pk': context['export_id']}
+
+
+def export_payload(context, index):
+    users = context['user_ids']
+    return {'format': 'csv', 'user': users[index % len(users)]}
+
+
+def batch_payload(context, index):
+    return {
+        'mode': 'all_or_nothing',
+        'expenses': [expense_payload(context, index * 50 + item) for item in range(50)],
+    }
+
+
+# Seeded datasets split their users into groups of about this many members
+GROUP_SIZE = 10
+
+
+# How to call every route of expenses_app.urls: (method, URL kwargs, JSON payload or
+# query parameters).
+# Reads come first so the writes do not change the dataset they measure.
+ROUTES = {
+    'user-detail': ('get', user_kwargs('pk'), None),
+    'user-balance': ('get', user_kwargs('pk'), None),
+    'user-expenses': ('get', user_kwargs('user_id'), None),
+    'user-changes': ('get', user_kwargs('user_id'), None),
+    'overall-expenses': ('get', None, None),
+    'expense-search': ('get', None, search_params),
+    'download-balance-sheet': ('get', None, None),
+    'settlements': ('get', None, None),
+    'report-user-totals': ('get', None, None),
+    'report-pairwise-debts': ('get', None, None),
+    'report-split-methods': ('get', None, None),
+    'report-summary': ('get', None, None),
+    'cache-stats': ('get', None, None),
+    'metrics': ('get', None, None),
+    'export-detail': ('get', export_kwargs, None),
+    'export-download': ('get', export_kwargs, None),
+    'group-detail': ('get', group_kwargs, None),
+    'group-expenses': ('get', group_kwargs, None),
+    'group-balances': ('get', group_kwargs, None),
+    'group-balance-sheet': ('get', group_kwargs, None),
+    'create-user': ('post', None, create_user_payload),
+    'bulk-upsert-users': ('post', None, bulk_users_payload),
+    'create-expense': ('post', None, expense_payload),
+    'create-expense-batch': ('post', None, batch_payload),
+    'create-export': ('post', None, export_payload),
+    'create-group': ('post', None, group_payload),
+    'group-members': ('post', group_kwargs, member_payload),
+}
+
+
+def parse_sizes(text):
+    # "100x1000,1000x10000" -> [(100, 1000), (1000, 10000)]
+    sizes = []
+    for part in text.split(','):
+        users, _, expenses = part.strip().partition('x')
+        try:
+            users, expenses = int(users), int(expenses)
+        except ValueError:
+            raise CommandError(f"Invalid dataset size '{part}', expected USERSxEXPENSES.")
+        if users < 1 or expenses < 0:
+            raise CommandError(f"Invalid dataset size '{part}', at least one user is needed.")
+        sizes.append((users, expenses))
+    return sizes
+
+
+def measure(client, method, url, payload, warm):
+    if not warm:
+        # Bumping the global version makes every cached response unreachable
+        response_cache.bump_global()
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        if method == 'get':
+            response = client.get(url, payload)
+        else:
+            response = client.post(url, payload, content_type='application/json')
+        # Streaming responses are only produced while they are consumed
+        if response.streaming:
+            b''.join(response.streaming_content)
+        elapsed = time.perf_counter() - start
+    return elapsed, len(queries), response.status_code
+
+
+def summarize(timings, queries, statuses):
+    timings = np.array(timings) * 1000
+    return {
+        'requests': len(timings),
+        'mean_ms': round(float(timings.mean()), 3),
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p90_ms': round(float(np.percentile(timings, 90)), 3),
+        'p99_ms': round(float(np.percentile(timings, 99)), 3),
+        'throughput_rps': round(len(timings) / (timings.sum() / 1000), 1) if timings.sum() else None,
+        'queries': max(queries),
+        'status': sorted(set(statuses)),
+    }
+
+
+def find_regressions(results, baseline, threshold, min_delta_ms):
+    # Routes whose median latency grew by more than `threshold` (and `min_delta_ms`),
+    # or that run more queries than in the baseline
+    regressions = []
+    for size, size_results in results['sizes'].items():
+        baseline_routes = baseline.get('sizes', {}).get(size, {}).get('routes', {})
+        for name, current in size_results['routes'].items():
+            previous = baseline_routes.get(name)
+            if previous is None:
+                continue
+            limit = previous['p50_ms'] * (1 + threshold)
+            if current['p50_ms'] > limit and current['p50_ms'] - previous['p50_ms'] > min_delta_ms:
+                regressions.append(
+                    f"{size} {name}: p50 {current['p50_ms']:.2f} ms vs baseline {previous['p50_ms']:.2f} ms"
+                )
+            if current['queries'] > previous['queries']:
+                regressions.append(
+                    f"{size} {name}: {current['queries']} queries vs baseline {previous['queries']}"
+                )
+    return regressions
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure latency percentiles, throughput and query counts of every API route on "
+        "seeded datasets of several sizes, and compare them against a stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='100x1000,1000x10000',
+            help="Comma separated dataset sizes as USERSxEXPENSES (default 100x1000,1000x10000).",
+        )
+        parser.add_argument('--requests', type=int, default=20, help="Requests per route and size (default 20).")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed of the datasets (default 0).")
+        parser.add_argument('--routes', help="Comma separated route names to measure (default all).")
+        parser.add_argument('--warm', action='store_true', help="Let repeated requests hit the response cache.")
+        parser.add_argument('--output', default='bench-results.json', help="Where to write the results (default bench-results.json).")
+        parser.add_argument('--baseline', help="Results file to compare against; regressions fail the command.")
+        parser.add_argument('--threshold', type=float, default=0.25, help="Allowed p50 slowdown against the baseline (default 0.25).")
+        parser.add_argument('--min-delta-ms', type=float, default=1.0, help="Ignore p50 slowdowns below this many ms (default 1.0).")
+        parser.add_argument(
+            '--in-place', action='store_true',
+            help="Run against the configured database instead of a throwaway test database. Deletes all expense data.",
+        )
+
+    def handle(self, *args, **options):
+        sizes = parse_sizes(options['sizes'])
+        names = [pattern.name for pattern in urls.urlpatterns]
+        missing = [name for name in names if name not in ROUTES]
+        if missing:
+            raise CommandError(f"No benchmark defined for routes: {', '.join(missing)}")
+        if options['routes']:
+            selected = options['routes'].split(',')
+            unknown = [name for name in selected if name not in ROUTES]
+            if unknown:
+                raise CommandError(f"Unknown routes: {', '.join(unknown)}")
+            names = [name for name in ROUTES if name in selected]
+        else:
+            names = list(ROUTES)
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        old_name = None
+        if not options['in_place']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            setup_test_environment()
+            environment_set_up = True
+        except RuntimeError:
+            # Already set up, e.g. when running under the test runner
+            environment_set_up = False
+        try:
+            # Exports are written in the request, to a scratch directory
+            with tempfile.TemporaryDirectory() as directory:
+                with override_settings(EXPENSES_EXPORT_WORKERS=0, EXPENSES_EXPORT_DIR=directory):
+                    results = self.run(sizes, names, options)
+        finally:
+            if environment_set_up:
+                teardown_test_environment()
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is not None:
+            regressions = find_regressions(results, baseline, options['threshold'], options['min_delta_ms'])
+            if regressions:
+                for regression in regressions:
+                    self.stdout.write(self.style.ERROR(regression))
+                raise CommandError(f"{len(regressions)} regressions against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['baseline']}"))
+
+    def run(self, sizes, names, options):
+        results = {
+            'meta': {
+                'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'seed': options['seed'],
+                'requests': options['requests'],
+                'warm': options['warm'],
+            },
+            'sizes': {},
+        }
+        client = Client()
+        for users, expenses in sizes:
+            size = f'{users}x{expenses}'
+            start = time.perf_counter()
+            with transaction.atomic():
+                flush_dataset()
+            _, _, shares = seed_dataset(
+                users, expenses, mix=DEFAULT_MIX, seed=options['seed'], groups=max(users // GROUP_SIZE, 1),
+            )
+            seconds = time.perf_counter() - start
+            self.stdout.write(f"Dataset {size}: {shares} shares, seeded in {seconds:.1f}s")
+
+            # Users with shares, in a fixed random order, are cycled through by the per-user routes
+            user_ids = sorted(ExpenseShare.objects.values_list('user_id', flat=True).distinct())
+            user_ids = user_ids or list(User.objects.values_list('id', flat=True))
+            random.Random(options['seed']).shuffle(user_ids)
+            group_ids = list(Group.objects.values_list('id', flat=True))
+            random.Random(options['seed']).shuffle(group_ids)
+            context = {'user_ids': user_ids, 'group_ids': group_ids, 'run': size}
+
+            routes = {}
+            for name in names:
+                method, kwargs, payload = ROUTES[name]
+                timings, queries, statuses = [], [], []
+                for index in range(options['requests']):
+                    url = reverse(name, kwargs=kwargs(context, index) if kwargs else None)
+                    body = payload(context, index) if payload else None
+                    elapsed, count, status_code = measure(client, method, url, body, options['warm'])
+                    timings.append(elapsed)
+                    queries.append(count)
+                    statuses.append(status_code)
+                routes[name] = summarize(timings, queries, statuses)
+                if any(code >= 500 for code in statuses):
+                    raise CommandError(f"{name} failed with {routes[name]['status']} on {size}")
+                self.stdout.write(
+                    f"  {name:>24}: p50 {routes[name]['p50_ms']:9.2f} ms  p99 {routes[name]['p99_ms']:9.2f} ms  "
+                    f"{routes[name]['throughput_rps'] or 0:8.1f} req/s  {routes[name]['queries']} queries"
+                )
+            results['sizes'][size] = {
+                'users': users, 'expenses': expenses, 'shares': shares,
+                'seed_seconds': round(seconds, 2), 'routes': routes,
+            }
+        return results
@@ -0,0 +1,79 @@
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from expenses_app.models import Expenses, ExpenseShare
+from expenses_app.money import format_minor
+from expenses_app.reports import ExpenseArrays
+
+
+def orm_loop_reports():
+    # Reference implementation: the same reports computed by iterating model instances
+    owed = defaultdict(int)
+    paid = defaultdict(int)
+    net = defaultdict(int)
+    share_counts = defaultdict(int)
+    pairs = defaultdict(int)
+    split_totals = defaultdict(int)
+    for expense in Expenses.objects.all().iterator(chunk_size=2000):
+        split_totals[expense.split_method] += expense.total_amount
+        if expense.paid_by_id is not None:
+            paid[expense.paid_by_id] += expense.total_amount
+    for share in ExpenseShare.objects.select_related('expense').iterator(chunk_size=2000):
+        amount = share.amount or 0
+        owed[share.user_id] += amount
+        share_counts[share.user_id] += 1
+        payer_id = share.expense.paid_by_id
+        if payer_id is not None:
+            net[payer_id] += amount
+            net[share.user_id] -= amount
+            if payer_id != share.user_id:
+                pairs[share.user_id, payer_id] += amount
+
+    user_totals = [
+        {
+            "user": user_id,
+            "total_owed": format_minor(owed[user_id]),
+            "total_paid": format_minor(paid[user_id]),
+            "net_balance": format_minor(net[user_id]),
+            "share_count": share_counts[user_id],
+        }
+        for user_id in sorted(set(owed) | set(paid))
+    ]
+    debts = [
+        {"from_user": debtor, "to_user": creditor, "amount": format_minor(amount - pairs.get((creditor, debtor), 0))}
+        for (debtor, creditor), amount in pairs.items()
+        if amount > pairs.get((creditor, debtor), 0)
+    ]
+    return user_totals, debts, dict(split_totals)
+
+
+def vectorized_reports():
+    arrays = ExpenseArrays.load()
+    return arrays.user_totals(), arrays.pairwise_debts(), arrays.split_method_breakdown()
+
+
+class Command(BaseCommand):
+    help = "Compare the vectorized report engine against an ORM loop on the current database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per implementation; the best run is reported.")
+
+    def handle(self, *args, **options):
+        shares = ExpenseShare.objects.count()
+        expenses = Expenses.objects.count()
+        self.stdout.write(f"Dataset: {expenses} expenses, {shares} shares")
+
+        timings = {}
+        for name, report in (('orm loop', orm_loop_reports), ('vectorized', vectorized_reports)):
+            runs = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                report()
+                runs.append(time.perf_counter() - start)
+            timings[name] = min(runs)
+            self.stdout.write(f"{name:>10}: {timings[name] * 1000:.1f} ms")
+
+        speedup = timings['orm loop'] / timings['vectorized'] if timings['vectorized'] else float('inf')
+        self.stdout.write(self.style.SUCCESS(f"Speedup: {speedup:.1f}x"))
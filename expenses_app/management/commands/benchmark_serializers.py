@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from expenses_app.fast_serializers import expense_rows, serialize_expenses
+from expenses_app.models import Expenses
+from expenses_app.renderers import FastJSONRenderer, orjson
+from expenses_app.serializers import ExpenseSerializer
+
+
+def model_serializer_response(limit):
+    # Reference implementation: ExpenseSerializer over prefetched instances, stdlib JSON
+    expenses = Expenses.objects.prefetch_related('shares').order_by('date', 'id')[:limit]
+    return JSONRenderer().render(ExpenseSerializer(expenses, many=True).data)
+
+
+def fast_response(limit):
+    rows = expense_rows().order_by('date', 'id')[:limit]
+    return FastJSONRenderer().render(serialize_expenses(rows))
+
+
+class Command(BaseCommand):
+    help = "Compare the fast listing serializers against ExpenseSerializer on the current database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10000, help="Expenses per response (default 10000).")
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per implementation; the best run is reported.")
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+        count = min(limit, Expenses.objects.count())
+        self.stdout.write(f"Response: {count} expenses, renderer: {'orjson' if orjson else 'stdlib json'}")
+
+        timings = {}
+        outputs = {}
+        for name, response in (('model serializer', model_serializer_response), ('fast path', fast_response)):
+            runs = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                outputs[name] = response(limit)
+                runs.append(time.perf_counter() - start)
+            timings[name] = min(runs)
+            rate = count / timings[name] if timings[name] else float('inf')
+            self.stdout.write(f"{name:>16}: {timings[name] * 1000:.1f} ms, {rate:.0f} expenses/s")
+
+        if outputs['model serializer'] != outputs['fast path']:
+            raise CommandError("The fast path rendered different bytes than ExpenseSerializer.")
+        speedup = timings['model serializer'] / timings['fast path'] if timings['fast path'] else float('inf')
+        self.stdout.write(self.style.SUCCESS(f"Identical output ({len(outputs['fast path'])} bytes), speedup: {speedup:.1f}x"))
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from expenses_app.database import SQLITE_PRAGMAS, sqlite_options
+from expenses_app.models import User
+from expenses_app.seeding import seed_dataset
+
+# SQLite setups compared: Django's stock one (rollback journal, synchronous=FULL, deferred
+# transactions, a new connection per request) and the one of expenses_app.database
+PROFILES = {
+    'default': {'OPTIONS': {}, 'CONN_MAX_AGE': 0, 'pragmas': {}},
+    'tuned': {'OPTIONS': sqlite_options(), 'CONN_MAX_AGE': 60, 'pragmas': SQLITE_PRAGMAS},
+}
+
+
+def expense_payload(rng, user_ids):
+    members = rng.sample(user_ids, 3)
+    return {
+        'description': 'Benchmark expense', 'total_amount': '30.00', 'split_method': 'equal',
+        'paid_by': members[0], 'shares': [{'user': user_id} for user_id in members],
+    }
+
+
+def client_loop(kind, user_ids, deadline, seed, samples):
+    # Write expenses or read user listings until `deadline`, recording
+    # (kind, status, seconds, database locked) per request
+    client = Client()
+    rng = random.Random(seed)
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if kind == 'write':
+                response = client.post(reverse('create-expense'), expense_payload(rng, user_ids), content_type='application/json')
+            else:
+                user_id = rng.choice(user_ids)
+                response = client.get(reverse('user-expenses', kwargs={'user_id': user_id}), {'page_size': 20})
+            elapsed = time.perf_counter() - start
+            samples.append((kind, response.status_code, elapsed, b'database is locked' in response.content))
+    finally:
+        # Every thread has its own connection to the scratch database
+        connection.close()
+
+
+def summarize(samples, kind, seconds):
+    rows = [sample for sample in samples if sample[0] == kind]
+    ok = [elapsed * 1000 for _, status, elapsed, _ in rows if status < 400]
+    return {
+        'requests': len(rows),
+        'per_second': round(len(ok) / seconds, 1),
+        'errors': len(rows) - len(ok),
+        'locked': sum(1 for *_, locked in rows if locked),
+        'p50_ms': round(float(np.percentile(ok, 50)), 2) if ok else None,
+        'p99_ms': round(float(np.percentile(ok, 99)), 2) if ok else None,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure expense writes per second under concurrent writers and readers with "
+        "Django's stock SQLite setup and with the tuned one (WAL, pragmas, immediate transactions)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help="Threads posting expenses (default 8).")
+        parser.add_argument('--readers', type=int, default=4, help="Threads reading user listings (default 4).")
+        parser.add_argument('--seconds', type=float, default=5, help="Duration of every run (default 5).")
+        parser.add_argument('--users', type=int, default=200, help="Users of the scratch dataset (default 200).")
+        parser.add_argument('--expenses', type=int, default=2000, help="Expenses of the scratch dataset (default 2000).")
+        parser.add_argument('--profiles', default=','.join(PROFILES), help="Comma separated setups to compare (default default,tuned).")
+        parser.add_argument('--output', help="Also write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("benchmark_writes compares SQLite setups; the default database is not SQLite.")
+        profiles = options['profiles'].split(',')
+        unknown = [profile for profile in profiles if profile not in PROFILES]
+        if unknown:
+            raise CommandError(f"Unknown profiles: {', '.join(unknown)}")
+        if options['writers'] < 1 or options['readers'] < 0 or options['users'] < 3:
+            raise CommandError("At least one writer and three users are needed.")
+
+        try:
+            setup_test_environment()
+            environment_set_up = True
+        except RuntimeError:
+            # Already set up, e.g. when running under the test runner
+            environment_set_up = False
+        # Requests waiting for the write lock cross the slow request limit, and failed
+        # writes are counted rather than logged one by one
+        loggers = [logging.getLogger(name) for name in ('expenses_app.middleware', 'django.request')]
+        levels = [logger.level for logger in loggers]
+        for logger in loggers:
+            logger.setLevel(logging.CRITICAL)
+        try:
+            results = {profile: self.run(profile, options) for profile in profiles}
+        finally:
+            for logger, level in zip(loggers, levels):
+                logger.setLevel(level)
+            if environment_set_up:
+                teardown_test_environment()
+
+        for profile, result in results.items():
+            writes, reads = result['writes'], result['reads']
+            self.stdout.write(
+                f"{profile:>8}: {writes['per_second']:8.1f} writes/s  p50 {writes['p50_ms'] or 0:7.2f} ms  "
+                f"p99 {writes['p99_ms'] or 0:8.2f} ms  {writes['errors']} failed ({writes['locked']} locked)  "
+                f"{reads['per_second']:8.1f} reads/s"
+            )
+        if 'default' in results and 'tuned' in results and results['default']['writes']['per_second']:
+            ratio = results['tuned']['writes']['per_second'] / results['default']['writes']['per_second']
+            self.stdout.write(self.style.SUCCESS(f"tuned: {ratio:.1f}x the writes per second of default"))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def run(self, profile, options):
+        # One run on a scratch database file. The settings of the default database are
+        # switched while it lasts; only the worker threads open connections with them, so
+        # the connection of the calling thread is left alone.
+        setup = PROFILES[profile]
+        settings_dict = connections.settings['default']
+        saved = {key: settings_dict[key] for key in ('NAME', 'OPTIONS', 'CONN_MAX_AGE')}
+        with tempfile.TemporaryDirectory() as directory, ThreadPoolExecutor(max_workers=options['writers'] + options['readers']) as pool:
+            settings_dict.update(
+                NAME=os.path.join(directory, 'benchmark.sqlite3'),
+                OPTIONS=setup['OPTIONS'], CONN_MAX_AGE=setup['CONN_MAX_AGE'],
+            )
+            try:
+                with override_settings(EXPENSES_SQLITE_PRAGMAS=setup['pragmas']):
+                    user_ids = pool.submit(self.prepare, options).result()
+                    samples = []
+                    deadline = time.perf_counter() + options['seconds']
+                    kinds = ['write'] * options['writers'] + ['read'] * options['readers']
+                    futures = [
+                        pool.submit(client_loop, kind, user_ids, deadline, index, samples)
+                        for index, kind in enumerate(kinds)
+                    ]
+                    for future in futures:
+                        future.result()
+            finally:
+                settings_dict.update(saved)
+        return {
+            'writes': summarize(samples, 'write', options['seconds']),
+            'reads': summarize(samples, 'read', options['seconds']),
+        }
+
+    def prepare(self, options):
+        try:
+            call_command('migrate', verbosity=0)
+            seed_dataset(options['users'], options['expenses'])
+            return list(User.objects.values_list('id', flat=True))
+        finally:
+            connection.close()
@@ -0,0 +1,41 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app.archive import close_period
+from expenses_app.routers import expense_shards
+from expenses_app.sharding import is_sharded, use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Close the period ending on a date: snapshot every user's balances and move the "
+        "expenses dated up to it, with their shares, to the archive tables. Every expense "
+        "shard closes the period in turn."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('cutoff', help="Last day of the period to close, as YYYY-MM-DD.")
+
+    def handle(self, *args, **options):
+        try:
+            cutoff = datetime.date.fromisoformat(options['cutoff'])
+        except ValueError:
+            raise CommandError("The cutoff must be a date like 2024-06-30.")
+
+        for alias in expense_shards():
+            # Named only when there are several shards
+            shard = f"[{alias}] " if is_sharded() else ""
+            start = time.perf_counter()
+            try:
+                with use_shard(alias):
+                    period = close_period(cutoff)
+                    snapshots = period.snapshots.count()
+            except ValueError as e:
+                raise CommandError(shard + str(e))
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(
+                f"{shard}Closed the period ending on {period.cutoff}: archived {period.expense_count} expenses "
+                f"and {period.share_count} shares, snapshot of {snapshots} balances in {elapsed:.1f}s"
+            ))
@@ -0,0 +1,36 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from expenses_app.changes import compact_changes
+from expenses_app.routers import expense_shards
+from expenses_app.sharding import use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Compact the change feed: drop entries superseded by a later change to the same "
+        "expense and entries older than the retention period. Clients holding tokens older "
+        "than the dropped entries download their listings again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help="Keep this many days of entries (default EXPENSES_CHANGES_RETENTION_DAYS).",
+        )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = getattr(settings, 'EXPENSES_CHANGES_RETENTION_DAYS', 30)
+        if days < 0:
+            raise CommandError("--days must not be negative.")
+        before = timezone.now() - datetime.timedelta(days=days)
+        removed = 0
+        for alias in expense_shards():
+            with use_shard(alias):
+                removed += compact_changes(before)
+        self.stdout.write(self.style.SUCCESS(f"Dropped {removed} change feed entries, kept {days} days"))
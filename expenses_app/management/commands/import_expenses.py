@@ -0,0 +1,110 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app.changes import reset_changes
+from expenses_app.importing import FORMATS, Checkpoint, detect_format, import_expenses, load_user_emails, new_state
+from expenses_app.ledger import rebuild_ledger
+from expenses_app.routers import expense_shards
+from expenses_app.sharding import use_shard
+
+
+class Command(BaseCommand):
+    help = (
+        "Import expense history from a CSV or JSONL file with bulk inserts, one transaction "
+        "per batch. Users are referenced by email and must exist. Progress is checkpointed, "
+        "so an interrupted import continues where it stopped with --resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or JSONL file to import.")
+        parser.add_argument('--format', choices=FORMATS, help="File format (default: from the file extension).")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Expenses per transaction (default 1000).")
+        parser.add_argument('--workers', type=int, default=0, help="Processes parsing and validating records (default 0, parse in this process).")
+        parser.add_argument('--checkpoint', help="Checkpoint file (default: PATH.checkpoint).")
+        parser.add_argument('--resume', action='store_true', help="Continue from the checkpoint file.")
+        parser.add_argument('--errors', help="Write the invalid records and their errors to this JSONL file.")
+        parser.add_argument('--skip-ledger', action='store_true', help="Do not rebuild the balance ledger at the end (run rebuild_balances later).")
+        parser.add_argument('--progress', type=float, default=5.0, help="Seconds between progress reports (default 5).")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError(f"No such file: {path}")
+        if options['batch_size'] < 1 or options['workers'] < 0:
+            raise CommandError("--batch-size must be at least 1 and --workers not negative.")
+        try:
+            fmt = options['format'] or detect_format(path)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        checkpoint = Checkpoint(options['checkpoint'] or f'{path}.checkpoint')
+        state = checkpoint.load()
+        if state is not None and not options['resume']:
+            raise CommandError(
+                f"{checkpoint.path} exists from an earlier import of this file. "
+                "Pass --resume to continue it or delete the checkpoint to start over."
+            )
+        if state is None:
+            state = new_state()
+        elif state['complete']:
+            self.stdout.write(f"{path} was already imported completely ({state['expenses']} expenses).")
+            return
+        elif state['offset']:
+            self.stdout.write(f"Resuming at byte {state['offset']} after {state['records']} records.")
+
+        size = os.path.getsize(path)
+        errors_file = open(options['errors'], 'a' if options['resume'] else 'w') if options['errors'] else None
+        start = time.perf_counter()
+        first_records = state['records']
+        reported = start
+        try:
+            users = load_user_emails()
+            self.stdout.write(f"Loaded {len(users)} user emails in {time.perf_counter() - start:.1f}s")
+            for state, errors in import_expenses(
+                path, fmt, state, checkpoint=checkpoint,
+                batch_size=options['batch_size'], workers=options['workers'], users=users,
+            ):
+                if errors_file is not None:
+                    for error in errors:
+                        errors_file.write(json.dumps(error) + '\n')
+                now = time.perf_counter()
+                if now - reported >= options['progress']:
+                    reported = now
+                    self.report(state, size, (state['records'] - first_records) / (now - start))
+        except (ValueError, UnicodeDecodeError) as e:
+            raise CommandError(f"Cannot read {path}: {e}")
+        finally:
+            if errors_file is not None:
+                errors_file.close()
+
+        elapsed = time.perf_counter() - start
+        self.report(state, size, (state['records'] - first_records) / elapsed if elapsed else 0)
+        # Imported expenses have no change feed entries: clients syncing their listings
+        # download them again
+        for alias in expense_shards():
+            with use_shard(alias):
+                reset_changes()
+        if not options['skip_ledger']:
+            ledger_start = time.perf_counter()
+            for alias in expense_shards():
+                with use_shard(alias):
+                    rebuild_ledger()
+            self.stdout.write(f"Rebuilt the balance ledger in {time.perf_counter() - ledger_start:.1f}s")
+        summary = (
+            f"Imported {state['expenses']} expenses and {state['shares']} shares "
+            f"from {state['records']} records in {time.perf_counter() - start:.1f}s"
+        )
+        if state['errors']:
+            self.stdout.write(self.style.WARNING(f"{summary}; {state['errors']} invalid records skipped"))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
+
+    def report(self, state, size, rate):
+        done = 100 * state['offset'] / size if size else 100
+        self.stdout.write(
+            f"{done:5.1f}%  {state['records']} records, {state['expenses']} expenses, "
+            f"{state['shares']} shares, {state['errors']} errors, {rate:.0f} records/s"
+        )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from expenses_app.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the expired idempotency keys of the expense creation endpoints. Retries "
+        "made with them afterwards create their expenses again."
+    )
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_keys()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired idempotency keys"))
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from expenses_app.ledger import LEDGER_FIELDS, compute_balances, empty_balance, rebuild_daily_totals, replace_balances
+from expenses_app.models import UserBalance
+from expenses_app.routers import expense_shards
+from expenses_app.sharding import is_sharded, use_shard
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-user balance ledger (and the per-day report totals) from the expenses and shares and report drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report drift, do not rewrite the ledger.")
+        parser.add_argument('--show', type=int, default=20, help="Number of drifted users to list (default 20).")
+
+    def handle(self, *args, **options):
+        # Every expense shard keeps the ledger of its own expenses
+        recomputed, drifted = 0, []
+        for alias in expense_shards():
+            with use_shard(alias):
+                expected, shard_drifted = self.rebuild(alias, options['dry_run'])
+            recomputed += len(expected)
+            # Named only when there are several shards
+            shard = f"[{alias}] " if is_sharded() else ""
+            drifted.extend((f"{shard}user {user_id}", changes) for user_id, changes in shard_drifted)
+
+        for user, changes in drifted[:options['show']]:
+            details = ", ".join(
+                f"{field} stored={stored_value} expected={expected_value}"
+                for field, (stored_value, expected_value) in changes.items()
+            )
+            self.stdout.write(f"{user}: {details}")
+        if len(drifted) > options['show']:
+            self.stdout.write(f"... and {len(drifted) - options['show']} more")
+
+        summary = f"{recomputed} balances recomputed, {len(drifted)} drifted"
+        if options['dry_run']:
+            self.stdout.write(summary + " (dry run, ledger unchanged)")
+        elif drifted:
+            self.stdout.write(self.style.WARNING(summary + ", ledger rewritten"))
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
+
+    def rebuild(self, alias, dry_run):
+        # (recomputed balances, drifted users with their changes) of the shard being written to
+        with transaction.atomic(using=alias):
+            expected = compute_balances()
+            stored = {
+                row['user_id']: row
+                for row in UserBalance.objects.values('user_id', 'version', *LEDGER_FIELDS).iterator(chunk_size=2000)
+            }
+
+            # A user drifted when any stored column differs from the recomputed one
+            drifted = []
+            for user_id in sorted(set(expected) | set(stored)):
+                stored_row = stored.get(user_id, empty_balance())
+                expected_row = expected.get(user_id, empty_balance())
+                changes = {
+                    field: (stored_row[field], expected_row[field])
+                    for field in LEDGER_FIELDS
+                    if stored_row[field] != expected_row[field]
+                }
+                if changes:
+                    drifted.append((user_id, changes))
+
+            if not dry_run:
+                replace_balances(expected, {user_id: row['version'] for user_id, row in stored.items()})
+                rebuild_daily_totals()
+        return expected, drifted
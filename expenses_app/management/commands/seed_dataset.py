@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from expenses_app.seeding import DEFAULT_END_DATE, flush_dataset, parse_mix, parse_range, seed_dataset
+
+
+class Command(BaseCommand):
+    help = "Fill the database with a deterministic synthetic dataset of users, expenses and shares."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000, help="Number of users (default 1000).")
+        parser.add_argument('--expenses', type=int, default=10000, help="Number of expenses (default 10000).")
+        parser.add_argument(
+            '--mix', default='equal=5,percentage=3,exact=2',
+            help="Relative weight of each split method (default equal=5,percentage=3,exact=2).",
+        )
+        parser.add_argument('--group-size', default='2-5', help="Participants per expense, as MIN-MAX (default 2-5).")
+        parser.add_argument('--groups', type=int, default=0, help="Split the users into this many expense groups (default 0, no groups).")
+        parser.add_argument('--payer-ratio', type=float, default=0.8, help="Share of expenses with a payer (default 0.8).")
+        parser.add_argument('--days', type=int, default=365, help="Spread expense dates over this many days (default 365).")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed (default 0).")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Expenses per bulk insert (default 2000).")
+        parser.add_argument('--flush', action='store_true', help="Delete all users, expenses and balances first.")
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+            group_size = parse_range(options['group_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['users'] < 0 or options['expenses'] < 0 or options['groups'] < 0 or options['days'] < 1 or options['chunk_size'] < 1:
+            raise CommandError("Counts must not be negative; --days and --chunk-size must be at least 1.")
+        if not 0 <= options['payer_ratio'] <= 1:
+            raise CommandError("--payer-ratio must be between 0 and 1.")
+
+        start = time.perf_counter()
+        if options['flush']:
+            with transaction.atomic():
+                flush_dataset()
+        users, expenses, shares = seed_dataset(
+            options['users'], options['expenses'],
+            mix=mix, group_size=group_size, payer_ratio=options['payer_ratio'],
+            days=options['days'], end_date=DEFAULT_END_DATE, seed=options['seed'],
+            chunk_size=options['chunk_size'], groups=options['groups'],
+        )
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {users} users, {expenses} expenses and {shares} shares in {elapsed:.1f}s"
+        ))
@@ -0,0 +1,111 @@
+import threading
+from collections import defaultdict, deque
+
+import numpy as np
+from django.conf import settings
+
+# Upper bounds (in seconds) of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+# In-memory request metrics per route, exported in the Prometheus text format.
+# Histograms and counters are cumulative since the process started; the quantiles are
+# computed over a rolling window of the most recent requests of each route.
+class RouteMetrics:
+
+    def __init__(self, window):
+        self.count = 0
+        self.duration_sum = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.statuses = defaultdict(int)
+        self.recent = deque(maxlen=window)
+
+    def observe(self, duration, queries, db_seconds, render_seconds, status):
+        self.count += 1
+        self.duration_sum += duration
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if duration <= bound:
+                self.buckets[index] += 1
+        self.queries += queries
+        self.db_seconds += db_seconds
+        self.render_seconds += render_seconds
+        self.statuses[status] += 1
+        self.recent.append(duration)
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    @property
+    def window(self):
+        return getattr(settings, 'EXPENSES_METRICS_WINDOW', 1000)
+
+    def observe(self, route, method, duration, queries, db_seconds, render_seconds, status):
+        with self.lock:
+            metrics = self.routes.get((route, method))
+            if metrics is None:
+                metrics = self.routes[route, method] = RouteMetrics(self.window)
+            metrics.observe(duration, queries, db_seconds, render_seconds, status)
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def render(self):
+        # Prometheus text exposition format (version 0.0.4)
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines = [
+                '# HELP expenses_request_duration_seconds Time spent handling requests.',
+                '# TYPE expenses_request_duration_seconds histogram',
+            ]
+            for (route, method), metrics in routes:
+                labels = f'route="{route}",method="{method}"'
+                for bound, count in zip(DURATION_BUCKETS, metrics.buckets):
+                    lines.append(f'expenses_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'expenses_request_duration_seconds_bucket{{{labels},le="+Inf"}} {metrics.count}')
+                lines.append(f'expenses_request_duration_seconds_sum{{{labels}}} {metrics.duration_sum:.6f}')
+                lines.append(f'expenses_request_duration_seconds_count{{{labels}}} {metrics.count}')
+
+            lines += [
+                '# HELP expenses_request_latency_seconds Request latency quantiles over the most recent requests.',
+                '# TYPE expenses_request_latency_seconds summary',
+            ]
+            for (route, method), metrics in routes:
+                labels = f'route="{route}",method="{method}"'
+                values = np.percentile(np.array(metrics.recent), [quantile * 100 for quantile in QUANTILES])
+                for quantile, value in zip(QUANTILES, values):
+                    lines.append(f'expenses_request_latency_seconds{{{labels},quantile="{quantile}"}} {value:.6f}')
+                lines.append(f'expenses_request_latency_seconds_sum{{{labels}}} {sum(metrics.recent):.6f}')
+                lines.append(f'expenses_request_latency_seconds_count{{{labels}}} {len(metrics.recent)}')
+
+            counters = (
+                ('expenses_db_queries_total', 'SQL queries run while handling requests.', 'queries', '{}'),
+                ('expenses_db_seconds_total', 'Time spent in SQL queries.', 'db_seconds', '{:.6f}'),
+                ('expenses_render_seconds_total', 'Time spent rendering response bodies.', 'render_seconds', '{:.6f}'),
+            )
+            for name, description, attribute, value_format in counters:
+                lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+                for (route, method), metrics in routes:
+                    value = value_format.format(getattr(metrics, attribute))
+                    lines.append(f'{name}{{route="{route}",method="{method}"}} {value}')
+
+            lines += [
+                '# HELP expenses_responses_total Responses by status code.',
+                '# TYPE expenses_responses_total counter',
+            ]
+            for (route, method), metrics in routes:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append(f'expenses_responses_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics_registry = MetricsRegistry()
@@ -0,0 +1,203 @@
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+
+from .metrics import metrics_registry
+from .routers import (
+    STICKY_COOKIE, Routing, current_routing, read_replicas, routed_stream, sticky_seconds,
+)
+
+logger = logging.getLogger(__name__)
+
+# Recorder of the request being handled. Context variables follow the request into the
+# threads that read the expense shards (see sharding.py), which thread-local state would not.
+current_recorder = ContextVar('expenses_query_recorder', default=None)
+
+
+# Records every SQL statement run while it is the current recorder
+class QueryRecorder:
+
+    def __init__(self):
+        self.statements = []
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds += elapsed
+            self.statements.append((sql, elapsed))
+
+
+def record_queries(execute, sql, params, many, context):
+    # Execute wrapper installed on every database connection (see signals.py)
+    recorder = current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection):
+    if record_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_queries)
+
+
+# Per-request instrumentation: query count, database time, render time and total time.
+# The numbers are sent back in a Server-Timing header, added to the per-route metrics
+# served at /api/_metrics/, and requests over the query or latency limits are logged
+# together with the SQL they ran. The body of a streaming response is read after the
+# view returns: its chunks are read with the recorder of the request, and the request is
+# recorded once the response is closed. Its Server-Timing header leaves out that part,
+# having been sent before the body.
+class RequestMetricsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        request._metrics_render = [None, None]
+        token = current_recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        return self.finish(request, response, recorder, start)
+
+    def finish(self, request, response, recorder, start):
+        render = self.render_seconds(request)
+        response['Server-Timing'] = ', '.join([
+            f'db;desc="{len(recorder.statements)} queries";dur={recorder.seconds * 1000:.2f}',
+            f'render;dur={render * 1000:.2f}',
+            f'total;dur={(time.perf_counter() - start) * 1000:.2f}',
+        ])
+        if response.streaming:
+            response.streaming_content = measured_stream(self, request, response, recorder, start)
+        else:
+            self.record(request, response, recorder, time.perf_counter() - start)
+        return response
+
+    def render_seconds(self, request):
+        render_start, render_end = request._metrics_render
+        return render_end - render_start if render_start is not None and render_end is not None else 0.0
+
+    def record(self, request, response, recorder, total):
+        queries = len(recorder.statements)
+        render = self.render_seconds(request)
+        match = request.resolver_match
+        route = match.url_name if match is not None and match.url_name else 'unmatched'
+        metrics_registry.observe(route, request.method, total, queries, recorder.seconds, render, response.status_code)
+
+        max_queries = getattr(settings, 'EXPENSES_MAX_QUERIES_PER_REQUEST', 50)
+        slow_ms = getattr(settings, 'EXPENSES_SLOW_REQUEST_MS', 1000)
+        if queries > max_queries or total * 1000 > slow_ms:
+            self.log_slow_request(request, route, response, total, recorder)
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after the last template response hook
+        request._metrics_render[0] = time.perf_counter()
+        response.add_post_render_callback(lambda rendered: self.rendered(request))
+        return response
+
+    def rendered(self, request):
+        request._metrics_render[1] = time.perf_counter()
+
+    def log_slow_request(self, request, route, response, total, recorder):
+        # Identical statements are grouped so N+1 patterns stand out
+        counts = Counter(sql for sql, _ in recorder.statements)
+        durations = Counter()
+        for sql, elapsed in recorder.statements:
+            durations[sql] += elapsed
+        details = '\n'.join(
+            f'  {count}x {durations[sql] * 1000:.2f} ms: {sql}'
+            for sql, count in counts.most_common(10)
+        )
+        if len(counts) > 10:
+            details += f'\n  ... and {len(counts) - 10} more distinct statements'
+        logger.warning(
+            'Slow request %s %s (%s): %d status, %.1f ms, %d queries, %.1f ms in the database\n%s',
+            request.method, request.get_full_path(), route, response.status_code, total * 1000,
+            len(recorder.statements), recorder.seconds * 1000, details,
+        )
+
+
+# Streaming content read with the query recorder of its request. The request is recorded
+# when the response is closed, after the last chunk or once the client went away.
+class MeasuredContent:
+
+    def __init__(self, content, middleware, request, response, recorder, start):
+        self.content = content
+        self.middleware = middleware
+        self.request = request
+        self.response = response
+        self.recorder = recorder
+        self.start = start
+        self.recorded = False
+
+    def close(self):
+        if not self.recorded:
+            self.recorded = True
+            self.middleware.record(self.request, self.response, self.recorder, time.perf_counter() - self.start)
+
+
+class MeasuredStream(MeasuredContent):
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = current_recorder.set(self.recorder)
+        try:
+            return next(self.content)
+        finally:
+            current_recorder.reset(token)
+
+
+def measured_stream(middleware, request, response, recorder, start):
+    return MeasuredStream(iter(response.streaming_content), middleware, request, response, recorder, start)
+
+
+# Lets safe requests to the expenses_app views read from the read replicas (see
+# routers.py). Clients whose request wrote something get a cookie that keeps them on the
+# primary for EXPENSES_REPLICA_STICKY_SECONDS, longer than the replicas are expected to lag.
+class ReplicaRoutingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routing = Routing()
+        token = current_routing.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.finish(request, response, routing)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        routing = current_routing.get()
+        if routing is not None and read_replicas():
+            routing.allowed = (
+                request.method in ('GET', 'HEAD', 'OPTIONS')
+                and view_func.__module__.startswith('expenses_app.')
+                and STICKY_COOKIE not in request.COOKIES
+            )
+
+    def finish(self, request, response, routing):
+        if not read_replicas():
+            return response
+        wrote = routing.wrote or request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400
+        if wrote:
+            response.set_cookie(STICKY_COOKIE, '1', max_age=sticky_seconds(), httponly=True, samesite='Lax')
+        if response.streaming and routing.allowed:
+            # Streamed rows are read after this returns
+            response.streaming_content = routed_stream(response, routing)
+        else:
+            routing.release()
+        return response
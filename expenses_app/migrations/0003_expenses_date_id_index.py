@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0002_alter_expenseshare_amount'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='expenseshare',
+            name='expense',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shares', to='expenses_app.expenses'),
+        ),
+        migrations.AddIndex(
+            model_name='expenses',
+            index=models.Index(fields=['date', 'id'], name='expenses_date_id_idx'),
+        ),
+    ]
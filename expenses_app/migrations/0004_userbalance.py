@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_balances(apps, schema_editor):
+    # Seed the ledger from the shares that already exist
+    ExpenseShare = apps.get_model('expenses_app', 'ExpenseShare')
+    UserBalance = apps.get_model('expenses_app', 'UserBalance')
+    alias = schema_editor.connection.alias
+    totals = (
+        ExpenseShare.objects.using(alias).values('user')
+        .annotate(total_owed=Sum('amount'), expense_count=Count('expense', distinct=True))
+        .order_by()
+    )
+    UserBalance.objects.using(alias).bulk_create(
+        [
+            UserBalance(user_id=row['user'], total_owed=row['total_owed'] or 0, expense_count=row['expense_count'])
+            for row in totals
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0003_expenses_date_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBalance',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to='expenses_app.user')),
+                ('total_owed', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('expense_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_balances, migrations.RunPython.noop),
+    ]
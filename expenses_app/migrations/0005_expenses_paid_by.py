@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0004_userbalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expenses',
+            name='paid_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='paid_expenses', to='expenses_app.user'),
+        ),
+        migrations.AddField(
+            model_name='userbalance',
+            name='net_balance',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='userbalance',
+            name='total_paid',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0005_expenses_paid_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userbalance',
+            name='updated_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userbalance',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
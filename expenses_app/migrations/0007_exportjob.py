@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0006_userbalance_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('format', models.CharField(choices=[('csv', 'CSV'), ('csv.gz', 'Gzip-compressed CSV'), ('jsonl', 'JSON Lines')], default='csv', max_length=10)),
+                ('date_from', models.DateField(blank=True, null=True)),
+                ('date_to', models.DateField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('expired', 'Expired')], default='pending', max_length=10)),
+                ('rows_written', models.PositiveBigIntegerField(default=0)),
+                ('rows_total', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('file_name', models.CharField(blank=True, max_length=255)),
+                ('size', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='export_jobs', to='expenses_app.user')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', ('pending', 'running', 'done'))), fields=('key',), name='exportjob_active_key')],
+            },
+        ),
+    ]
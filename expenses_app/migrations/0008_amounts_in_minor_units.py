@@ -0,0 +1,89 @@
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import BigIntegerField, F
+from django.db.models.functions import Cast, Round
+
+# Decimal amount columns become integer minor units (cents / paise). Every column is
+# copied into a new integer column that then takes its place; the old columns are made
+# nullable first so the migration can be reversed on a populated database.
+
+# {model: {field: (decimal field, integer field)}}
+AMOUNT_FIELDS = {
+    'expenses': {
+        'total_amount': (
+            models.DecimalField(max_digits=10, decimal_places=2),
+            models.BigIntegerField(help_text='In minor units (cents).'),
+        ),
+    },
+    'expenseshare': {
+        'amount': (
+            models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True),
+            models.BigIntegerField(null=True, blank=True, help_text='In minor units (cents).'),
+        ),
+    },
+    'userbalance': {
+        field: (models.DecimalField(max_digits=14, decimal_places=2, default=0), models.BigIntegerField(default=0))
+        for field in ('total_owed', 'total_paid', 'net_balance')
+    },
+}
+
+
+def to_minor_units(apps, schema_editor):
+    for model_name, fields in AMOUNT_FIELDS.items():
+        model = apps.get_model('expenses_app', model_name)
+        model.objects.using(schema_editor.connection.alias).update(**{
+            f'{field}_minor': Cast(Round(F(field) * 100), output_field=BigIntegerField())
+            for field in fields
+        })
+
+
+def to_decimal(apps, schema_editor):
+    for model_name, fields in AMOUNT_FIELDS.items():
+        model = apps.get_model('expenses_app', model_name)
+        manager = model.objects.db_manager(schema_editor.connection.alias)
+        rows = list(manager.only('pk', *[f'{field}_minor' for field in fields]))
+        for row in rows:
+            for field in fields:
+                value = getattr(row, f'{field}_minor')
+                setattr(row, field, None if value is None else Decimal(value) / 100)
+        manager.bulk_update(rows, list(fields), batch_size=1000)
+
+
+def operations(make_operation):
+    return [
+        make_operation(model_name, field, decimal_field, integer_field)
+        for model_name, fields in AMOUNT_FIELDS.items()
+        for field, (decimal_field, integer_field) in fields.items()
+    ]
+
+
+def nullable(field):
+    _, _, args, kwargs = field.deconstruct()
+    return type(field)(*args, **{**kwargs, 'null': True})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0007_exportjob'),
+    ]
+
+    operations = [
+        *operations(lambda model_name, field, decimal_field, integer_field: migrations.AlterField(
+            model_name=model_name, name=field, field=nullable(decimal_field),
+        )),
+        *operations(lambda model_name, field, decimal_field, integer_field: migrations.AddField(
+            model_name=model_name, name=f'{field}_minor', field=nullable(integer_field),
+        )),
+        migrations.RunPython(to_minor_units, to_decimal),
+        *operations(lambda model_name, field, decimal_field, integer_field: migrations.RemoveField(
+            model_name=model_name, name=field,
+        )),
+        *operations(lambda model_name, field, decimal_field, integer_field: migrations.RenameField(
+            model_name=model_name, old_name=f'{field}_minor', new_name=field,
+        )),
+        *operations(lambda model_name, field, decimal_field, integer_field: migrations.AlterField(
+            model_name=model_name, name=field, field=integer_field,
+        )),
+    ]
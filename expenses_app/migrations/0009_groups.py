@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0008_amounts_in_minor_units'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Group',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GroupMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joined_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='expenses',
+            name='group',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='expenses', to='expenses_app.group'),
+        ),
+        migrations.AddField(
+            model_name='expenseshare',
+            name='group',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='expenses_app.group'),
+        ),
+        migrations.AddIndex(
+            model_name='expenses',
+            index=models.Index(fields=['group', 'date', 'id'], name='expenses_group_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expenseshare',
+            index=models.Index(fields=['group', 'user'], name='expenseshare_group_user_idx'),
+        ),
+        migrations.AddField(
+            model_name='groupmembership',
+            name='group',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='expenses_app.group'),
+        ),
+        migrations.AddField(
+            model_name='groupmembership',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_memberships', to='expenses_app.user'),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='members',
+            field=models.ManyToManyField(related_name='expense_groups', through='expenses_app.GroupMembership', to='expenses_app.user'),
+        ),
+        migrations.AddConstraint(
+            model_name='groupmembership',
+            constraint=models.UniqueConstraint(fields=('group', 'user'), name='groupmembership_group_user_unique'),
+        ),
+    ]
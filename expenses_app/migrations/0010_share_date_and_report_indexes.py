@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_expense_dates(apps, schema_editor):
+    Expenses = apps.get_model('expenses_app', 'Expenses')
+    ExpenseShare = apps.get_model('expenses_app', 'ExpenseShare')
+    ExpenseShare.objects.using(schema_editor.connection.alias).update(date=Subquery(Expenses.objects.filter(pk=OuterRef('expense_id')).values('date')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0009_groups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expenseshare',
+            name='date',
+            field=models.DateField(null=True),
+        ),
+        migrations.RunPython(copy_expense_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='expenseshare',
+            name='date',
+            field=models.DateField(),
+        ),
+        migrations.AlterField(
+            model_name='expenseshare',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='expenses_app.user'),
+        ),
+        migrations.AddIndex(
+            model_name='expenses',
+            index=models.Index(fields=['date', 'split_method', 'total_amount'], name='expenses_date_split_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expenseshare',
+            index=models.Index(fields=['user', 'date', 'id'], name='expenseshare_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expenseshare',
+            index=models.Index(fields=['date', 'user', 'amount'], name='expenseshare_date_user_idx'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0010_share_date_and_report_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeriodClose',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cutoff', models.DateField(unique=True)),
+                ('closed_at', models.DateTimeField(auto_now_add=True)),
+                ('expense_count', models.PositiveBigIntegerField(default=0)),
+                ('share_count', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedExpense',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('description', models.CharField(max_length=255)),
+                ('total_amount', models.BigIntegerField(help_text='In minor units (cents).')),
+                ('split_method', models.CharField(choices=[('equal', 'Equal'), ('percentage', 'Percentage'), ('exact', 'Exact')], max_length=10)),
+                ('date', models.DateField()),
+                ('group', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='archived_expenses', to='expenses_app.group')),
+                ('paid_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='expenses_app.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedExpenseShare',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('amount', models.BigIntegerField(blank=True, help_text='In minor units (cents).', null=True)),
+                ('percentage', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('date', models.DateField()),
+                ('expense', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shares', to='expenses_app.archivedexpense')),
+                ('group', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='expenses_app.group')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='expenses_app.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_owed', models.BigIntegerField(default=0)),
+                ('expense_count', models.PositiveIntegerField(default=0)),
+                ('total_paid', models.BigIntegerField(default=0)),
+                ('net_balance', models.BigIntegerField(default=0)),
+                ('share_count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='expenses_app.user')),
+                ('period', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='expenses_app.periodclose')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedexpense',
+            index=models.Index(fields=['date', 'id'], name='archivedexpense_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedexpense',
+            index=models.Index(fields=['group', 'date', 'id'], name='archivedexpense_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedexpenseshare',
+            index=models.Index(fields=['group', 'user'], name='archivedshare_group_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedexpenseshare',
+            index=models.Index(fields=['user', 'date', 'id'], name='archivedshare_user_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='balancesnapshot',
+            constraint=models.UniqueConstraint(fields=('period', 'user'), name='balancesnapshot_period_user_unique'),
+        ),
+    ]
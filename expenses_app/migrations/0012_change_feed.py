@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:28
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0011_period_close'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeCompaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('through', models.BigIntegerField()),
+                ('compacted_at', models.DateTimeField(auto_now_add=True)),
+                ('removed', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ExpenseChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField()),
+                ('expense_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_id', 'id'], name='expensechange_user_id_idx'), models.Index(fields=['user_id', 'expense_id', 'id'], name='expensechange_expense_idx')],
+            },
+        ),
+    ]
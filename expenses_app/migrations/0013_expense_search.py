@@ -0,0 +1,139 @@
+from django.db import migrations
+
+# Full-text index of the expense descriptions, live and archived (see expenses_app/search.py).
+#
+# SQLite: an FTS5 table keyed by expense id with the words of the description and the ids of
+# the users sharing the expense, so that searches filtered by user are an intersection of
+# index entries. Triggers keep it in sync, so that bulk inserts, queryset updates and the
+# plain DELETEs of the period close and the seeding flush, which send no signals, update it
+# too. Archiving copies an expense and its shares to the archive tables under the same ids
+# before deleting them: the index row is left alone as long as either copy exists.
+#
+# PostgreSQL: GIN indexes over the tsvector of the descriptions, maintained by the database.
+
+# Space-separated user ids of the shares of an expense, in one of the two share tables
+SQLITE_USERS = "coalesce((SELECT group_concat(user_id, ' ') FROM {table} WHERE expense_id = {expense}), '')"
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE expenses_app_expensesearch USING fts5(
+        description, users, tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER expenses_app_expenses_search_insert AFTER INSERT ON expenses_app_expenses BEGIN
+        INSERT INTO expenses_app_expensesearch (rowid, description, users) VALUES (new.id, new.description, '');
+    END
+    """,
+    """
+    CREATE TRIGGER expenses_app_expenses_search_update AFTER UPDATE OF description ON expenses_app_expenses
+    WHEN old.description IS NOT new.description BEGIN
+        UPDATE expenses_app_expensesearch SET description = new.description WHERE rowid = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER expenses_app_expenses_search_delete AFTER DELETE ON expenses_app_expenses
+    WHEN NOT EXISTS (SELECT 1 FROM expenses_app_archivedexpense WHERE id = old.id) BEGIN
+        DELETE FROM expenses_app_expensesearch WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER expenses_app_archivedexpense_search_insert AFTER INSERT ON expenses_app_archivedexpense
+    WHEN NOT EXISTS (SELECT 1 FROM expenses_app_expenses WHERE id = new.id) BEGIN
+        INSERT INTO expenses_app_expensesearch (rowid, description, users) VALUES (new.id, new.description, '');
+    END
+    """,
+    """
+    CREATE TRIGGER expenses_app_archivedexpense_search_delete AFTER DELETE ON expenses_app_archivedexpense
+    WHEN NOT EXISTS (SELECT 1 FROM expenses_app_expenses WHERE id = old.id) BEGIN
+        DELETE FROM expenses_app_expensesearch WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER expenses_app_expenseshare_search_insert AFTER INSERT ON expenses_app_expenseshare
+    WHEN NOT EXISTS (SELECT 1 FROM expenses_app_archivedexpenseshare WHERE id = new.id) BEGIN
+        UPDATE expenses_app_expensesearch SET users = users || ' ' || new.user_id WHERE rowid = new.expense_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER expenses_app_expenseshare_search_update AFTER UPDATE OF user_id, expense_id ON expenses_app_expenseshare
+    WHEN old.user_id IS NOT new.user_id OR old.expense_id IS NOT new.expense_id BEGIN
+        UPDATE expenses_app_expensesearch
+            SET users = {SQLITE_USERS.format(table='expenses_app_expenseshare', expense='old.expense_id')}
+            WHERE rowid = old.expense_id;
+        UPDATE expenses_app_expensesearch
+            SET users = {SQLITE_USERS.format(table='expenses_app_expenseshare', expense='new.expense_id')}
+            WHERE rowid = new.expense_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER expenses_app_expenseshare_search_delete AFTER DELETE ON expenses_app_expenseshare
+    WHEN NOT EXISTS (SELECT 1 FROM expenses_app_archivedexpenseshare WHERE id = old.id) BEGIN
+        UPDATE expenses_app_expensesearch
+            SET users = {SQLITE_USERS.format(table='expenses_app_expenseshare', expense='old.expense_id')}
+            WHERE rowid = old.expense_id;
+    END
+    """,
+    """
+    CREATE TRIGGER expenses_app_archivedexpenseshare_search_insert AFTER INSERT ON expenses_app_archivedexpenseshare
+    WHEN NOT EXISTS (SELECT 1 FROM expenses_app_expenseshare WHERE id = new.id) BEGIN
+        UPDATE expenses_app_expensesearch SET users = users || ' ' || new.user_id WHERE rowid = new.expense_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER expenses_app_archivedexpenseshare_search_delete AFTER DELETE ON expenses_app_archivedexpenseshare
+    WHEN NOT EXISTS (SELECT 1 FROM expenses_app_expenseshare WHERE id = old.id) BEGIN
+        UPDATE expenses_app_expensesearch
+            SET users = {SQLITE_USERS.format(table='expenses_app_archivedexpenseshare', expense='old.expense_id')}
+            WHERE rowid = old.expense_id;
+    END
+    """,
+    f"""
+    INSERT INTO expenses_app_expensesearch (rowid, description, users)
+        SELECT id, description, {SQLITE_USERS.format(table='expenses_app_expenseshare', expense='e.id')}
+            FROM expenses_app_expenses e
+        UNION ALL
+        SELECT id, description, {SQLITE_USERS.format(table='expenses_app_archivedexpenseshare', expense='e.id')}
+            FROM expenses_app_archivedexpense e WHERE id NOT IN (SELECT id FROM expenses_app_expenses)
+    """,
+]
+
+SQLITE_BACKWARD = [
+    f'DROP TRIGGER IF EXISTS {table}_search_{event}'
+    for table in (
+        'expenses_app_expenses', 'expenses_app_archivedexpense',
+        'expenses_app_expenseshare', 'expenses_app_archivedexpenseshare',
+    )
+    for event in ('insert', 'update', 'delete')
+] + ['DROP TABLE IF EXISTS expenses_app_expensesearch']
+
+POSTGRESQL_FORWARD = [
+    "CREATE INDEX expenses_search_idx ON expenses_app_expenses USING GIN (to_tsvector('simple', description))",
+    "CREATE INDEX archivedexpense_search_idx ON expenses_app_archivedexpense USING GIN (to_tsvector('simple', description))",
+]
+
+POSTGRESQL_BACKWARD = [
+    'DROP INDEX IF EXISTS expenses_search_idx',
+    'DROP INDEX IF EXISTS archivedexpense_search_idx',
+]
+
+
+def run_statements(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0012_change_feed'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_statements({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run_statements({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRESQL_BACKWARD}),
+        ),
+    ]
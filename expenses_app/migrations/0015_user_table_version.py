@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0014_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTableVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
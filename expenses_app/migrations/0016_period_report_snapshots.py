@@ -0,0 +1,80 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, Sum
+
+
+def snapshot_latest_period(apps, schema_editor):
+    # Every archived expense belongs to a period up to the latest one, so the archive
+    # tables add up to the snapshots of the latest period; earlier ones are never read
+    alias = schema_editor.connection.alias
+    PeriodClose = apps.get_model('expenses_app', 'PeriodClose')
+    ArchivedExpense = apps.get_model('expenses_app', 'ArchivedExpense')
+    ArchivedExpenseShare = apps.get_model('expenses_app', 'ArchivedExpenseShare')
+    DebtSnapshot = apps.get_model('expenses_app', 'DebtSnapshot')
+    SplitMethodSnapshot = apps.get_model('expenses_app', 'SplitMethodSnapshot')
+    period = PeriodClose.objects.using(alias).order_by('-cutoff').first()
+    if period is None:
+        return
+    shares = ArchivedExpenseShare.objects.using(alias)
+    debts = (
+        shares.filter(expense__paid_by__isnull=False).exclude(user=F('expense__paid_by'))
+        .values_list('user', 'expense__paid_by').annotate(total=Sum('amount')).order_by('user', 'expense__paid_by')
+    )
+    DebtSnapshot.objects.using(alias).bulk_create(
+        [
+            DebtSnapshot(period=period, debtor_id=debtor, creditor_id=creditor, amount=total or 0)
+            for debtor, creditor, total in debts
+        ],
+        batch_size=1000,
+    )
+    share_counts = dict(shares.values_list('expense__split_method').annotate(count=Count('id')).order_by())
+    methods = ArchivedExpense.objects.using(alias).values_list('split_method').annotate(
+        count=Count('id'), total=Sum('total_amount'),
+    ).order_by('split_method')
+    SplitMethodSnapshot.objects.using(alias).bulk_create([
+        SplitMethodSnapshot(
+            period=period, split_method=method, expense_count=count, total_amount=total or 0,
+            share_count=share_counts.get(method, 0),
+        )
+        for method, count, total in methods
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0015_user_table_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DebtSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.BigIntegerField(default=0)),
+                ('creditor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='expenses_app.user')),
+                ('debtor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='expenses_app.user')),
+                ('period', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='debts', to='expenses_app.periodclose')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('period', 'debtor', 'creditor'), name='debtsnapshot_period_pair_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SplitMethodSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('split_method', models.CharField(choices=[('equal', 'Equal'), ('percentage', 'Percentage'), ('exact', 'Exact')], max_length=10)),
+                ('expense_count', models.PositiveIntegerField(default=0)),
+                ('total_amount', models.BigIntegerField(default=0)),
+                ('share_count', models.PositiveIntegerField(default=0)),
+                ('period', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='split_methods', to='expenses_app.periodclose')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('period', 'split_method'), name='splitmethodsnapshot_period_unique')],
+            },
+        ),
+        migrations.RunPython(snapshot_latest_period, migrations.RunPython.noop),
+    ]
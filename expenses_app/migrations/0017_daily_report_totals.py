@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+
+
+def add_up_days(apps, schema_editor):
+    # Roll up the rows already in the live and archive tables
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    for name, key, live, archive, amount in (
+        ('DailyUserTotal', 'user_id', 'ExpenseShare', 'ArchivedExpenseShare', 'amount'),
+        ('DailySplitMethodTotal', 'split_method', 'Expenses', 'ArchivedExpense', 'total_amount'),
+    ):
+        model = apps.get_model('expenses_app', name)
+        table, column = quote(model._meta.db_table), quote(model._meta.get_field(key).column)
+        for archived, source in ((False, live), (True, archive)):
+            totals = (
+                apps.get_model('expenses_app', source).objects.using(connection.alias).values_list('date', key)
+                .annotate(total=Coalesce(Sum(amount), 0), count=Count('*')).order_by()
+            )
+            sql, params = totals.query.get_compiler(using=connection.alias).as_sql()
+            schema_editor.execute(
+                f'INSERT INTO {table} ("archived", "date", {column}, "total", "count") '
+                f'SELECT %s, rollup.* FROM ({sql}) rollup',
+                [archived, *params],
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0016_period_report_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySplitMethodTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('split_method', models.CharField(choices=[('equal', 'Equal'), ('percentage', 'Percentage'), ('exact', 'Exact')], max_length=10)),
+                ('archived', models.BooleanField(default=False)),
+                ('total', models.BigIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('date', 'split_method', 'archived'), name='dailysplittotal_day_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyUserTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('archived', models.BooleanField(default=False)),
+                ('total', models.BigIntegerField(default=0)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='expenses_app.user')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'date'], name='dailyusertotal_user_date_idx')],
+                'constraints': [models.UniqueConstraint(fields=('date', 'user', 'archived'), name='dailyusertotal_day_unique')],
+            },
+        ),
+        migrations.RunPython(add_up_days, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
 
 class User(models.Model):
     email  = models.EmailField(unique=True, db_index=True)
@@ -8,6 +10,27 @@ class User(models.Model):
     def __str__(self) :
         return self.name
 
+class Group(models.Model):
+    # A trip, household, ... whose members share expenses among themselves
+    name = models.CharField(max_length=255)
+    members = models.ManyToManyField(User, through='GroupMembership', related_name='expense_groups')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) :
+        return self.name
+
+class GroupMembership(models.Model):
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='group_memberships')
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Also the index used to list the members of a group
+        constraints = [models.UniqueConstraint(fields=['group', 'user'], name='groupmembership_group_user_unique')]
+
+    def __str__(self) :
+        return f"{self.user_id} in {self.group_id}"
+
 class Expenses(models.Model):
     SPLIT_CHOICES = (
         ('equal', 'Equal'),
@@ -16,15 +39,276 @@ class Expenses(models.Model):
     )
 
     description = models.CharField(max_length=255)
-    total_amount = models.DecimalField(max_digits = 10, decimal_places=2)
+    # Amounts are integer minor units (cents / paise), rendered as decimal strings by the API
+    total_amount = models.BigIntegerField(help_text='In minor units (cents).')
     split_method = models.CharField(max_length=10, choices=SPLIT_CHOICES)
     date = models.DateField(auto_now_add= True)
+    paid_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='paid_expenses')
+    # Expenses without a group belong to the global pool. Lookups by group use the
+    # (group, date, id) index below, so the column needs no index of its own.
+    group = models.ForeignKey(Group, on_delete=models.PROTECT, null=True, blank=True, related_name='expenses', db_index=False)
+
+    class Meta:
+        # Support keyset pagination over (date, id), globally and within a group
+        indexes = [
+            models.Index(fields=['date', 'id'], name='expenses_date_id_idx'),
+            models.Index(fields=['group', 'date', 'id'], name='expenses_group_date_id_idx'),
+            # Covers the per-split-method summary report over a date range
+            models.Index(fields=['date', 'split_method', 'total_amount'], name='expenses_date_split_idx'),
+        ]
 
 class ExpenseShare(models.Model):
     expense = models.ForeignKey(Expenses, on_delete =models.CASCADE, db_index=True,related_name='shares')
-    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index= True)
-    amount = models.DecimalField(max_digits = 10, decimal_places=2, null=True, blank = True)
+    # Covered by the (user, date, id) index below
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    amount = models.BigIntegerField(null=True, blank = True, help_text='In minor units (cents).')
     percentage = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank = True)
+    # Copy of the expense's group, so group-scoped share queries read the
+    # (group, user) index instead of joining every expense of the group
+    group = models.ForeignKey(Group, on_delete=models.PROTECT, null=True, blank=True, related_name='+', db_index=False)
+    # Copy of the expense's date, so a user's shares are listed and reported by date
+    # without joining their expenses
+    date = models.DateField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'user'], name='expenseshare_group_user_idx'),
+            # Keyset pagination of a user's shares over (date, id)
+            models.Index(fields=['user', 'date', 'id'], name='expenseshare_user_date_idx'),
+            # Covers the per-user summary report over a date range
+            models.Index(fields=['date', 'user', 'amount'], name='expenseshare_date_user_idx'),
+        ]
+
+    def __str__(self) :
+        return f"{self.user.name} owes {self.amount} for {self.expense.description}"
+
+class PeriodClose(models.Model):
+    # Expenses dated on or before `cutoff` were moved to the archive tables when the
+    # period was closed, and every user's balances up to it were written to a snapshot
+    cutoff = models.DateField(unique=True)
+    closed_at = models.DateTimeField(auto_now_add=True)
+    expense_count = models.PositiveBigIntegerField(default=0)
+    share_count = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self) :
+        return f"period closed on {self.cutoff}"
+
+class BalanceSnapshot(models.Model):
+    # A user's ledger totals over every expense up to the cutoff of a closed period,
+    # in integer minor units. Live totals are the latest snapshot plus the live tables.
+    period = models.ForeignKey(PeriodClose, on_delete=models.CASCADE, related_name='snapshots')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    total_owed = models.BigIntegerField(default=0)
+    expense_count = models.PositiveIntegerField(default=0)
+    total_paid = models.BigIntegerField(default=0)
+    net_balance = models.BigIntegerField(default=0)
+    share_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['period', 'user'], name='balancesnapshot_period_user_unique')]
+
+    def __str__(self) :
+        return f"{self.user_id} owes {self.total_owed} on {self.period_id}"
+
+class DebtSnapshot(models.Model):
+    # What `debtor` owes `creditor` over every expense up to the cutoff of a closed period,
+    # in integer minor units, before netting against the debt in the opposite direction
+    period = models.ForeignKey(PeriodClose, on_delete=models.CASCADE, related_name='debts')
+    debtor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    creditor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    amount = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['period', 'debtor', 'creditor'], name='debtsnapshot_period_pair_unique')]
+
+class SplitMethodSnapshot(models.Model):
+    # Expense counts, totals and share counts of a split method over every expense up to
+    # the cutoff of a closed period, in integer minor units
+    period = models.ForeignKey(PeriodClose, on_delete=models.CASCADE, related_name='split_methods')
+    split_method = models.CharField(max_length=10, choices=Expenses.SPLIT_CHOICES)
+    expense_count = models.PositiveIntegerField(default=0)
+    total_amount = models.BigIntegerField(default=0)
+    share_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['period', 'split_method'], name='splitmethodsnapshot_period_unique')]
+
+class ArchivedExpense(models.Model):
+    # Expenses of closed periods, moved out of `Expenses` with their ids and columns
+    id = models.BigIntegerField(primary_key=True)
+    description = models.CharField(max_length=255)
+    total_amount = models.BigIntegerField(help_text='In minor units (cents).')
+    split_method = models.CharField(max_length=10, choices=Expenses.SPLIT_CHOICES)
+    date = models.DateField()
+    paid_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    group = models.ForeignKey(Group, on_delete=models.PROTECT, null=True, blank=True, related_name='archived_expenses', db_index=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'id'], name='archivedexpense_date_id_idx'),
+            models.Index(fields=['group', 'date', 'id'], name='archivedexpense_group_idx'),
+        ]
+
+class ArchivedExpenseShare(models.Model):
+    # Shares of the archived expenses, laid out as `ExpenseShare`
+    id = models.BigIntegerField(primary_key=True)
+    expense = models.ForeignKey(ArchivedExpense, on_delete=models.CASCADE, related_name='shares')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    amount = models.BigIntegerField(null=True, blank=True, help_text='In minor units (cents).')
+    percentage = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
+    group = models.ForeignKey(Group, on_delete=models.PROTECT, null=True, blank=True, related_name='+', db_index=False)
+    date = models.DateField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'user'], name='archivedshare_group_user_idx'),
+            models.Index(fields=['user', 'date', 'id'], name='archivedshare_user_date_idx'),
+        ]
+
+class UserBalance(models.Model):
+    # Materialized per-user totals, maintained in the same transaction as the shares
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='balance')
+    # Amounts in integer minor units
+    total_owed = models.BigIntegerField(default=0)
+    expense_count = models.PositiveIntegerField(default=0)
+    total_paid = models.BigIntegerField(default=0)
+    # What the user is owed (positive) or owes (negative) across expenses with a payer
+    net_balance = models.BigIntegerField(default=0)
+    # Bumped on every change to the user's expenses; drives ETag / Last-Modified
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    def __str__(self) :
+        return f"{self.user_id} owes {self.total_owed}"
+
+class DailyUserTotal(models.Model):
+    # What a user owes over the shares dated on a day (in integer minor units) and how
+    # many there are, maintained with the ledger. `archived` rows add up the shares of
+    # closed periods.
+    date = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    archived = models.BooleanField(default=False)
+    total = models.BigIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['date', 'user', 'archived'], name='dailyusertotal_day_unique')]
+        indexes = [models.Index(fields=['user', 'date'], name='dailyusertotal_user_date_idx')]
+
+class DailySplitMethodTotal(models.Model):
+    # Total amount (in integer minor units) and count of the expenses of a split method
+    # dated on a day, maintained with the ledger. `archived` rows add up the expenses of
+    # closed periods.
+    date = models.DateField()
+    split_method = models.CharField(max_length=10, choices=Expenses.SPLIT_CHOICES)
+    archived = models.BooleanField(default=False)
+    total = models.BigIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'split_method', 'archived'], name='dailysplittotal_day_unique'),
+        ]
+
+class ExportJob(models.Model):
+    FORMAT_CHOICES = (
+        ('csv', 'CSV'),
+        ('csv.gz', 'Gzip-compressed CSV'),
+        ('jsonl', 'JSON Lines'),
+    )
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        # The artifact was replaced by the export of newer data and deleted
+        ('expired', 'Expired'),
+    )
+    ACTIVE_STATUSES = ('pending', 'running', 'done')
+
+    # Hash of the parameters and of the state of the data they were exported from
+    key = models.CharField(max_length=64)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='csv')
+    date_from = models.DateField(null=True, blank=True)
+    date_to = models.DateField(null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='export_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    rows_written = models.PositiveBigIntegerField(default=0)
+    rows_total = models.PositiveBigIntegerField(null=True, blank=True)
+    file_name = models.CharField(max_length=255, blank=True)
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Moved on by the worker while it writes; a job that stops moving is considered dead
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # At most one queued, running or finished export per parameters and data state;
+        # identical requests share it
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'],
+                condition=models.Q(status__in=('pending', 'running', 'done')),
+                name='exportjob_active_key',
+            ),
+        ]
+
+    def __str__(self) :
+        return f"{self.format} export {self.id} ({self.status})"
+
+class ExpenseChange(models.Model):
+    # Change feed of the users' expense listings: one row for every write to one of a
+    # user's shares, numbered in the order they were written. Plain ids rather than
+    # foreign keys, as entries outlive the shares and expenses they point to.
+    user_id = models.BigIntegerField()
+    expense_id = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'id'], name='expensechange_user_id_idx'),
+            # Finds the entries superseded by a later one when compacting
+            models.Index(fields=['user_id', 'expense_id', 'id'], name='expensechange_expense_idx'),
+        ]
+
+    def __str__(self) :
+        return f"change {self.id} to expense {self.expense_id} of {self.user_id}"
+
+class ChangeCompaction(models.Model):
+    # Change feed tokens below `through` are no longer served: the entries they would
+    # need were compacted away, or expenses were bulk loaded without entries
+    through = models.BigIntegerField()
+    compacted_at = models.DateTimeField(auto_now_add=True)
+    removed = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self) :
+        return f"changes compacted through {self.through}"
+
+class IdempotencyKey(models.Model):
+    # Response of a POST made with an Idempotency-Key header, replayed to the retries of the
+    # request until it expires. Rows without a status are claimed by a request still running.
+    endpoint = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    # Hash of the request body: a key cannot be reused for a different request
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=JSONEncoder)
+    # When the key was claimed; a claim that is not completed in time is taken over
+    claimed_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['endpoint', 'key'], name='idempotencykey_endpoint_key')]
+
+    def __str__(self) :
+        return f"{self.endpoint} {self.key} ({self.status_code or 'running'})"
+
+class UserTableVersion(models.Model):
+    # A single row moved on by every write to the users, so that the validators of the
+    # responses embedding user names (balance sheets, exports) change with them
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self) :
-        return f"{self.user.name} owes {self.amount} for {self.expense.description}"
\ No newline at end of file
+        return f"users version {self.version}"
@@ -0,0 +1,56 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+
+# Amounts are stored and computed as integer minor units (cents / paise); they only
+# become decimal strings at the edges (API, exports)
+MINOR_UNITS = 100
+# Precision of the decimal amounts and percentages
+CENT = Decimal('0.01')
+# '.00' to '.99', the fractional part of an amount by its minor units
+FRACTIONS = [f'.{cents:02d}' for cents in range(MINOR_UNITS)]
+
+
+def to_minor(value):
+    # Decimal amount to integer minor units, e.g. Decimal('123.45') -> 12345
+    return int((Decimal(value) * MINOR_UNITS).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def allocate(total, weights):
+    # Split the integer `total` in proportion to integer `weights` so that the parts
+    # always add up to `total` exactly (largest remainder method): every part gets the
+    # floor of its exact quota and the units left over go to the largest remainders,
+    # earlier parts first on ties. All-zero weights split the total equally.
+    weights = list(weights)
+    weight_sum = sum(weights)
+    if not weight_sum:
+        weights = [1] * len(weights)
+        weight_sum = len(weights)
+    parts = []
+    remainders = []
+    for index, weight in enumerate(weights):
+        part, remainder = divmod(total * weight, weight_sum)
+        parts.append(part)
+        remainders.append((-remainder, index))
+    for _, index in sorted(remainders)[:total - sum(parts)]:
+        parts[index] += 1
+    return parts
+
+
+def format_minor(value):
+    # Render integer minor units as a decimal string, e.g. 12345 -> "123.45"
+    value = int(value)
+    sign = '-' if value < 0 else ''
+    units, cents = divmod(abs(value), MINOR_UNITS)
+    return f"{sign}{units}.{cents:02d}"
+
+
+def format_minor_array(values):
+    # Vectorized format_minor() for an integer NumPy array, returns a list of strings.
+    # Reports format up to millions of amounts: the fractional parts are looked up rather
+    # than formatted, and only the negative amounts are revisited for their sign.
+    units, cents = np.divmod(np.abs(values), MINOR_UNITS)
+    strings = list(map(str.__add__, map(str, units.tolist()), map(FRACTIONS.__getitem__, cents.tolist())))
+    for index in np.flatnonzero(values < 0).tolist():
+        strings[index] = '-' + strings[index]
+    return strings
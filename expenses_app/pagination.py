@@ -0,0 +1,137 @@
+import base64
+import binascii
+import datetime
+import heapq
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .routers import expense_shards
+from .sharding import fetch_all, on_shard
+
+
+# Keyset (cursor) pagination over a (date, id) ordering.
+# Each page is fetched with a `WHERE (date, id) > (last_date, last_id)` filter, so the
+# cost of a page does not depend on how deep into the listing it is.
+class KeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def __init__(self, date_field='date', id_field='id'):
+        self.date_field = date_field
+        self.id_field = id_field
+        self.page_size = getattr(settings, 'EXPENSES_PAGE_SIZE', 100)
+        self.max_page_size = getattr(settings, 'EXPENSES_MAX_PAGE_SIZE', 1000)
+
+    def get_query_params(self, request):
+        # DRF requests and plain Django requests are both accepted
+        return getattr(request, 'query_params', request.GET)
+
+    def get_page_size(self, request):
+        value = self.get_query_params(request).get(self.page_size_query_param)
+        if value is None:
+            return self.page_size
+        try:
+            page_size = int(value)
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: "A valid integer is required."})
+        if page_size < 1:
+            raise ValidationError({self.page_size_query_param: "Ensure this value is greater than or equal to 1."})
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, date, pk):
+        raw = f"{date.isoformat()}|{pk}".encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            date, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+            return datetime.date.fromisoformat(date), int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise ValidationError({self.cursor_query_param: "Invalid cursor."})
+
+    def get_position(self, obj):
+        # Read the (date, id) key of an item; `date_field` may span a relation.
+        # Rows from `.values()` querysets carry the lookup as their key.
+        if isinstance(obj, dict):
+            return obj[self.date_field], obj[self.id_field]
+        value = obj
+        for part in self.date_field.split('__'):
+            value = getattr(value, part)
+        return value, getattr(obj, self.id_field)
+
+    def page_queryset(self, queryset, request):
+        # The queryset of the requested page, with one extra row to know whether there
+        # is a next page
+        self.request = request
+        params = self.get_query_params(request)
+        self.current_page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(self.date_field, self.id_field)
+        cursor = params.get(self.cursor_query_param)
+        if cursor:
+            date, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(**{f'{self.date_field}__gt': date}) |
+                Q(**{self.date_field: date, f'{self.id_field}__gt': pk})
+            )
+        return queryset[:self.current_page_size + 1]
+
+    def finish_page(self, rows):
+        self.has_next = len(rows) > self.current_page_size
+        page = rows[:self.current_page_size]
+        self.next_position = self.get_position(page[-1]) if self.has_next else None
+        return page
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.finish_page(list(self.page_queryset(queryset, request)))
+
+    def merge_pages(self, pages):
+        # One page out of the pages of several querysets, merged on their (date, id) keys
+        rows = heapq.merge(*pages, key=self.get_position)
+        return self.finish_page(list(islice(rows, self.current_page_size + 1)))
+
+    def paginate_querysets(self, querysets, request, view=None):
+        # Paginate the rows of several querysets as one listing, e.g. the live and the
+        # archive tables. Every queryset is read up to one page from the cursor on.
+        return self.merge_pages([list(self.page_queryset(queryset, request)) for queryset in querysets])
+
+    def paginate_shards(self, querysets, request, view=None):
+        # `paginate_querysets` over every expense shard: the pages of each shard are read
+        # in parallel (see sharding.py) and merged as one listing
+        pages = [
+            on_shard(self.page_queryset(queryset, request), alias)
+            for alias in expense_shards() for queryset in querysets
+        ]
+        return self.merge_pages(fetch_all(pages))
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(*self.next_position))
+
+    def get_paginated_data(self, data):
+        return {
+            'next': self.get_next_link(),
+            'results': data,
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
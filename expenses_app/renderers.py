@@ -0,0 +1,34 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is used without it
+    orjson = None
+
+
+# JSON renderer backed by orjson when it is installed.
+# Produces the same bytes as DRF's JSONRenderer for compact UTF-8 output; anything
+# orjson cannot handle natively (Decimal, lazy strings, datetimes) goes through DRF's
+# own encoder, and indented or ASCII-only output falls back to the stdlib renderer.
+class FastJSONRenderer(JSONRenderer):
+    options = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def __init__(self):
+        self.encoder = self.encoder_class()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if orjson is None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self.encoder.default, option=self.options)
+        except (orjson.JSONEncodeError, TypeError):
+            # e.g. integers beyond 64 bits; let the stdlib encoder decide
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # Same \u2028 / \u2029 escaping as JSONRenderer
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
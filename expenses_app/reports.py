@@ -0,0 +1,383 @@
+from itertools import chain
+
+import numpy as np
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Case, DateField, F, Func, IntegerField, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDay, TruncMonth, TruncWeek
+
+from .archive import archived_querysets
+from .ledger import latest_period
+from .models import (
+    Expenses, ExpenseShare, BalanceSnapshot, DebtSnapshot, SplitMethodSnapshot, DailyUserTotal, DailySplitMethodTotal,
+)
+from .money import format_minor, format_minor_array
+from .sharding import gather
+
+SPLIT_METHODS = [choice for choice, _ in Expenses.SPLIT_CHOICES]
+
+# Marks expenses without a payer in the payer column
+NO_PAYER = -1
+
+# Rows fetched from the database at a time while reading columns
+COLUMN_CHUNK_SIZE = 10000
+
+GRANULARITIES = ('day', 'week', 'month')
+SUMMARY_GROUPS = ('user', 'split_method')
+TRUNCATE = {'day': TruncDay, 'week': TruncWeek, 'month': TruncMonth}
+# SQLite runs Django's Trunc functions as Python callbacks, once per row; its own date
+# functions are several times faster. Weeks start on Monday as with TruncWeek.
+SQLITE_PERIODS = {
+    'day': '%(expressions)s',
+    'week': "date(%(expressions)s, 'weekday 0', '-6 days')",
+    'month': "date(%(expressions)s, 'start of month')",
+}
+
+
+# Column arrays of the expenses and shares tables, amounts in integer minor units.
+# Every report is computed from these arrays with vectorized NumPy operations
+# instead of iterating model instances.
+class ExpenseArrays:
+
+    def __init__(self, expense_ids, payers, totals, split_codes, share_expenses, share_users, share_amounts):
+        self.expense_ids = expense_ids
+        self.payers = payers
+        self.totals = totals
+        self.split_codes = split_codes
+        self.share_expenses = share_expenses
+        self.share_users = share_users
+        self.share_amounts = share_amounts
+
+        # Position of every share's expense in the (sorted) expense columns
+        self.share_expense_index = np.searchsorted(expense_ids, share_expenses)
+        self.share_payers = payers[self.share_expense_index]
+
+        # Dense 0..n-1 index over every user that appears as a participant or a payer
+        self.user_ids, inverse = np.unique(
+            np.concatenate([share_users, payers[payers != NO_PAYER]]),
+            return_inverse=True,
+        )
+        self.share_user_index = inverse[:len(share_users)]
+        # Dense index of every expense's payer and of every share's payer (meaningless without a payer)
+        self.payer_index = np.searchsorted(self.user_ids, payers)
+        self.share_payer_index = self.payer_index[self.share_expense_index]
+
+    @classmethod
+    def load(cls, expenses=None, shares=None, archived=None):
+        # `archived`: (expenses, shares) querysets of the archive tables read along with
+        # the live ones, for the whole history. Without querysets, the tables of every
+        # expense shard are read in parallel; their ids come in shard order, so the
+        # concatenated columns stay sorted.
+        if expenses is None and shares is None:
+            parts = gather(lambda alias: _load_columns(Expenses.objects.all(), ExpenseShare.objects.all(), archived))
+            expense_columns, share_columns = parts[0] if len(parts) == 1 else [
+                np.concatenate(columns, axis=1) for columns in zip(*parts)
+            ]
+        else:
+            expense_columns, share_columns = _load_columns(expenses, shares, archived)
+        expense_ids, payers, totals, split_codes = expense_columns
+        return cls(expense_ids, payers, totals, split_codes.astype(np.int8), *share_columns)
+
+    def user_totals(self, baseline=None):
+        # Per-user owed, paid and net amounts plus share counts. `baseline` holds the
+        # (user ids, owed, paid, net, share count) columns of a balance snapshot to add on top.
+        n = len(self.user_ids)
+        owed = _sum_by(self.share_user_index, self.share_amounts, n)
+        share_count = np.bincount(self.share_user_index, minlength=n)
+
+        has_payer = self.payers != NO_PAYER
+        paid = _sum_by(self.payer_index[has_payer], self.totals[has_payer], n)
+
+        # Net balance: payers are credited with the shares of their expenses, participants debited
+        paid_shares = self.share_payers != NO_PAYER
+        credited = _sum_by(self.share_payer_index[paid_shares], self.share_amounts[paid_shares], n)
+        debited = _sum_by(self.share_user_index[paid_shares], self.share_amounts[paid_shares], n)
+
+        user_ids, net = self.user_ids, credited - debited
+        if baseline is not None and len(baseline[0]):
+            base_ids = baseline[0]
+            user_ids = np.union1d(self.user_ids, base_ids)
+            live, base = np.searchsorted(user_ids, self.user_ids), np.searchsorted(user_ids, base_ids)
+            owed, paid, net, share_count = [
+                _scatter(len(user_ids), live, values, base, base_values)
+                for values, base_values in zip((owed, paid, net, share_count), baseline[1:])
+            ]
+
+        columns = zip(
+            user_ids.tolist(),
+            format_minor_array(owed),
+            format_minor_array(paid),
+            format_minor_array(net),
+            share_count.tolist(),
+        )
+        return [
+            {
+                "user": user_id,
+                "total_owed": user_owed,
+                "total_paid": user_paid,
+                "net_balance": net_balance,
+                "share_count": count,
+            }
+            for user_id, user_owed, user_paid, net_balance, count in columns
+        ]
+
+    def gross_debts(self):
+        # (debtor ids, creditor ids, amounts) columns of what every participant owes every
+        # payer, one column per (debtor, creditor) pair, before netting
+        n = len(self.user_ids)
+        mask = (self.share_payers != NO_PAYER) & (self.share_payers != self.share_users)
+        if not mask.any():
+            return np.zeros((3, 0), dtype=np.int64)
+        keys, inverse = np.unique(self.share_user_index[mask] * n + self.share_payer_index[mask], return_inverse=True)
+        owed = _sum_by(inverse, self.share_amounts[mask], len(keys))
+        return np.stack([self.user_ids[keys // n], self.user_ids[keys % n], owed])
+
+    def pairwise_debts(self, baseline=None):
+        # Net amount every participant owes every payer. `baseline` holds the (debtor ids,
+        # creditor ids, amounts) columns of a debt snapshot to add on top.
+        columns = self.gross_debts()
+        if baseline is not None and len(baseline[0]):
+            columns = np.concatenate([baseline, columns], axis=1)
+        return net_debts(*columns)
+
+    def split_method_breakdown(self, baseline=None):
+        # Expense counts, totals and share counts per split method. `baseline` holds the
+        # (split codes, expense counts, totals, share counts) columns of a split method
+        # snapshot to add on top.
+        methods = len(SPLIT_METHODS)
+        counts = np.bincount(self.split_codes, minlength=methods)
+        totals = _sum_by(self.split_codes, self.totals, methods)
+        share_counts = np.bincount(self.split_codes[self.share_expense_index], minlength=methods)
+        if baseline is not None and len(baseline[0]):
+            codes = baseline[0]
+            counts, totals, share_counts = [
+                values + _sum_by(codes, base_values, methods)
+                for values, base_values in zip((counts, totals, share_counts), baseline[1:])
+            ]
+        return [
+            {
+                "split_method": method,
+                "expense_count": int(counts[code]),
+                "total_amount": format_minor(totals[code]),
+                "share_count": int(share_counts[code]),
+            }
+            for code, method in enumerate(SPLIT_METHODS)
+        ]
+
+
+def net_debts(debtors, creditors, owed):
+    # Net amount every debtor owes every creditor from (debtor ids, creditor ids, amounts)
+    # columns, which may repeat a pair. Debts in both directions between two users are
+    # netted against each other.
+    if not len(debtors):
+        return []
+    user_ids = np.unique(np.concatenate([debtors, creditors]))
+    n = len(user_ids)
+    keys, inverse = np.unique(np.searchsorted(user_ids, debtors) * n + np.searchsorted(user_ids, creditors), return_inverse=True)
+    owed = _sum_by(inverse, owed, len(keys))
+
+    # Look up the debt in the opposite direction for every pair
+    reverse_keys = (keys % n) * n + keys // n
+    position = np.minimum(np.searchsorted(keys, reverse_keys), len(keys) - 1)
+    reverse_owed = np.where(keys[position] == reverse_keys, owed[position], 0)
+    net = owed - reverse_owed
+
+    positive = net > 0
+    columns = zip(
+        user_ids[keys[positive] // n].tolist(),
+        user_ids[keys[positive] % n].tolist(),
+        format_minor_array(net[positive]),
+    )
+    return [{"from_user": debtor, "to_user": creditor, "amount": amount} for debtor, creditor, amount in columns]
+
+
+# First day of the day, week or month `expression` (a date) falls in
+class PeriodStart(Func):
+    output_field = DateField()
+
+    def __init__(self, expression, granularity):
+        super().__init__(expression)
+        self.granularity = granularity
+
+    def as_sql(self, compiler, connection, **extra_context):
+        trunc = TRUNCATE[self.granularity](*self.get_source_expressions(), output_field=DateField())
+        return compiler.compile(trunc.resolve_expression(compiler.query))
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template=SQLITE_PERIODS[self.granularity], **extra_context)
+
+
+def snapshot_columns(period):
+    # (user ids, owed, paid, net, share count) columns of the balance snapshot of a closed period
+    return _columns(
+        BalanceSnapshot.objects.filter(period=period), 'user_id', 'total_owed', 'total_paid', 'net_balance', 'share_count',
+    )
+
+
+def debt_snapshot_columns(period):
+    # (debtor ids, creditor ids, amounts) columns of the debt snapshot of a closed period
+    return _columns(DebtSnapshot.objects.filter(period=period), 'debtor_id', 'creditor_id', 'amount')
+
+
+def split_method_snapshot_columns(period):
+    # (split codes, expense counts, totals, share counts) columns of the split method
+    # snapshot of a closed period
+    return _columns(
+        SplitMethodSnapshot.objects.filter(period=period), _split_code(), 'expense_count', 'total_amount', 'share_count',
+    )
+
+
+def latest_period_columns(columns):
+    # `columns(period)` of the last closed period of every expense shard (every shard
+    # closes its own periods), concatenated; None before the first close
+    def shard_columns(alias):
+        period = latest_period()
+        return columns(period) if period is not None else None
+
+    parts = [part for part in gather(shard_columns) if part is not None]
+    if len(parts) < 2:
+        return parts[0] if parts else None
+    return np.concatenate(parts, axis=1)
+
+
+def latest_snapshot_columns():
+    # `snapshot_columns` of the last closed period, added up over the expense shards
+    columns = latest_period_columns(snapshot_columns)
+    if columns is None:
+        return None
+    user_ids, inverse = np.unique(columns[0], return_inverse=True)
+    return np.stack([user_ids] + [_sum_by(inverse, values, len(user_ids)) for values in columns[1:]])
+
+
+def load_arrays(include_archived=False):
+    # The arrays of the open period, or of the whole history with `include_archived`
+    return ExpenseArrays.load(archived=archived_querysets() if include_archived else None)
+
+
+def user_totals(include_archived=False):
+    # Whole-history totals per user: the snapshot of the last closed period plus the open
+    # period, or every row of the live and archive tables with `include_archived`
+    if include_archived:
+        return load_arrays(include_archived=True).user_totals()
+    return ExpenseArrays.load().user_totals(latest_snapshot_columns())
+
+
+def pairwise_debts(include_archived=False):
+    # Whole-history net debts: the debt snapshot of the last closed period plus the open
+    # period, or every row of the live and archive tables with `include_archived`
+    if include_archived:
+        return load_arrays(include_archived=True).pairwise_debts()
+    return ExpenseArrays.load().pairwise_debts(latest_period_columns(debt_snapshot_columns))
+
+
+def split_method_breakdown(include_archived=False):
+    # Whole-history totals per split method, from the snapshot of the last closed period
+    # plus the open period or, with `include_archived`, from the archive tables
+    if include_archived:
+        return load_arrays(include_archived=True).split_method_breakdown()
+    return ExpenseArrays.load().split_method_breakdown(latest_period_columns(split_method_snapshot_columns))
+
+
+def period_summary(date_from=None, date_to=None, granularity='month', group_by='user', user=None, include_archived=False):
+    # Totals per period and user (what the user owes, from the shares) or per period and
+    # split method (from the expenses), added up by the database from the per-day rollups
+    # the ledger maintains, so a period costs one row per day and user or split method
+    # rather than one per share or expense. `include_archived` adds the rows of closed
+    # periods.
+    if group_by == 'user':
+        model, key = DailyUserTotal, 'user_id'
+    else:
+        model, key = DailySplitMethodTotal, 'split_method'
+    def shard_rows(alias):
+        rows = model.objects.all() if include_archived else model.objects.filter(archived=False)
+        if user is not None:
+            rows = rows.filter(user=user)
+        if date_from is not None:
+            rows = rows.filter(date__gte=date_from)
+        if date_to is not None:
+            rows = rows.filter(date__lte=date_to)
+        return list(
+            rows.values_list(PeriodStart('date', granularity), key)
+            .annotate(total=Sum('total'), count=Sum('count'))
+            .order_by()
+        )
+
+    # The totals of every expense shard, added up
+    totals = {}
+    for period, value, total, count in chain.from_iterable(gather(shard_rows)):
+        previous_total, previous_count = totals.get((period, value), (0, 0))
+        totals[period, value] = (previous_total + total, previous_count + count)
+    label = 'user' if group_by == 'user' else 'split_method'
+    return [
+        {"period": period.isoformat(), label: value, "total": format_minor(total), "count": count}
+        for (period, value), (total, count) in sorted(totals.items())
+    ]
+
+
+def _load_columns(expenses, shares, archived=None):
+    # (expense columns, share columns) of the live and, with `archived`, the archive tables
+    expenses = Expenses.objects.all() if expenses is None else expenses
+    shares = ExpenseShare.objects.all() if shares is None else shares
+    expense_columns, share_columns = _table_columns(expenses, shares)
+    if archived is not None:
+        archived_expenses, archived_shares = _table_columns(*archived)
+        # Archived and live ids may interleave; the expense columns are kept sorted by id
+        expense_columns = np.concatenate([archived_expenses, expense_columns], axis=1)
+        expense_columns = expense_columns[:, np.argsort(expense_columns[0], kind='stable')]
+        share_columns = np.concatenate([archived_shares, share_columns], axis=1)
+    return expense_columns, share_columns
+
+
+def _table_columns(expenses, shares):
+    # (expense columns, share columns) of an expenses and a shares queryset, the expense
+    # columns sorted by id
+    expense_columns = _columns(expenses, 'id', Coalesce(F('paid_by'), Value(NO_PAYER)), 'total_amount', _split_code())
+    expense_columns = expense_columns[:, np.argsort(expense_columns[0], kind='stable')]
+
+    # Ignore shares of expenses created after the expenses were read
+    last_expense_id = int(expense_columns[0][-1]) if expense_columns.shape[1] else 0
+    share_columns = _columns(
+        shares.filter(expense_id__lte=last_expense_id), 'expense_id', 'user_id', Coalesce(F('amount'), Value(0)),
+    )
+    return expense_columns, share_columns
+
+
+def _split_code():
+    # Position of the `split_method` column in SPLIT_METHODS
+    return Case(
+        *[When(split_method=method, then=Value(code)) for code, method in enumerate(SPLIT_METHODS)],
+        output_field=IntegerField(),
+    )
+
+
+def _columns(queryset, *fields):
+    # The integer `fields` (names or expressions) of the rows of `queryset` as int64
+    # arrays, in the order the rows are read. The rows of a single query are streamed
+    # flat into one array and split into columns, so every column comes from the same
+    # rows whatever order the database returns them in. The rows are fetched from the
+    # cursor as they are: the ORM's per-row conversion would dominate the load time.
+    rows = queryset.values_list(*fields).order_by()
+    try:
+        sql, params = rows.query.get_compiler(using=rows.db).as_sql()
+    except EmptyResultSet:
+        return np.zeros((len(fields), 0), dtype=np.int64)
+    with connections[rows.db].cursor() as cursor:
+        cursor.execute(sql, params)
+        chunks = iter(lambda: cursor.fetchmany(COLUMN_CHUNK_SIZE), [])
+        values = np.fromiter(chain.from_iterable(chain.from_iterable(chunks)), dtype=np.int64)
+    return values.reshape(-1, len(fields)).T
+
+
+def _scatter(length, index, values, other_index, other_values):
+    # Array of `length` zeros with `values` added at `index` and `other_values` at `other_index`
+    result = np.zeros(length, dtype=np.int64)
+    result[index] += values
+    result[other_index] += other_values
+    return result
+
+
+def _sum_by(index, values, length):
+    # Exact integer group-by sum (np.bincount would go through float64)
+    sums = np.zeros(length, dtype=np.int64)
+    np.add.at(sums, index, values)
+    return sums
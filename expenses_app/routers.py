@@ -0,0 +1,230 @@
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+# Read replica and expense shard routing.
+# ReplicaRoutingMiddleware (middleware.py) lets safe requests to the expenses_app views
+# read from a replica, and ReplicaRouter sends their reads to one of EXPENSES_READ_REPLICAS.
+# Everything else reads from the primary: writes, unsafe requests, requests inside a
+# transaction, management commands, export workers and clients that wrote less than
+# EXPENSES_REPLICA_STICKY_SECONDS ago, so that they read their own writes.
+# ShardRouter sends the queries of the expense tables to the shard selected with
+# `use_shard` (see sharding.py); it comes first and leaves the default shard to ReplicaRouter.
+
+PRIMARY = 'default'
+
+# Set for EXPENSES_REPLICA_STICKY_SECONDS on the clients of successful writes
+STICKY_COOKIE = 'expenses_primary'
+
+# Routing of the request being handled. Like the query recorder, it follows the request
+# into the threads that read the expense shards (see sharding.py).
+current_routing = ContextVar('expenses_replica_routing', default=None)
+
+# Expense shard selected with `use_shard`, followed into threads the same way
+current_shard = ContextVar('expenses_shard', default=None)
+
+# Models whose rows live on the shard of their expense; users, groups and export jobs stay
+# on the default database
+SHARDED_MODELS = frozenset({
+    'expenses', 'expenseshare', 'archivedexpense', 'archivedexpenseshare', 'userbalance',
+    'dailyusertotal', 'dailysplitmethodtotal', 'periodclose', 'balancesnapshot', 'debtsnapshot', 'splitmethodsnapshot',
+    'expensechange', 'changecompaction',
+})
+
+
+def read_replicas():
+    return list(getattr(settings, 'EXPENSES_READ_REPLICAS', []))
+
+
+def expense_shards():
+    # Aliases of the expense shards, the default database first
+    return list(getattr(settings, 'EXPENSES_SHARDS', [PRIMARY]))
+
+
+def active_shard():
+    # The shard the queries of the expense tables go to
+    return current_shard.get() or PRIMARY
+
+
+def sticky_seconds():
+    return getattr(settings, 'EXPENSES_REPLICA_STICKY_SECONDS', 5)
+
+
+def reading_from_replica():
+    routing = current_routing.get()
+    return routing is not None and routing.alias is not None
+
+
+# Routing state of one request. All reads of a request go to the same replica, picked
+# on the first read and given back once the response has been sent.
+class Routing:
+
+    def __init__(self):
+        self.allowed = False
+        self.wrote = False
+        self.alias = None
+        self.selector = None
+
+    def release(self):
+        if self.selector is not None:
+            self.selector.release(self.alias)
+            self.selector = None
+
+
+# Replica selection (EXPENSES_REPLICA_SELECTION)
+class RoundRobinSelector:
+
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def acquire(self):
+        with self.lock:
+            alias = self.aliases[self.count % len(self.aliases)]
+            self.count += 1
+        return alias
+
+    def release(self, alias):
+        pass
+
+
+# Picks the replica that was used least recently: replicas still serving requests count
+# as in use now, the others as of when they were last picked or their last request
+# finished. Long requests (streamed balance sheets) keep their replica out of the way.
+class LeastRecentlyUsedSelector:
+
+    def __init__(self, aliases):
+        self.lock = threading.Lock()
+        self.in_flight = dict.fromkeys(aliases, 0)
+        self.last_used = dict.fromkeys(aliases, 0.0)
+
+    def acquire(self):
+        with self.lock:
+            alias = min(self.in_flight, key=lambda alias: (self.in_flight[alias], self.last_used[alias]))
+            self.in_flight[alias] += 1
+            self.last_used[alias] = time.monotonic()
+        return alias
+
+    def release(self, alias):
+        with self.lock:
+            self.in_flight[alias] -= 1
+            self.last_used[alias] = time.monotonic()
+
+
+SELECTORS = {
+    'round_robin': RoundRobinSelector,
+    'least_recently_used': LeastRecentlyUsedSelector,
+}
+
+
+class ReplicaRouter:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.selectors = {}
+
+    def selector(self, replicas):
+        # One selector per replica set, so that changing the settings starts afresh
+        method = getattr(settings, 'EXPENSES_REPLICA_SELECTION', 'round_robin')
+        key = (method, tuple(replicas))
+        with self.lock:
+            if key not in self.selectors:
+                self.selectors[key] = SELECTORS[method](list(replicas))
+            return self.selectors[key]
+
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        if routing is None or not routing.allowed or routing.wrote or model._meta.app_label != 'expenses_app':
+            return None
+        if routing.alias is None:
+            replicas = read_replicas()
+            # Reads inside a transaction on the primary must see its writes
+            if not replicas or connections[PRIMARY].in_atomic_block:
+                return None
+            routing.selector = self.selector(replicas)
+            routing.alias = routing.selector.acquire()
+        return routing.alias
+
+    def db_for_write(self, model, **hints):
+        # The rest of the request, and the client for a while, read from the primary
+        routing = current_routing.get()
+        if routing is not None:
+            routing.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *read_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        return False if db in read_replicas() else None
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'expenses_app' and model._meta.model_name in SHARDED_MODELS
+
+
+class ShardRouter:
+
+    def shard(self, model, hints):
+        # The selected shard, else the shard of the instance the query is about
+        if not is_sharded(model):
+            return None
+        alias = current_shard.get()
+        if alias is None:
+            instance = hints.get('instance')
+            if instance is not None and is_sharded(type(instance)):
+                alias = instance._state.db
+        # The default shard is left to the next router
+        if alias == PRIMARY or alias not in expense_shards():
+            return None
+        return alias
+
+    def db_for_read(self, model, **hints):
+        return self.shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Users and groups are copied to every shard, so expenses may reference them anywhere
+        shards = expense_shards()
+        if len(shards) > 1 and obj1._state.db in shards and obj2._state.db in shards:
+            return True
+        return None
+
+
+# Streaming content that is read through the routing of its request, after the
+# middleware has returned. The replica is given back when the response is closed.
+class RoutedContent:
+
+    def __init__(self, content, routing):
+        self.content = content
+        self.routing = routing
+
+    def close(self):
+        self.routing.release()
+
+
+class RoutedStream(RoutedContent):
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = current_routing.set(self.routing)
+        try:
+            return next(self.content)
+        finally:
+            current_routing.reset(token)
+
+
+def routed_stream(response, routing):
+    return RoutedStream(iter(response.streaming_content), routing)
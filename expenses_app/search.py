@@ -0,0 +1,175 @@
+import re
+from collections import defaultdict
+from itertools import chain
+
+from django.db import connections
+
+from .fast_serializers import archived_expense_rows, expense_rows, serialize_expenses
+from .models import Expenses, ExpenseShare, ArchivedExpense, ArchivedExpenseShare
+from .sharding import gather, id_shard, on_shard
+
+# Full-text search over the expense descriptions.
+# Backed by the FTS5 table of migration 0013 on SQLite and by GIN indexes over
+# to_tsvector('simple', description) on PostgreSQL, so a search reads the index entries of
+# its words instead of scanning every description. The FTS5 table also indexes the users of
+# every expense, so filtering by user intersects index entries too. Every match is ranked by
+# relevance (bm25 / ts_rank), newest first among equals, and the best `limit` are kept.
+# With several expense shards, every shard ranks its own matches and the best of them are
+# merged on their scores.
+
+SEARCH_TABLE = 'expenses_app_expensesearch'
+# Text search configuration of the PostgreSQL indexes: no stemming and no stop words, like
+# the unicode61 tokenizer of the FTS5 table
+SEARCH_CONFIG = 'simple'
+
+# Words of a query; a trailing * makes the word a prefix
+TERM = re.compile(r'(\w+)(\*?)')
+
+
+def parse_query(text):
+    # "din* paris" -> [('din', True), ('paris', False)]. Anything that is not a word is
+    # ignored, so queries cannot inject search syntax. Raises ValueError without words.
+    terms = [(word.lower(), bool(star)) for word, star in TERM.findall(text)]
+    if not terms:
+        raise ValueError("Enter at least one word to search for.")
+    return terms
+
+
+def fts5_query(terms, user_id=None):
+    # Every word must be in the description: description : "din"* AND description : "paris".
+    # A user is one more word, among the users of the expense.
+    phrases = [f'description : "{word}"' + ('*' if prefix else '') for word, prefix in terms]
+    if user_id is not None:
+        phrases.append(f'users : "{int(user_id)}"')
+    return ' AND '.join(phrases)
+
+
+def tsquery(terms):
+    # Same for to_tsquery: din:* & paris
+    return ' & '.join(word + (':*' if prefix else '') for word, prefix in terms)
+
+
+def expense_conditions(connection, share_model, date_from, date_to, user_id=None):
+    # WHERE conditions on an expense row aliased `e`: it is dated within the range and the
+    # user takes part in it
+    conditions, params = [], []
+    if date_from is not None:
+        conditions.append('e.date >= %s')
+        params.append(connection.ops.adapt_datefield_value(date_from))
+    if date_to is not None:
+        conditions.append('e.date <= %s')
+        params.append(connection.ops.adapt_datefield_value(date_to))
+    if user_id is not None:
+        shares = connection.ops.quote_name(share_model._meta.db_table)
+        conditions.append(f'EXISTS (SELECT 1 FROM {shares} s WHERE s.expense_id = e.id AND s.user_id = %s)')
+        params.append(user_id)
+    return conditions, params
+
+
+def sources(include_archived):
+    pairs = [(Expenses, ExpenseShare)]
+    if include_archived:
+        pairs.append((ArchivedExpense, ArchivedExpenseShare))
+    return pairs
+
+
+def sqlite_filters(connection, alias, date_from, date_to, include_archived):
+    # WHERE conditions on the index entries aliased `alias`: their expense is in one of the
+    # tables searched and dated within the range. Users are filtered by the match itself.
+    if include_archived and date_from is None and date_to is None:
+        # Every entry is a live or an archived expense
+        return [], []
+    exists, params = [], []
+    for expense_model, share_model in sources(include_archived):
+        conditions, source_params = expense_conditions(connection, share_model, date_from, date_to)
+        table = connection.ops.quote_name(expense_model._meta.db_table)
+        where = ' AND '.join([f'e.id = {alias}.rowid'] + conditions)
+        exists.append(f'EXISTS (SELECT 1 FROM {table} e WHERE {where})')
+        params.extend(source_params)
+    return [f'({" OR ".join(exists)})'], params
+
+
+def sqlite_search(connection, terms, user_id, date_from, date_to, include_archived, limit):
+    # The FTS5 table yields the matches, user filter included, ranked by bm25 over the
+    # description
+    conditions, params = sqlite_filters(connection, SEARCH_TABLE, date_from, date_to, include_archived)
+    where = ' AND '.join([f'{SEARCH_TABLE}.{SEARCH_TABLE} MATCH %s'] + conditions)
+    # bm25() takes the table itself, not an alias
+    return (
+        f'SELECT rowid, bm25({SEARCH_TABLE}, 1.0, 0.0) AS score FROM {SEARCH_TABLE} WHERE {where} '
+        f'ORDER BY score, rowid DESC LIMIT %s',
+        [fts5_query(terms, user_id), *params, limit],
+    )
+
+
+def postgresql_search(connection, terms, user_id, date_from, date_to, include_archived, limit):
+    # The GIN index of each expense table yields its matches, which are then ranked by
+    # ts_rank. The expressions must stay the ones the indexes were created on.
+    # Scores are negated, so that lower is better as with bm25.
+    query = tsquery(terms)
+    selects, params = [], []
+    for expense_model, share_model in sources(include_archived):
+        conditions, source_params = expense_conditions(connection, share_model, date_from, date_to, user_id)
+        table = connection.ops.quote_name(expense_model._meta.db_table)
+        where = ' AND '.join([f"to_tsvector('{SEARCH_CONFIG}', e.description) @@ to_tsquery('{SEARCH_CONFIG}', %s)"] + conditions)
+        selects.append(f'SELECT e.id, e.description FROM {table} e WHERE {where}')
+        params.extend([query, *source_params])
+    return (
+        f"SELECT id, -ts_rank(to_tsvector('{SEARCH_CONFIG}', description), to_tsquery('{SEARCH_CONFIG}', %s)) AS score "
+        f'FROM ({" UNION ALL ".join(selects)}) matches ORDER BY score, id DESC LIMIT %s',
+        [query, *params, limit],
+    )
+
+
+SEARCHES = {
+    'sqlite': sqlite_search,
+    'postgresql': postgresql_search,
+}
+
+
+def search_shard(terms, user_id, date_from, date_to, include_archived, limit):
+    # (score, id) of the best `limit` matches of the shard being read, best (lowest) first.
+    # Runs on the database the expenses are read from (a replica when the request reads
+    # from one).
+    connection = connections[Expenses.objects.all().db]
+    if connection.vendor not in SEARCHES:
+        raise NotImplementedError(f"Full-text search is not supported on {connection.vendor}.")
+    sql, params = SEARCHES[connection.vendor](
+        connection, terms, user_id, date_from, date_to, include_archived, limit,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(score, expense_id) for expense_id, score in cursor.fetchall()]
+
+
+def search_expense_ids(terms, user_id=None, date_from=None, date_to=None, include_archived=False, limit=100):
+    # Ids of the best `limit` expenses matching every term, best first
+    shards = gather(lambda alias: search_shard(terms, user_id, date_from, date_to, include_archived, limit))
+    matches = shards[0] if len(shards) == 1 else sorted(chain.from_iterable(shards), key=lambda match: (match[0], -match[1]))
+    return [expense_id for _, expense_id in matches[:limit]]
+
+
+def search_expenses(terms, user_id=None, date_from=None, date_to=None, include_archived=False, limit=100):
+    # The matching expenses with their shares, as listed by the overall expenses endpoint,
+    # best first
+    ids = search_expense_ids(terms, user_id, date_from, date_to, include_archived, limit)
+    by_shard = defaultdict(list)
+    for expense_id in ids:
+        by_shard[id_shard(expense_id)].append(expense_id)
+    querysets = [expense_rows(), archived_expense_rows()] if include_archived else [expense_rows()]
+    rows = {}
+    for alias, shard_ids in by_shard.items():
+        for queryset in querysets:
+            missing = [expense_id for expense_id in shard_ids if expense_id not in rows]
+            if not missing:
+                break
+            for row in on_shard(queryset, alias).filter(id__in=missing):
+                rows[row['id']] = row
+    return serialize_expenses([rows[expense_id] for expense_id in ids if expense_id in rows], include_archived)
+
+
+def clear_search_index(cursor):
+    # Empty the FTS5 table ahead of a bulk DELETE of the expenses, which would otherwise
+    # remove its entries one by one through the triggers
+    if cursor.db.vendor == 'sqlite':
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
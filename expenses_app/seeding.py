@@ -0,0 +1,200 @@
+import datetime
+import random
+from decimal import Decimal
+
+from collections import defaultdict
+
+from django.db import connections, transaction
+
+from .cache import response_cache
+from .changes import reset_changes
+from .conditional import touch_user_table
+from .ingest import save_expenses, shard_chunks
+from .ledger import rebuild_ledger
+from .search import clear_search_index
+from .routers import active_shard, expense_shards
+from .sharding import copy_to_shards, is_sharded, use_shard
+from .models import (
+    User, Group, GroupMembership, Expenses, ExpenseShare, ExportJob, UserBalance, DailyUserTotal, DailySplitMethodTotal,
+    PeriodClose, BalanceSnapshot, DebtSnapshot, SplitMethodSnapshot, ArchivedExpense, ArchivedExpenseShare,
+    ExpenseChange, ChangeCompaction,
+)
+
+# Deterministic synthetic datasets for benchmarks and load tests.
+# The same arguments always produce the same users, expenses, shares, payers and dates,
+# whatever the database, so benchmark runs on different machines are comparable. With
+# several expense shards the expenses are written to their shards as the API would.
+
+DEFAULT_MIX = {'equal': 0.5, 'percentage': 0.3, 'exact': 0.2}
+DEFAULT_END_DATE = datetime.date(2024, 12, 31)
+
+
+def parse_mix(text):
+    # "equal=5,percentage=3,exact=2" -> normalized weights per split method
+    mix = {}
+    for part in text.split(','):
+        method, _, weight = part.partition('=')
+        method = method.strip()
+        if method not in dict(Expenses.SPLIT_CHOICES):
+            raise ValueError(f"Unknown split method '{method}'.")
+        try:
+            mix[method] = float(weight)
+        except ValueError:
+            raise ValueError(f"Invalid weight for '{method}'.")
+        if mix[method] < 0:
+            raise ValueError(f"Invalid weight for '{method}'.")
+    total = sum(mix.values())
+    if not total:
+        raise ValueError("At least one split method needs a positive weight.")
+    return {method: weight / total for method, weight in mix.items()}
+
+
+def parse_range(text):
+    # "2-6" -> (2, 6), "3" -> (3, 3)
+    low, _, high = text.partition('-')
+    low, high = int(low), int(high or low)
+    if low < 1 or high < low:
+        raise ValueError("Expected a range like 2-6.")
+    return low, high
+
+
+def split_integer(rng, total, parts):
+    # Split `total` into `parts` positive integers at random cut points
+    cuts = sorted(rng.sample(range(1, total), parts - 1))
+    return [high - low for low, high in zip([0] + cuts, cuts + [total])]
+
+
+def flush_dataset():
+    # Empty the expense tables of every shard, and the copies of the users and groups,
+    # with plain DELETEs; the ORM would load every row to send delete signals
+    for alias in expense_shards():
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            clear_search_index(cursor)
+            for model in (
+                ExportJob, ExpenseShare, ArchivedExpenseShare, BalanceSnapshot, DebtSnapshot, SplitMethodSnapshot,
+                PeriodClose, UserBalance, DailyUserTotal, DailySplitMethodTotal, ExpenseChange, ChangeCompaction,
+                Expenses, ArchivedExpense, GroupMembership, Group, User,
+            ):
+                cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}')
+    touch_user_table()
+    response_cache.invalidate_global_on_commit()
+
+
+def generate_expenses(rng, users, count, mix, group_size, payer_ratio, pools=None):
+    # Yield validated expense data in the shape `save_expenses` expects. With `pools`
+    # ([(group, users)]) every expense is shared among the members of a random group.
+    methods = list(mix)
+    weights = [mix[method] for method in methods]
+    group = None
+    for index in range(count):
+        method = rng.choices(methods, weights)[0]
+        if pools:
+            group, users = pools[rng.randrange(len(pools))]
+        size = min(rng.randint(*group_size), len(users))
+        members = rng.sample(users, size)
+        total_cents = rng.randint(max(100, size), 50000)
+
+        if method == 'percentage':
+            basis_points = split_integer(rng, 10000, size) if size > 1 else [10000]
+            shares = [
+                {'user': user, 'percentage': Decimal(points) / 100}
+                for user, points in zip(members, basis_points)
+            ]
+        elif method == 'exact':
+            cents = split_integer(rng, total_cents, size) if size > 1 else [total_cents]
+            shares = [{'user': user, 'amount': amount} for user, amount in zip(members, cents)]
+        else:
+            shares = [{'user': user} for user in members]
+
+        yield {
+            'description': f'Seed expense {index + 1}',
+            'total_amount': total_cents,
+            'split_method': method,
+            'paid_by': rng.choice(members) if rng.random() < payer_ratio else None,
+            'group': group,
+            'shares': shares,
+        }
+
+
+def create_groups(users, count, chunk_size):
+    # Split the users into `count` groups of consecutive users; returns [(group, members)]
+    count = min(count, len(users))
+    groups = Group.objects.bulk_create([Group(name=f'Seed Group {index}') for index in range(count)], batch_size=chunk_size)
+    pools = [(group, users[len(users) * index // count:len(users) * (index + 1) // count]) for index, group in enumerate(groups)]
+    GroupMembership.objects.bulk_create(
+        [GroupMembership(group=group, user=user) for group, members in pools for user in members],
+        batch_size=chunk_size,
+    )
+    return pools
+
+
+def seed_dataset(users, expenses, mix=None, group_size=(2, 5), payer_ratio=0.8, days=365,
+                 end_date=DEFAULT_END_DATE, seed=0, chunk_size=2000, groups=0):
+    # Insert `users` users and `expenses` expenses through the bulk write path and rebuild
+    # the balance ledger once at the end. With `groups`, the users are split into that many
+    # groups and every expense stays within one of them.
+    # Returns the number of (users, expenses, shares).
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    width = len(str(users))
+
+    with transaction.atomic():
+        created_users = User.objects.bulk_create(
+            [
+                User(
+                    email=f'seed-{seed}-user-{index:0{width}d}@example.com',
+                    name=f'Seed User {index}',
+                    mobile_number=f'9{index:09d}',
+                )
+                for index in range(users)
+            ],
+            batch_size=chunk_size,
+        )
+        touch_user_table()
+        pools = create_groups(created_users, groups, chunk_size) if groups else None
+    # Bulk inserts send no signals: the shards get their copies here
+    if is_sharded():
+        copy_to_shards(User, created_users)
+        copy_to_shards(Group, [group for group, _ in pools or []])
+
+    share_count = 0
+    expense_ids = defaultdict(list)
+    count = expenses if created_users else 0
+    items = generate_expenses(rng, created_users, count, mix, group_size, payer_ratio, pools)
+    while True:
+        chunk = [item for _, item in zip(range(chunk_size), items)]
+        if not chunk:
+            break
+        for alias, shard_chunk in shard_chunks(enumerate(chunk), chunk_size):
+            with use_shard(alias), transaction.atomic(using=alias):
+                created = save_expenses([item for _, item in shard_chunk], bulk_load=True)
+            expense_ids[alias].extend(expense.id for expense in created)
+        share_count += sum(len(item['shares']) for item in chunk)
+
+    for alias, ids in expense_ids.items():
+        with use_shard(alias):
+            spread_dates(ids, days, end_date)
+    for alias in expense_shards():
+        with use_shard(alias):
+            rebuild_ledger()
+            reset_changes()
+    return len(created_users), sum(len(ids) for ids in expense_ids.values()), share_count
+
+
+def spread_dates(expense_ids, days, end_date):
+    # `date` is set on insert; spread the expenses of the selected shard (their ids in
+    # insertion order) evenly over the last `days` days with one id-range UPDATE per day,
+    # oldest first so the (date, id) order matches the ids
+    count = len(expense_ids)
+    start_date = end_date - datetime.timedelta(days=days - 1)
+    with transaction.atomic(using=active_shard()):
+        for day in range(days):
+            low = count * day // days
+            high = count * (day + 1) // days
+            if low < high:
+                date = start_date + datetime.timedelta(days=day)
+                Expenses.objects.filter(id__gte=expense_ids[low], id__lte=expense_ids[high - 1]).update(date=date)
+                ExpenseShare.objects.filter(
+                    expense_id__gte=expense_ids[low], expense_id__lte=expense_ids[high - 1],
+                ).update(date=date)
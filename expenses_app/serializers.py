@@ -1,5 +1,30 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
 from rest_framework import serializers
-from .models import User, Expenses, ExpenseShare
+from .models import User, Group, GroupMembership, Expenses, ExpenseShare, UserBalance, ExportJob
+from .changes import decode_token
+from .search import parse_query
+from .reports import GRANULARITIES, SUMMARY_GROUPS
+from .sharding import expense_shard, use_shard
+from .ingest import BATCH_MODES, collect_group_ids, collect_user_ids, save_expenses, share_error, split_error
+from .money import format_minor, to_minor
+from .users import user_cache
+
+# Amount field for columns stored as integer minor units: accepts and renders the same
+# decimal strings as a two-place DecimalField, e.g. "12.34" <-> 1234
+class MoneyField(serializers.DecimalField):
+
+    def __init__(self, max_digits=10, **kwargs):
+        super().__init__(max_digits=max_digits, decimal_places=2, **kwargs)
+
+    def to_internal_value(self, data):
+        return to_minor(super().to_internal_value(data))
+
+    def to_representation(self, value):
+        return format_minor(value)
 
 # Serializer for User model
 class UserSerializer(serializers.ModelSerializer):
@@ -7,8 +32,66 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'email', 'name', 'mobile_number']
 
+# Serializer for a user of a bulk upsert: existing emails are updated rather than rejected,
+# so the email is not checked for uniqueness
+class UserUpsertSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'email', 'name', 'mobile_number']
+        extra_kwargs = {'email': {'validators': []}}
+
+# Serializer for the users sent to the bulk upsert endpoint
+class UserBulkSerializer(serializers.Serializer):
+    users = UserUpsertSerializer(many=True, allow_empty=False, max_length=getattr(settings, 'EXPENSES_USER_BULK_MAX_SIZE', 5000))
+
+    def validate_users(self, users):
+        counts = Counter(user['email'] for user in users)
+        duplicates = sorted(email for email, count in counts.items() if count > 1)
+        if duplicates:
+            raise serializers.ValidationError(f"Emails {', '.join(duplicates)} are listed more than once.")
+        return users
+
+# Serializer for UserBalance model
+class UserBalanceSerializer(serializers.ModelSerializer):
+    total_owed = MoneyField(max_digits=14)
+    total_paid = MoneyField(max_digits=14)
+    net_balance = MoneyField(max_digits=14)
+
+    class Meta:
+        model = UserBalance
+        fields = ['user', 'total_owed', 'expense_count', 'total_paid', 'net_balance']
+
+# Primary key field that resolves objects from a preloaded map in the context (under
+# `context_key`) when one is given, instead of running one query per value
+class PreloadedField(serializers.PrimaryKeyRelatedField):
+    context_key = None
+
+    def to_internal_value(self, data):
+        objects = self.context.get(self.context_key)
+        if objects is None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            obj = objects.get(int(data))
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if obj is None:
+            self.fail('does_not_exist', pk_value=data)
+        return obj
+
+# Users of the shares and payers, preloaded by batches
+class UserField(PreloadedField):
+    context_key = 'users'
+
+# Groups of the expenses, preloaded by batches
+class GroupField(PreloadedField):
+    context_key = 'groups'
+
 # Serializer for ExpenseShare model
 class ExpenseShareSerializer(serializers.ModelSerializer):
+    user = UserField(queryset=User.objects.all())
+    amount = MoneyField(required=False, allow_null=True)
     description = serializers.SerializerMethodField()  # Add description field from the related expense
 
     class Meta:
@@ -21,63 +104,216 @@ class ExpenseShareSerializer(serializers.ModelSerializer):
         
     def validate(self, data):
         # Validate the share based on the split method
-        split_method = self.context['split_method']
-        if split_method == 'exact' and 'amount' not in data:
-            raise serializers.ValidationError({"amount": "This field is required for the exact split method."})
-        elif split_method == 'percentage' and 'percentage' not in data:
-            raise serializers.ValidationError({"percentage": "This field is required for the percentage split method."})
-        elif split_method == 'equal' and ('amount' in data or 'percentage' in data):
-            raise serializers.ValidationError("For equal split, only the user field is required.")
+        error = share_error(self.context['split_method'], data)
+        if error is not None:
+            raise serializers.ValidationError(error)
         return data
 
 # Serializer for Expenses model
 class ExpenseSerializer(serializers.ModelSerializer):
-    shares = ExpenseShareSerializer(many=True)  # Include shares as a nested serializer
+    paid_by = UserField(queryset=User.objects.all(), required=False, allow_null=True)
+    total_amount = MoneyField()
+    group = GroupField(queryset=Group.objects.all(), required=False, allow_null=True)
+    shares = ExpenseShareSerializer(many=True, allow_empty=False)  # Include shares as a nested serializer
 
     class Meta:
         model = Expenses
-        fields = ['id', 'description', 'total_amount', 'split_method', 'date', 'shares']
+        fields = ['id', 'description', 'total_amount', 'split_method', 'date', 'paid_by', 'group', 'shares']
         
+    def to_internal_value(self, data):
+        # Resolve the payer and the share users through the user cache, with at most one
+        # query for those it misses, unless a batch preloaded them
+        if 'users' not in self.context and isinstance(data, dict):
+            self.context['users'] = user_cache.in_bulk(collect_user_ids([data]))
+        return super().to_internal_value(data)
+
     def validate(self, data):
         # Validate the entire expense based on the split method
-        split_method = data.get('split_method')
-        shares = data.get('shares', [])
-        
-        if split_method == 'percentage':
-            total_percentage = sum(share.get('percentage', 0) for share in shares)
-            if total_percentage != 100:
-                raise serializers.ValidationError("Total percentage must equal 100%.")
-        elif split_method == 'exact':
-            total_amount = sum(share.get('amount', 0) for share in shares)
-            if total_amount != data.get('total_amount', 0):
-                raise serializers.ValidationError("Total exact amounts must equal the total expense amount.")
-
+        error = split_error(data.get('split_method'), data.get('total_amount', 0), data.get('shares', []))
+        if error is not None:
+            raise serializers.ValidationError(error)
+        group = data.get('group')
+        if group is not None:
+            # Only members of the group can pay for or take part in its expenses
+            user_ids = {share['user'].pk for share in data.get('shares', [])}
+            if data.get('paid_by') is not None:
+                user_ids.add(data['paid_by'].pk)
+            outsiders = sorted(user_ids - self.group_members(group))
+            if outsiders:
+                raise serializers.ValidationError(
+                    {"group": f"Users {', '.join(map(str, outsiders))} are not members of this group."}
+                )
         return data
 
+    def group_members(self, group):
+        # Member ids of a group, shared through a `group_members` dict in the context
+        # by batches so every group is read once
+        members = self.context.get('group_members', {})
+        if group.pk not in members:
+            members[group.pk] = set(GroupMembership.objects.filter(group=group).values_list('user_id', flat=True))
+        return members[group.pk]
+
     def create(self, validated_data):
-        shares_data = validated_data.pop('shares')  # Remove shares data from validated data
-        expense = Expenses.objects.create(**validated_data)  # Create the expense
-
-        # Create shares based on the split method
-        if expense.split_method == 'equal':
-            equal_amount = expense.total_amount / len(shares_data)
-            for share_data in shares_data:
-                percentage = 100 / len(shares_data)
-                ExpenseShare.objects.create(expense=expense, user=share_data['user'], amount=equal_amount, percentage=percentage)
-        elif expense.split_method == 'exact':
-            total_amount = expense.total_amount
-            for share_data in shares_data:
-                percentage = (share_data['amount'] / total_amount) * 100
-                ExpenseShare.objects.create(expense=expense, **share_data, percentage=percentage)
-        elif expense.split_method == 'percentage':
-            for share_data in shares_data:
-                amount = expense.total_amount * (share_data['percentage'] / 100)
-                ExpenseShare.objects.create(expense=expense, user=share_data['user'], amount=amount, percentage=share_data['percentage'])
-
-        return expense
-    
+        # Create the expense and its shares in a single transaction, on their shard
+        alias = expense_shard(validated_data)
+        with use_shard(alias), transaction.atomic(using=alias):
+            return save_expenses([validated_data])[0]
+
     # Uncomment the following method if you need to customize the representation of the ExpenseSerializer
     # def to_representation(self, instance):
     #     representation = super().to_representation(instance)
     #     representation['shares'] = ExpenseShareSerializer(instance.expenseshare_set.all(), many=True, context={'split_method': instance.split_method}).data
     #     return representation
+
+# Serializer for Group model
+class GroupSerializer(serializers.ModelSerializer):
+    members = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True, required=False)
+
+    class Meta:
+        model = Group
+        fields = ['id', 'name', 'members', 'created_at']
+
+    def create(self, validated_data):
+        # Create the group and its memberships in a single transaction
+        members = {user.pk: user for user in validated_data.pop('members', [])}
+        with transaction.atomic():
+            group = Group.objects.create(**validated_data)
+            GroupMembership.objects.bulk_create([GroupMembership(group=group, user=user) for user in members.values()])
+        return group
+
+# Serializer for a user joining a group
+class GroupMemberSerializer(serializers.Serializer):
+    user = UserField(queryset=User.objects.all())
+
+# Serializer for a batch of expenses sent to the batch endpoint
+class ExpenseBatchSerializer(serializers.Serializer):
+    mode = serializers.ChoiceField(choices=BATCH_MODES, default='all_or_nothing')
+    expenses = serializers.ListField(
+        child=serializers.JSONField(),
+        allow_empty=False,
+        max_length=getattr(settings, 'EXPENSES_BATCH_MAX_SIZE', 5000),
+    )
+
+    def validate_items(self):
+        # Validate every expense on its own, resolving all referenced users and groups with
+        # one query each (none for cached users). Returns a (validated_data, errors) pair
+        # per expense.
+        items = self.validated_data['expenses']
+        users = user_cache.in_bulk(collect_user_ids(items))
+        groups = Group.objects.in_bulk(collect_group_ids(items))
+        group_members = {}
+        results = []
+        for item in items:
+            if not isinstance(item, dict):
+                results.append((None, {"non_field_errors": ["Invalid data. Expected a dictionary."]}))
+                continue
+            context = {
+                'split_method': item.get('split_method'), 'users': users,
+                'groups': groups, 'group_members': group_members,
+            }
+            serializer = ExpenseSerializer(data=item, context=context)
+            if serializer.is_valid():
+                results.append((serializer.validated_data, None))
+            else:
+                results.append((None, serializer.errors))
+        return results
+
+# Serializer for the query parameters of the read endpoints that can include closed periods
+class ArchiveQuerySerializer(serializers.Serializer):
+    include_archived = serializers.BooleanField(default=False)
+
+def include_archived(params):
+    # The validated `include_archived` flag of a request's query parameters
+    serializer = ArchiveQuerySerializer(data=params)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data['include_archived']
+
+# Serializer for the query parameters of the period summary report
+class SummaryQuerySerializer(ArchiveQuerySerializer):
+    granularity = serializers.ChoiceField(choices=GRANULARITIES, default='month')
+    group_by = serializers.ChoiceField(choices=SUMMARY_GROUPS, default='user')
+    user = serializers.IntegerField(required=False)
+
+    def get_fields(self):
+        # `from` and `to` cannot be declared as class attributes
+        fields = super().get_fields()
+        fields['from'] = serializers.DateField(required=False)
+        fields['to'] = serializers.DateField(required=False)
+        return fields
+
+    def validate(self, data):
+        if data.get('from') and data.get('to') and data['from'] > data['to']:
+            raise serializers.ValidationError("from must not be after to.")
+        if data.get('user') is not None and data['group_by'] != 'user':
+            raise serializers.ValidationError("user can only be given with group_by=user.")
+        return data
+
+# Serializer for the query parameters of the change feed
+class ChangesQuerySerializer(serializers.Serializer):
+    since = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(min_value=1, required=False)
+
+    def validate_since(self, value):
+        try:
+            return decode_token(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+    def validate_page_size(self, value):
+        return min(value, getattr(settings, 'EXPENSES_MAX_PAGE_SIZE', 1000))
+
+# Serializer for the query parameters of the expense search
+class SearchQuerySerializer(ArchiveQuerySerializer):
+    q = serializers.CharField(max_length=255)
+    user = serializers.IntegerField(required=False)
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    page_size = serializers.IntegerField(min_value=1, required=False)
+
+    def validate_q(self, value):
+        # The words to search for, as parsed by `parse_query`
+        try:
+            return parse_query(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+    def validate_page_size(self, value):
+        return min(value, getattr(settings, 'EXPENSES_MAX_PAGE_SIZE', 1000))
+
+    def validate(self, data):
+        if data.get('date_from') and data.get('date_to') and data['date_from'] > data['date_to']:
+            raise serializers.ValidationError("date_from must not be after date_to.")
+        return data
+
+# Serializer for ExportJob model
+class ExportJobSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+    download = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ExportJob
+        fields = [
+            'id', 'format', 'date_from', 'date_to', 'user', 'status', 'progress', 'rows_written',
+            'rows_total', 'size', 'error', 'created_at', 'finished_at', 'download',
+        ]
+        read_only_fields = ['status', 'rows_written', 'rows_total', 'size', 'error', 'created_at', 'finished_at']
+
+    def get_progress(self, obj):
+        # Percentage of the rows written so far
+        if obj.status == 'done':
+            return 100.0
+        if not obj.rows_total:
+            return 0.0
+        return round(100 * min(obj.rows_written / obj.rows_total, 1), 1)
+
+    def get_download(self, obj):
+        if obj.status != 'done':
+            return None
+        url = reverse('export-download', args=[obj.id])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
+
+    def validate(self, data):
+        if data.get('date_from') and data.get('date_to') and data['date_from'] > data['date_to']:
+            raise serializers.ValidationError("date_from must not be after date_to.")
+        return data
@@ -0,0 +1,71 @@
+import heapq
+from collections import defaultdict
+
+from .models import UserBalance
+from .money import format_minor
+from .sharding import gather
+
+
+def load_net_balances():
+    # Read every non-zero net balance (integer cents) from the ledger as parallel
+    # arrays; the aggregation itself lives in the database. The ledgers of several expense
+    # shards are read in parallel and added up.
+    shards = gather(load_shard_net_balances)
+    if len(shards) == 1:
+        return shards[0]
+    totals = defaultdict(int)
+    for user_ids, cents in shards:
+        for user_id, amount in zip(user_ids, cents):
+            totals[user_id] += amount
+    user_ids = sorted(user_id for user_id, amount in totals.items() if amount)
+    return user_ids, [totals[user_id] for user_id in user_ids]
+
+
+def load_shard_net_balances(alias):
+    user_ids = []
+    cents = []
+    rows = (
+        UserBalance.objects.exclude(net_balance=0)
+        .values_list('user_id', 'net_balance')
+        .iterator(chunk_size=5000)
+    )
+    for user_id, net_balance in rows:
+        user_ids.append(user_id)
+        cents.append(net_balance)
+    return user_ids, cents
+
+
+def settle(user_ids, cents):
+    # Turn net balances into a short list of transfers.
+    # Greedy matching: the largest debtor always pays the largest creditor, using
+    # two max-heaps. Produces at most n - 1 transfers for n users in O(n log n).
+    creditors = [(-amount, user_id) for user_id, amount in zip(user_ids, cents) if amount > 0]
+    debtors = [(amount, user_id) for user_id, amount in zip(user_ids, cents) if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    append = transfers.append
+    while creditors and debtors:
+        credit, creditor = creditors[0]
+        debt, debtor = debtors[0]
+        amount = min(-credit, -debt)
+        append((debtor, creditor, amount))
+        # Replace the top of a heap in place when that side is not fully settled yet
+        if -credit > amount:
+            heapq.heapreplace(creditors, (credit + amount, creditor))
+        else:
+            heapq.heappop(creditors)
+        if -debt > amount:
+            heapq.heapreplace(debtors, (debt + amount, debtor))
+        else:
+            heapq.heappop(debtors)
+    return transfers
+
+
+def compute_settlements():
+    # Settle the current ledger and return transfers with decimal amounts
+    return [
+        {"from_user": debtor, "to_user": creditor, "amount": format_minor(amount)}
+        for debtor, creditor, amount in settle(*load_net_balances())
+    ]
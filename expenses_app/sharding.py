@@ -0,0 +1,266 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from contextvars import copy_context
+from itertools import islice
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+
+from .models import Expenses, ExpenseShare
+from .routers import PRIMARY, current_shard, expense_shards
+
+# Expense shards.
+# With several aliases in EXPENSES_SHARDS, every expense lives on one of them together with
+# its shares, its archived copy, its change feed entries and the ledger rows and snapshots
+# it adds up to. Users and groups are written to the default database and copied to every
+# other shard, so that expenses can reference them anywhere.
+#
+# The expenses of a group go to the shard of the group, the others to the shard of their
+# payer (of their first participant without one): the id modulo the number of shards.
+# Every shard hands out expense and share ids from its own range of SHARD_ID_SPAN ids, so
+# ids are unique across shards and sort by shard first: keep the order of EXPENSES_SHARDS
+# once expenses were written.
+#
+# Reads that span the shards run their queries on every shard in parallel, on a pool of
+# EXPENSES_SHARD_WORKERS threads, and merge the results in the order one database would
+# return them. With a single shard everything runs in the calling thread as before.
+
+SHARD_ID_SPAN = 10 ** 12
+
+# Tables whose ids are handed out by the shards (archived rows keep the ids of the live ones)
+SHARD_ID_MODELS = (Expenses, ExpenseShare)
+
+# Databases `reserve_shard_ids` can start the id sequences of (see checks.py)
+SHARD_ID_VENDORS = ('sqlite', 'postgresql')
+
+# Rows read ahead per chunk, and chunks buffered per shard, by the threads of `ShardStream`
+STREAM_CHUNK_SIZE = 2000
+STREAM_BUFFER = 2
+
+
+def is_sharded():
+    return len(expense_shards()) > 1
+
+
+@contextmanager
+def use_shard(alias):
+    # Send the queries of the expense tables to `alias` within the block
+    token = current_shard.set(alias)
+    try:
+        yield alias
+    finally:
+        current_shard.reset(token)
+
+
+def shard_for(key):
+    # The shard of a group or user id
+    shards = expense_shards()
+    return shards[key % len(shards)]
+
+
+def group_shard(group_id):
+    return shard_for(group_id)
+
+
+def expense_shard(data):
+    # The shard of a validated expense (the validated data of ExpenseSerializer)
+    if data.get('group') is not None:
+        return group_shard(data['group'].pk)
+    if data.get('paid_by') is not None:
+        return shard_for(data['paid_by'].pk)
+    shares = data.get('shares') or []
+    return shard_for(shares[0]['user'].pk) if shares else PRIMARY
+
+
+def id_shard(pk):
+    # The shard an expense or share id was handed out by
+    shards = expense_shards()
+    return shards[pk // SHARD_ID_SPAN] if len(shards) > 1 else PRIMARY
+
+
+def on_shard(queryset, alias):
+    # `queryset` bound to a shard. Querysets of the default shard are left to the routers,
+    # so that they may still read from a replica.
+    return queryset if alias == PRIMARY else queryset.using(alias)
+
+
+@contextmanager
+def atomic_on(aliases):
+    # One transaction on each of `aliases`. They commit one after the other on the way out,
+    # so a failing commit (not a failing write) can leave the earlier shards committed.
+    with ExitStack() as stack:
+        for alias in sorted(aliases):
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def run_in_worker(function, *args):
+    # Pool threads keep their connections between tasks, within CONN_MAX_AGE like
+    # request threads
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+def run_on_shard(function, alias):
+    with use_shard(alias):
+        return function(alias)
+
+
+# Bounded pool of threads running the per-shard queries of a read, created on first use
+class ShardPool:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def map(self, function, items):
+        # function(item) for every item in parallel, in the order of `items`. The calls see
+        # the context of the caller (replica routing, query recording). Without shards
+        # they run in the calling thread.
+        items = list(items)
+        if len(items) < 2 or not is_sharded():
+            return [function(item) for item in items]
+        with self.lock:
+            if self.executor is None:
+                workers = getattr(settings, 'EXPENSES_SHARD_WORKERS', None) or len(expense_shards())
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='expenses-shard')
+        futures = [
+            self.executor.submit(copy_context().run, run_in_worker, function, item)
+            for item in items
+        ]
+        return [future.result() for future in futures]
+
+
+shard_pool = ShardPool()
+
+
+def gather(function, shards=None):
+    # function(alias) on every shard (or on `shards`), with the queries of the expense
+    # tables sent to that shard; the results in shard order
+    shards = expense_shards() if shards is None else shards
+    return shard_pool.map(lambda alias: run_on_shard(function, alias), shards)
+
+
+def fetch_all(querysets):
+    # Evaluate querysets bound to different shards in parallel
+    return shard_pool.map(list, querysets)
+
+
+def put_chunk(chunks, stopped, item):
+    # Hand a chunk to the consumer of a ShardStream; False once the consumer went away
+    while not stopped.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def read_ahead(function, alias, chunk_size, chunks, stopped):
+    # Thread of a ShardStream. It holds no reference to the stream, so that a stream
+    # dropped by its consumer is collected and stops it.
+    try:
+        with use_shard(alias):
+            rows = iter(function(alias))
+            while chunk := list(islice(rows, chunk_size)):
+                if not put_chunk(chunks, stopped, chunk):
+                    return
+        put_chunk(chunks, stopped, None)
+    except Exception as e:
+        put_chunk(chunks, stopped, e)
+    finally:
+        # The thread ends here, and its connections with it
+        connections.close_all()
+
+
+def drain(chunks):
+    # Rows of the chunks handed over by `read_ahead`
+    while (item := chunks.get()) is not None:
+        if isinstance(item, Exception):
+            raise item
+        yield from item
+
+
+# Rows of `function(alias)` read ahead in chunks by a thread of its own, so that the
+# streams of every shard are read in parallel while the caller consumes one of them.
+# Streams do not use the pool: they hold their thread until they are consumed, and
+# concurrent streamed responses would wait for each other's threads.
+class ShardStream:
+
+    def __init__(self, function, alias, chunk_size=STREAM_CHUNK_SIZE, buffer=STREAM_BUFFER):
+        self.chunks = queue.Queue(maxsize=buffer)
+        self.stopped = threading.Event()
+        self.rows = drain(self.chunks)
+        threading.Thread(
+            target=copy_context().run, args=(read_ahead, function, alias, chunk_size, self.chunks, self.stopped),
+            name=f'expenses-shard-stream-{alias}', daemon=True,
+        ).start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.rows)
+
+    def close(self):
+        self.stopped.set()
+
+    def __del__(self):
+        self.stopped.set()
+
+
+def shard_streams(function, shards=None):
+    # One ShardStream of function(alias) per shard, all of them started
+    shards = expense_shards() if shards is None else shards
+    return [ShardStream(function, alias) for alias in shards]
+
+
+def copy_to_shards(model, objects):
+    # Insert or update copies of reference rows (users, groups) on every shard but the
+    # default one
+    objects = list(objects)
+    if not objects:
+        return
+    fields = model._meta.concrete_fields
+    updated = [field.name for field in fields if not field.primary_key]
+    for alias in expense_shards()[1:]:
+        copies = [model(**{field.attname: getattr(obj, field.attname) for field in fields}) for obj in objects]
+        model.objects.using(alias).bulk_create(copies, update_conflicts=True, unique_fields=['id'], update_fields=updated)
+
+
+def delete_from_shards(model, ids):
+    # Delete the copies of reference rows, and what they cascade to on each shard
+    for alias in expense_shards()[1:]:
+        model.objects.using(alias).filter(id__in=list(ids)).delete()
+
+
+def reserve_shard_ids(alias):
+    # Start the id sequences of a shard at the beginning of its range. Only moves them
+    # forward, so it can run after every migration.
+    shards = expense_shards()
+    if alias not in shards or shards.index(alias) == 0:
+        return
+    start = shards.index(alias) * SHARD_ID_SPAN
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        for model in SHARD_ID_MODELS:
+            table = model._meta.db_table
+            if connection.vendor == 'sqlite':
+                cursor.execute(
+                    'INSERT INTO sqlite_sequence (name, seq) SELECT %s, 0 '
+                    'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                    [table, table],
+                )
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s', [start, table, start])
+            elif connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, 'id'])
+                sequence = cursor.fetchone()[0]
+                cursor.execute(f'SELECT setval(%s, GREATEST(%s, last_value)) FROM {sequence}', [sequence, start])
+            else:
+                raise NotImplementedError(f"Expense shards are not supported on {connection.vendor}.")
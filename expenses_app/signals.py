@@ -0,0 +1,113 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate, post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from .cache import response_cache
+from .changes import record_changes
+from .conditional import touch_user_table
+from .database import apply_sqlite_pragmas
+from .ledger import refresh_daily_totals, touch_users
+from .middleware import install_query_recorder
+from .models import User, Group, Expenses, ExpenseShare
+from .routers import PRIMARY
+from .sharding import copy_to_shards, delete_from_shards, is_sharded, reserve_shard_ids, use_shard
+from .users import user_cache
+
+# Writes made outside the expense write path (admin, shell, cascades) invalidate the
+# response cache, move the users' ETags on, feed the change log and recompute the per-day
+# report totals here. Bulk inserts from the write path do not send these signals and take
+# care of all four themselves.
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, using, **kwargs):
+    response_cache.invalidate_users_on_commit([instance.pk])
+    if using == PRIMARY:
+        # Balance sheets and exports embed user names (the copies on the other shards
+        # are not the ones they read)
+        touch_user_table()
+    # Dropped again once committed, in case a concurrent request cached the old row
+    pk = instance.pk
+    user_cache.invalidate([pk])
+    transaction.on_commit(lambda: user_cache.invalidate([pk]))
+
+@receiver(post_save, sender=Expenses)
+@receiver(post_delete, sender=Expenses)
+def invalidate_expense(sender, instance, using, **kwargs):
+    # Listings of every participant embed the expense description. The ledger and the
+    # feed are those of the shard the expense was written to.
+    with use_shard(using):
+        if kwargs.get('created') is False:
+            user_ids = list(instance.shares.values_list('user_id', flat=True))
+            touch_users(user_ids)
+            record_changes((user_id, instance.pk) for user_id in user_ids)
+            response_cache.invalidate_users_on_commit(user_ids)
+        response_cache.invalidate_global_on_commit()
+
+@receiver(pre_save, sender=Expenses)
+def remember_date(sender, instance, using, **kwargs):
+    # The day an edited expense is moved away from, if any
+    instance.previous_date = None
+    if instance.pk is not None:
+        instance.previous_date = Expenses.objects.using(using).filter(pk=instance.pk).values_list('date', flat=True).first()
+
+@receiver(post_save, sender=Expenses)
+def sync_shares(sender, instance, created, using, **kwargs):
+    # Shares carry a copy of their expense's group and date, which may have been changed.
+    # The per-day totals of the day it is on and of the day it left are recomputed.
+    with use_shard(using):
+        if not created:
+            instance.shares.update(group_id=instance.group_id, date=instance.date)
+        refresh_daily_totals([instance.date, getattr(instance, 'previous_date', None)])
+
+@receiver(post_delete, sender=Expenses)
+@receiver(post_save, sender=ExpenseShare)
+@receiver(post_delete, sender=ExpenseShare)
+def refresh_day(sender, instance, using, **kwargs):
+    with use_shard(using):
+        refresh_daily_totals([instance.date])
+
+@receiver(pre_save, sender=ExpenseShare)
+def copy_expense_fields(sender, instance, **kwargs):
+    instance.group_id = instance.expense.group_id
+    instance.date = instance.expense.date
+
+@receiver(post_save, sender=ExpenseShare)
+@receiver(post_delete, sender=ExpenseShare)
+def invalidate_share(sender, instance, using, **kwargs):
+    with use_shard(using):
+        touch_users([instance.user_id])
+        record_changes([(instance.user_id, instance.expense_id)])
+        response_cache.invalidate_users_on_commit([instance.user_id])
+        response_cache.invalidate_global_on_commit()
+
+# Users and groups are written to the default database and copied to the other expense
+# shards once committed (see sharding.py)
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Group)
+def copy_reference_row(sender, instance, using, **kwargs):
+    if is_sharded() and using == PRIMARY:
+        transaction.on_commit(lambda: copy_to_shards(sender, [instance]), using=using)
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Group)
+def delete_reference_row(sender, instance, using, **kwargs):
+    if is_sharded() and using == PRIMARY:
+        pk = instance.pk
+        transaction.on_commit(lambda: delete_from_shards(sender, [pk]), using=using)
+
+# Every expense shard hands out ids from its own range
+@receiver(post_migrate)
+def reserve_ids(sender, using, **kwargs):
+    if sender.name == 'expenses_app':
+        reserve_shard_ids(using)
+
+# Every new database connection reports its queries to the request instrumentation
+@receiver(connection_created)
+def record_connection_queries(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    apply_sqlite_pragmas(connection)
@@ -0,0 +1,54 @@
+import json
+
+from django.core.cache import cache
+from django.urls import reverse
+from rest_framework import status
+from ..models import User, Expenses
+from ..sharding import id_shard
+
+USER_NAMES = ['User One', 'User Two', 'User Three', 'User Four']
+
+
+# Users and expenses shared by the API test cases. Creates `user_count` users, available
+# as self.user1, self.user2, ... and as the self.users list.
+class ExpenseTestMixin:
+    user_count = 3
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.users = [
+            User.objects.create(email=f'user{index}@example.com', name=name, mobile_number=f'123456789{index - 1}')
+            for index, name in enumerate(USER_NAMES[:self.user_count], start=1)
+        ]
+        for index, user in enumerate(self.users, start=1):
+            setattr(self, f'user{index}', user)
+
+    def expense_data(self, description='Dinner', total_amount='100.00', users=None, paid_by=None,
+                     split_method='equal', shares=None, **fields):
+        # The body of an expense split between `users` (user1 and user2 by default), with
+        # the fields of each share (amount, percentage) in `shares`
+        users = users if users is not None else [self.user1, self.user2]
+        shares = shares if shares is not None else [{}] * len(users)
+        data = {
+            'description': description, 'total_amount': total_amount, 'split_method': split_method,
+            'shares': [{'user': user.id, **share} for user, share in zip(users, shares)], **fields,
+        }
+        if paid_by is not None:
+            data['paid_by'] = paid_by.id
+        return data
+
+    def post_expense(self, data):
+        # Encoded here, for the clients of both APITestCase and TransactionTestCase
+        return self.client.post(reverse('create-expense'), json.dumps(data), content_type='application/json')
+
+    def create_expense(self, *args, date=None, **kwargs):
+        # Create an expense through the API and return it, moved to `date` when given
+        response = self.post_expense(self.expense_data(*args, **kwargs))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+        expense = Expenses.objects.using(id_shard(response.data['id'])).get(id=response.data['id'])
+        if date is not None:
+            # `date` is set on creation; saving again also moves the shares' copy of it
+            expense.date = date
+            expense.save()
+        return expense
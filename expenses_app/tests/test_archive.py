@@ -0,0 +1,155 @@
+import datetime
+import io
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..archive import close_period
+from ..ledger import compute_balances, rebuild_daily_totals
+from ..models import (
+    User, Expenses, ExpenseShare, ArchivedExpense, ArchivedExpenseShare, BalanceSnapshot, PeriodClose, DailyUserTotal,
+    DailySplitMethodTotal,
+)
+
+# Test case for closing periods and reading archived expenses
+@override_settings(EXPENSES_PAGE_SIZE=2)
+class PeriodCloseTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            User.objects.create(email=f'user{index}@example.com', name=f'User {index}', mobile_number='1234567890')
+            for index in range(3)
+        ]
+        self.group = self.client.post(reverse('create-group'), {
+            'name': 'Flat', 'members': [user.id for user in self.users],
+        }, format='json').data['id']
+        expenses = [
+            ('2024-01-10', '30.00', 0, [0, 1, 2], self.group),
+            ('2024-02-10', '10.00', 1, [0, 1], None),
+            ('2024-03-10', '20.00', 2, [1, 2], self.group),
+            ('2024-04-10', '40.00', 0, [0, 2], None),
+        ]
+        for day, total_amount, payer, members, group in expenses:
+            response = self.client.post(reverse('create-expense'), {
+                'description': f'Expense {day}', 'total_amount': total_amount, 'split_method': 'equal',
+                'paid_by': self.users[payer].id, 'group': group,
+                'shares': [{'user': self.users[index].id} for index in members],
+            }, format='json')
+            expense = Expenses.objects.get(id=response.data['id'])
+            expense.date = datetime.date.fromisoformat(day)
+            expense.save()
+
+    def get(self, name, *args, **params):
+        response = self.client.get(reverse(name, args=args), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def descriptions(self, name, *args, **params):
+        # Descriptions of every page of a listing
+        descriptions = []
+        response = self.get(name, *args, **params)
+        while True:
+            descriptions += [row['description'] for row in response.data['results']]
+            if response.data['next'] is None:
+                return descriptions
+            response = self.client.get(response.data['next'])
+
+    def close(self, cutoff):
+        # Run the cache invalidation of the close, which waits for the commit
+        with self.captureOnCommitCallbacks(execute=True):
+            return close_period(datetime.date.fromisoformat(cutoff))
+
+    def whole_history_reports(self):
+        return [self.get(name).data for name in ('report-user-totals', 'report-pairwise-debts', 'report-split-methods')]
+
+    def sheet(self, **params):
+        return b''.join(self.get('download-balance-sheet', **params).streaming_content)
+
+    def test_close_moves_expenses_and_snapshots_balances(self):
+        balances = compute_balances()
+        period = self.close('2024-02-29')
+        self.assertEqual((period.expense_count, period.share_count), (2, 5))
+        self.assertEqual(list(ArchivedExpense.objects.order_by('id').values_list('description', flat=True)),
+                         ['Expense 2024-01-10', 'Expense 2024-02-10'])
+        self.assertEqual(ExpenseShare.objects.count(), 4)
+        self.assertEqual(set(ArchivedExpenseShare.objects.values_list('group_id', flat=True)), {self.group, None})
+
+        snapshot = BalanceSnapshot.objects.get(period=period, user=self.users[0])
+        self.assertEqual((snapshot.total_owed, snapshot.total_paid, snapshot.net_balance, snapshot.share_count), (1500, 3000, 1500, 2))
+        # Live balances are the snapshot plus the open period
+        self.assertEqual(compute_balances(), balances)
+        output = io.StringIO()
+        call_command('rebuild_balances', dry_run=True, stdout=output)
+        self.assertIn('0 drifted', output.getvalue())
+
+    def test_periods_close_one_after_another(self):
+        balances = compute_balances()
+        reports = self.whole_history_reports()
+        self.close('2024-01-31')
+        # Debts of the snapshot are netted against those of the open period
+        self.assertEqual(self.whole_history_reports(), reports)
+        # Moved back to a day of the closed period, which already has archived totals
+        expense = Expenses.objects.get(description='Expense 2024-02-10')
+        expense.date = datetime.date(2024, 1, 10)
+        expense.save()
+        output = io.StringIO()
+        call_command('close_period', '2024-03-31', stdout=output)
+        self.assertIn('archived 2 expenses and 4 shares', output.getvalue())
+        self.assertEqual(Expenses.objects.count(), 1)
+        self.assertEqual(compute_balances(), balances)
+        self.assertEqual(self.whole_history_reports(), reports)
+        summary = self.get('report-summary', group_by='split_method', granularity='day', include_archived='true')
+        self.assertEqual(summary.data['rows'][0], {'period': '2024-01-10', 'split_method': 'equal', 'total': '40.00', 'count': 2})
+        def rollups():
+            return [
+                sorted(DailyUserTotal.objects.values_list('date', 'user_id', 'archived', 'total', 'count')),
+                sorted(DailySplitMethodTotal.objects.values_list('date', 'split_method', 'archived', 'total', 'count')),
+            ]
+        maintained = rollups()
+        rebuild_daily_totals()
+        self.assertEqual(rollups(), maintained)
+
+        with self.assertRaisesMessage(CommandError, 'The cutoff must be after 2024-03-31'):
+            call_command('close_period', '2024-03-01')
+        with self.assertRaisesMessage(CommandError, 'The cutoff must be in the past'):
+            call_command('close_period', datetime.date.today().isoformat())
+        self.assertEqual(PeriodClose.objects.count(), 2)
+
+    def test_listings_include_archived_expenses_on_request(self):
+        everything = self.descriptions('overall-expenses')
+        user_shares = self.descriptions('user-expenses', self.users[0].id)
+        sheet = self.sheet()
+        self.close('2024-02-29')
+
+        self.assertEqual(self.descriptions('overall-expenses'), everything[2:])
+        self.assertEqual(self.descriptions('overall-expenses', include_archived='true'), everything)
+        self.assertEqual(self.descriptions('user-expenses', self.users[0].id), ['Expense 2024-04-10'])
+        self.assertEqual(self.descriptions('user-expenses', self.users[0].id, include_archived='true'), user_shares)
+        response = self.get('overall-expenses', include_archived='true')
+        self.assertEqual(len(response.data['results'][0]['shares']), 3)
+
+        self.assertNotIn(b'Expense 2024-01-10', self.sheet())
+        self.assertEqual(self.sheet(include_archived='true'), sheet)
+        response = self.client.get(reverse('overall-expenses'), {'include_archived': 'maybe'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_reports_over_closed_periods(self):
+        totals = self.get('report-user-totals').data
+        debts = self.get('report-pairwise-debts').data
+        split_methods = self.get('report-split-methods').data
+        summary = self.get('report-summary', **{'from': '2024-01-01'}).data['rows']
+        group_balances = self.get('group-balances', self.group).data
+        self.close('2024-02-29')
+
+        # User totals, pairwise debts, split methods and group balances cover the whole history either way
+        for name, data in [('report-user-totals', totals), ('report-pairwise-debts', debts), ('report-split-methods', split_methods)]:
+            self.assertEqual(self.get(name).data, data)
+            self.assertEqual(self.get(name, include_archived='true').data, data)
+        self.assertEqual(self.get('group-balances', self.group).data, group_balances)
+        # The summary covers the open period unless asked otherwise
+        self.assertEqual(len(self.get('report-summary', **{'from': '2024-01-01'}).data['rows']), 4)
+        self.assertEqual(self.get('report-summary', **{'from': '2024-01-01', 'include_archived': 'true'}).data['rows'], summary)
@@ -0,0 +1,50 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..models import Expenses, ExpenseShare, UserBalance
+from .base import ExpenseTestMixin
+
+# Test case for the per-user balance ledger
+class UserBalanceTest(ExpenseTestMixin, APITestCase):
+
+    def test_balance_follows_created_expenses(self):
+        self.create_expense('Dinner', 3000, self.users)
+        self.create_expense('Ride', 2000, split_method='exact', shares=[{'amount': 1500}, {'amount': 500}])
+        url = reverse('user-balance', args=[self.user1.id])
+        with self.assertNumQueries(1):  # A balance read is a single row lookup
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_owed'], '2500.00')
+        self.assertEqual(response.data['expense_count'], 2)
+
+    def test_balance_of_user_without_expenses(self):
+        response = self.client.get(reverse('user-balance', args=[self.user3.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_owed'], '0.00')
+
+    def test_balance_of_unknown_user(self):
+        response = self.client.get(reverse('user-balance', args=[9999]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rebuild_balances_reports_and_fixes_drift(self):
+        self.create_expense('Dinner', 100)
+        # Shares written behind the ledger's back make it drift
+        expense = Expenses.objects.create(description='Manual', total_amount=4000, split_method='exact')
+        ExpenseShare.objects.create(expense=expense, user=self.user3, amount=4000, percentage=100)
+
+        out = StringIO()
+        call_command('rebuild_balances', '--dry-run', stdout=out)
+        self.assertIn('3 balances recomputed, 1 drifted', out.getvalue())
+        self.assertFalse(UserBalance.objects.filter(user=self.user3).exists())
+
+        out = StringIO()
+        call_command('rebuild_balances', stdout=out)
+        self.assertIn('1 drifted', out.getvalue())
+        self.assertEqual(UserBalance.objects.get(user=self.user3).total_owed, 4000)
+
+        out = StringIO()
+        call_command('rebuild_balances', stdout=out)
+        self.assertIn('0 drifted', out.getvalue())
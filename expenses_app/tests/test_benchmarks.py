@@ -0,0 +1,105 @@
+import io
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+from ..ledger import LEDGER_FIELDS, compute_balances
+from ..models import User, Expenses, ExpenseShare, UserBalance
+from ..seeding import flush_dataset, parse_mix, seed_dataset
+from ..urls import urlpatterns
+
+# Test case for the synthetic dataset generator
+class SeedDatasetTest(TestCase):
+
+    def snapshot(self):
+        # Dataset contents with database ids replaced by user emails
+        emails = dict(User.objects.values_list('id', 'email'))
+        expenses = {
+            expense.id: (expense.description, expense.total_amount, expense.split_method, expense.date, emails.get(expense.paid_by_id))
+            for expense in Expenses.objects.all()
+        }
+        shares = sorted(
+            (expenses[share.expense_id][0], emails[share.user_id], share.amount, share.percentage)
+            for share in ExpenseShare.objects.all()
+        )
+        return sorted(expenses.values()), shares
+
+    def test_same_seed_same_dataset(self):
+        seed_dataset(20, 100, seed=3)
+        first = self.snapshot()
+        flush_dataset()
+        seed_dataset(20, 100, seed=3)
+        self.assertEqual(self.snapshot(), first)
+        self.assertEqual(len(first[0]), 100)
+
+    def test_counts_and_ledger(self):
+        users, expenses, shares = seed_dataset(10, 50, group_size=(2, 4), seed=1)
+        self.assertEqual((users, expenses, shares), (10, 50, ExpenseShare.objects.count()))
+        self.assertTrue(100 <= shares <= 200)
+        stored = {row['user_id']: {field: row[field] for field in LEDGER_FIELDS} for row in UserBalance.objects.values('user_id', *LEDGER_FIELDS)}
+        self.assertEqual(stored, compute_balances())
+
+    def test_split_method_mix_and_dates(self):
+        seed_dataset(5, 30, mix=parse_mix('exact=1'), days=10, seed=2)
+        self.assertEqual(set(Expenses.objects.values_list('split_method', flat=True)), {'exact'})
+        self.assertEqual(Expenses.objects.values('date').distinct().count(), 10)
+
+    def test_invalid_mix(self):
+        with self.assertRaises(ValueError):
+            parse_mix('equal=1,split=2')
+        with self.assertRaises(ValueError):
+            parse_mix('equal=0')
+
+# Test case for the route benchmark command
+class BenchCommandTest(TestCase):
+
+    def setUp(self):
+        handle, self.output = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.output)
+
+    def bench(self, **options):
+        call_command('bench', sizes='5x20', requests=2, in_place=True, output=self.output, stdout=io.StringIO(), **options)
+        with open(self.output) as f:
+            return json.load(f)
+
+    def test_every_route_is_measured(self):
+        results = self.bench()
+        routes = results['sizes']['5x20']['routes']
+        self.assertEqual(set(routes), {pattern.name for pattern in urlpatterns})
+        for summary in routes.values():
+            self.assertEqual(summary['requests'], 2)
+            self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+            self.assertTrue(all(status < 500 for status in summary['status']))
+
+    def test_regression_against_baseline_fails(self):
+        baseline = self.bench(routes='overall-expenses')
+        baseline['sizes']['5x20']['routes']['overall-expenses']['queries'] -= 1
+        with open(self.output, 'w') as f:
+            json.dump(baseline, f)
+        with self.assertRaises(CommandError):
+            self.bench(routes='overall-expenses', baseline=self.output)
+
+# Test case for the write concurrency benchmark, which runs on scratch database files
+class BenchmarkWritesTest(TransactionTestCase):
+
+    def test_profiles_are_compared(self):
+        output = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'writes.json')
+            call_command(
+                'benchmark_writes', seconds=0.3, writers=2, readers=1, users=5, expenses=10,
+                output=path, stdout=output,
+            )
+            with open(path) as f:
+                results = json.load(f)
+        self.assertEqual(list(results), ['default', 'tuned'])
+        self.assertGreater(results['tuned']['writes']['requests'], 0)
+        self.assertIn('the writes per second of default', output.getvalue())
+        # The test database was left alone
+        self.assertFalse(User.objects.exists())
@@ -0,0 +1,73 @@
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from ..cache import response_cache
+from ..models import Expenses, ExpenseShare
+from .base import ExpenseTestMixin
+
+# Test case for the versioned response cache
+class ResponseCacheTest(ExpenseTestMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        response_cache.reset_stats()
+
+    def create_expense(self, *args, **kwargs):
+        # Versions are bumped when the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            return super().create_expense(*args, **kwargs)
+
+    def test_cache_hit_skips_the_database(self):
+        self.create_expense(users=[self.user1])
+        url = reverse('user-expenses', args=[self.user1.id])
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(response_cache.stats(), {'hits': 1, 'misses': 1})
+
+        url = reverse('user-detail', args=[self.user1.id])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['email'], 'user1@example.com')
+
+    def test_create_only_invalidates_involved_users(self):
+        self.create_expense(users=[self.user1])
+        self.create_expense(users=[self.user2])
+        url1 = reverse('user-expenses', args=[self.user1.id])
+        url2 = reverse('user-expenses', args=[self.user2.id])
+        self.client.get(url1)
+        self.client.get(url2)
+
+        self.create_expense(users=[self.user1, self.user3])
+        with self.assertNumQueries(0):  # User two was not involved
+            self.client.get(url2)
+        response = self.client.get(url1)  # User one's listing was invalidated
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_overall_listing_caches_full_pages_only(self):
+        for _ in range(3):
+            self.create_expense(users=[self.user1])
+        url = reverse('overall-expenses')
+        self.client.get(url, {'page_size': 2})
+        with self.assertNumQueries(2):  # Only the ETag / Last-Modified validators
+            self.client.get(url, {'page_size': 2})
+
+        # The last page is always read from the database so new expenses show up
+        last_page = self.client.get(url, {'page_size': 5})
+        self.create_expense(users=[self.user2])
+        response = self.client.get(url, {'page_size': 5})
+        self.assertEqual(len(response.data['results']), len(last_page.data['results']) + 1)
+
+    def test_direct_writes_invalidate_through_signals(self):
+        url = reverse('user-expenses', args=[self.user3.id])
+        self.assertEqual(self.client.get(url).data['results'], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            expense = Expenses.objects.create(description='Manual', total_amount=4000, split_method='exact')
+            ExpenseShare.objects.create(expense=expense, user=self.user3, amount=4000, percentage=100)
+        self.assertEqual(len(self.client.get(url).data['results']), 1)
+
+    def test_cache_stats_endpoint(self):
+        self.client.get(reverse('user-detail', args=[self.user1.id]))
+        response = self.client.get(reverse('cache-stats'))
+        self.assertEqual(response.data, {'hits': 0, 'misses': 1})
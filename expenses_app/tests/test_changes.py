@@ -0,0 +1,104 @@
+import datetime
+import io
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..archive import close_period
+from ..changes import compact_changes, reset_changes
+from ..models import ExpenseChange, ChangeCompaction
+from .base import ExpenseTestMixin
+
+# Test case for the change feed of the user listings
+@override_settings(EXPENSES_CHANGES_SETTLE_SECONDS=0)
+class ChangeFeedTest(ExpenseTestMixin, APITestCase):
+
+    user_count = 2
+
+    def setUp(self):
+        super().setUp()
+        self.token = self.sync(self.user2)['token']
+
+    def sync(self, user, expected_status=status.HTTP_200_OK, **params):
+        response = self.client.get(reverse('user-changes', args=[user.id]), params)
+        self.assertEqual(response.status_code, expected_status)
+        return response.data
+
+    def test_only_the_changes_since_the_token(self):
+        self.assertEqual(self.sync(self.user2, since=self.token)['changed'], [])
+        dinner = self.create_expense('Dinner')
+        data = self.sync(self.user2, since=self.token)
+        self.assertEqual(data['changed'], [{
+            'expense': dinner.id, 'user': self.user2.id, 'amount': '50.00', 'percentage': '50.00',
+            'description': 'Dinner', 'date': dinner.date.isoformat(),
+        }])
+        self.assertEqual((data['deleted'], data['has_more']), ([], False))
+
+        # Syncing from the new token finds nothing new
+        token = data['token']
+        self.assertEqual(self.sync(self.user2, since=token)['changed'], [])
+        # Updates and deletions made anywhere are picked up, latest state only
+        dinner.description = 'Late dinner'
+        dinner.save()
+        lunch = self.create_expense('Lunch')
+        data = self.sync(self.user2, since=token)
+        self.assertEqual([row['description'] for row in data['changed']], ['Late dinner', 'Lunch'])
+        lunch_id = lunch.id
+        lunch.delete()
+        data = self.sync(self.user2, since=token)
+        self.assertEqual(([row['description'] for row in data['changed']], data['deleted']), (['Late dinner'], [lunch_id]))
+
+    def test_pages_of_changes(self):
+        expenses = [self.create_expense(f'Expense {index}') for index in range(3)]
+        data = self.sync(self.user2, since=self.token, page_size=2)
+        self.assertEqual([row['expense'] for row in data['changed']], [expenses[0].id, expenses[1].id])
+        self.assertTrue(data['has_more'])
+        data = self.sync(self.user2, since=data['token'], page_size=2)
+        self.assertEqual(([row['expense'] for row in data['changed']], data['has_more']), ([expenses[2].id], False))
+
+    def test_archived_expenses_are_not_deletions(self):
+        expense = self.create_expense('Dinner')
+        expense.date = datetime.date(2024, 1, 10)
+        expense.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            close_period(datetime.date(2024, 1, 31))
+        data = self.sync(self.user2, since=self.token)
+        self.assertEqual(([row['date'] for row in data['changed']], data['deleted']), (['2024-01-10'], []))
+
+    def test_compaction(self):
+        expense = self.create_expense('Dinner')
+        expense.description = 'Late dinner'
+        expense.save()
+        # Superseded entries go, tokens stay valid
+        self.assertEqual(compact_changes(timezone.now() - datetime.timedelta(days=1)), 2)
+        self.assertEqual(ExpenseChange.objects.count(), 2)
+        self.assertEqual([row['description'] for row in self.sync(self.user2, since=self.token)['changed']], ['Late dinner'])
+
+        # Entries past the retention period go, and the tokens that needed them expire
+        token = self.sync(self.user2)['token']
+        self.create_expense('Lunch')
+        ExpenseChange.objects.filter(expense_id=expense.id).update(created_at=timezone.now() - datetime.timedelta(days=40))
+        output = io.StringIO()
+        call_command('compact_changes', stdout=output)
+        self.assertIn('Dropped 2 change feed entries', output.getvalue())
+        self.sync(self.user2, status.HTTP_410_GONE, since=self.token)
+        self.assertEqual([row['description'] for row in self.sync(self.user2, since=token)['changed']], ['Lunch'])
+
+    def test_bulk_loads_expire_every_token(self):
+        self.create_expense('Dinner')
+        reset_changes()
+        self.assertEqual(ChangeCompaction.objects.count(), 1)
+        self.sync(self.user2, status.HTTP_410_GONE, since=self.token)
+        token = self.sync(self.user2)['token']
+        self.assertEqual(self.sync(self.user2, since=token)['changed'], [])
+        self.create_expense('Lunch')
+        self.assertEqual([row['description'] for row in self.sync(self.user2, since=token)['changed']], ['Lunch'])
+
+    def test_invalid_requests(self):
+        self.assertIn('since', self.sync(self.user2, status.HTTP_400_BAD_REQUEST, since='not a token')['errors'])
+        self.sync(self.user2, status.HTTP_400_BAD_REQUEST, page_size=0)
+        response = self.client.get(reverse('user-changes', args=[9999]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
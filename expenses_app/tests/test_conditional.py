@@ -0,0 +1,94 @@
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..models import Expenses, ExpenseShare
+from .base import ExpenseTestMixin
+
+# Test case for ETag / Last-Modified conditional GETs
+class ConditionalGetTest(ExpenseTestMixin, APITestCase):
+
+    user_count = 2
+
+    def setUp(self):
+        super().setUp()
+        self.create_expense(users=[self.user1, self.user2])
+
+    def create_expense(self, *args, **kwargs):
+        # Versions are bumped when the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            return super().create_expense(*args, **kwargs)
+
+    def test_user_expenses_etag(self):
+        url = reverse('user-expenses', args=[self.user1.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):  # The validators are cached with the user's version
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        # Another page size is another representation
+        response = self.client.get(url, {'page_size': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.create_expense(users=[self.user1])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_user_expenses_if_modified_since(self):
+        url = reverse('user-expenses', args=[self.user2.id])
+        last_modified = self.client.get(url)['Last-Modified']
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_direct_writes_change_the_etag(self):
+        url = reverse('user-expenses', args=[self.user2.id])
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            expense = Expenses.objects.create(description='Manual', total_amount=4000, split_method='exact')
+            ExpenseShare.objects.create(expense=expense, user=self.user2, amount=4000, percentage=100)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_overall_expenses_etag(self):
+        url = reverse('overall-expenses')
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(2):  # Only the validator lookups run
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.create_expense(users=[self.user2])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_balance_sheet_etag(self):
+        url = reverse('download-balance-sheet')
+        response = self.client.get(url)
+        b''.join(response.streaming_content)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_renamed_users_change_the_balance_sheet_etag(self):
+        url = reverse('download-balance-sheet')
+        response = self.client.get(url)
+        b''.join(response.streaming_content)
+        etag = response['ETag']
+        self.user1.name = 'Renamed'
+        self.user1.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'Renamed', b''.join(response.streaming_content))
+        self.assertNotEqual(response['ETag'], etag)
+
+        # Bulk upserts too
+        etag = response['ETag']
+        self.client.post(reverse('bulk-upsert-users'), {'users': [
+            {'email': 'user2@example.com', 'name': 'Renamed Two', 'mobile_number': '1234567891'},
+        ]}, format='json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b'Renamed Two', b''.join(response.streaming_content))
@@ -0,0 +1,72 @@
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from ..database import SQLITE_PRAGMAS, database_settings, replica_settings, shard_settings
+
+# Test case for the database settings read from the environment
+class DatabaseSettingsTest(SimpleTestCase):
+
+    def test_sqlite_by_default(self):
+        database = database_settings({}, 'db.sqlite3')
+        self.assertEqual((database['ENGINE'], database['NAME']), ('django.db.backends.sqlite3', 'db.sqlite3'))
+        self.assertEqual((database['CONN_MAX_AGE'], database['CONN_HEALTH_CHECKS']), (60, True))
+        self.assertEqual(database['OPTIONS'], {'transaction_mode': 'IMMEDIATE'})
+
+    def test_postgresql_with_a_pool(self):
+        database = database_settings({
+            'EXPENSES_DB_ENGINE': 'postgresql', 'EXPENSES_DB_NAME': 'expenses', 'EXPENSES_DB_HOST': 'db',
+            'EXPENSES_DB_USER': 'app', 'EXPENSES_DB_POOL': 'true', 'EXPENSES_DB_POOL_MAX_SIZE': '50',
+        }, 'db.sqlite3')
+        self.assertEqual(database['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual((database['NAME'], database['HOST'], database['PORT'], database['USER']), ('expenses', 'db', '5432', 'app'))
+        # Pooled connections are never persistent
+        self.assertEqual(database['CONN_MAX_AGE'], 0)
+        self.assertEqual(database['OPTIONS'], {'pool': {'min_size': 2, 'max_size': 50}})
+
+        database = database_settings({'EXPENSES_DB_ENGINE': 'postgresql', 'EXPENSES_DB_CONN_MAX_AGE': '300'}, 'db.sqlite3')
+        self.assertEqual((database['CONN_MAX_AGE'], database['OPTIONS']), (300, {}))
+        with self.assertRaises(ValueError):
+            database_settings({'EXPENSES_DB_ENGINE': 'oracle'}, 'db.sqlite3')
+        # Connection pools came with Django 5.1
+        with mock.patch('django.VERSION', (5, 0, 0, 'final', 0)), self.assertRaises(ValueError):
+            database_settings({'EXPENSES_DB_ENGINE': 'postgresql', 'EXPENSES_DB_POOL': 'true'}, 'db.sqlite3')
+
+    def test_replicas(self):
+        primary = database_settings({}, 'db.sqlite3')
+        replicas = replica_settings({'EXPENSES_DB_REPLICAS': 'replica1.sqlite3, replica2.sqlite3'}, primary)
+        self.assertEqual([(alias, replica['NAME']) for alias, replica in replicas.items()],
+                         [('replica1', 'replica1.sqlite3'), ('replica2', 'replica2.sqlite3')])
+        self.assertEqual(replicas['replica1']['TEST'], {'MIRROR': 'default'})
+
+        primary = database_settings({'EXPENSES_DB_ENGINE': 'postgresql', 'EXPENSES_DB_HOST': 'db'}, 'db.sqlite3')
+        replicas = replica_settings({'EXPENSES_DB_REPLICAS': 'db-replica,db-replica-2:6432'}, primary)
+        self.assertEqual([(replica['HOST'], replica['PORT']) for replica in replicas.values()],
+                         [('db-replica', '5432'), ('db-replica-2', '6432')])
+        self.assertEqual(replica_settings({}, primary), {})
+
+    def test_shards(self):
+        primary = database_settings({}, 'db.sqlite3')
+        shards = shard_settings({'EXPENSES_DB_SHARDS': 'shard1.sqlite3,shard2.sqlite3'}, primary)
+        self.assertEqual([(alias, shard['NAME']) for alias, shard in shards.items()],
+                         [('shard1', 'shard1.sqlite3'), ('shard2', 'shard2.sqlite3')])
+        # Shards get test databases of their own
+        self.assertNotIn('TEST', shards['shard1'])
+
+        primary = database_settings({'EXPENSES_DB_ENGINE': 'postgresql', 'EXPENSES_DB_HOST': 'db'}, 'db.sqlite3')
+        shards = shard_settings({'EXPENSES_DB_SHARDS': 'db-shard-1:6432'}, primary)
+        self.assertEqual((shards['shard1']['HOST'], shards['shard1']['PORT']), ('db-shard-1', '6432'))
+
+# Test case for the pragmas set on new SQLite connections
+class SQLitePragmasTest(TestCase):
+
+    def test_connections_are_tuned(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("SQLite only")
+        with connection.cursor() as cursor:
+            pragmas = {}
+            for name in ('synchronous', 'busy_timeout', 'cache_size'):
+                cursor.execute(f'PRAGMA {name}')
+                pragmas[name] = cursor.fetchone()[0]
+        # synchronous=NORMAL reads back as 1
+        self.assertEqual(pragmas, {'synchronous': 1, 'busy_timeout': 5000, 'cache_size': SQLITE_PRAGMAS['cache_size']})
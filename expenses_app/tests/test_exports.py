@@ -0,0 +1,157 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..exports import export_path, start_export
+from ..models import User, Expenses, ExpenseShare, ExportJob
+from .base import ExpenseTestMixin
+
+# Test case for the export jobs, written in the request (EXPENSES_EXPORT_WORKERS = 0)
+class ExportJobTest(ExpenseTestMixin, APITestCase):
+
+    user_count = 2
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        settings = override_settings(EXPENSES_EXPORT_DIR=self.directory, EXPENSES_EXPORT_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        for index, day in enumerate([datetime.date(2024, 1, 10), datetime.date(2024, 2, 10), datetime.date(2024, 3, 10)]):
+            self.create_expense(f'Expense {index}', '30.00', paid_by=self.user1, date=day)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, **data):
+        # The export runs once the request's transaction commits; returns the job afterwards
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('create-export'), data, format='json')
+        if response.status_code != status.HTTP_202_ACCEPTED:
+            return response
+        return self.client.get(response['Location'])
+
+    def download(self, response):
+        response = self.client.get(response.json()['download'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content)
+
+    def test_csv_export_matches_balance_sheet(self):
+        response = self.export(format='csv')
+        detail = response.json()
+        self.assertEqual((detail['status'], detail['progress'], detail['rows_total']), ('done', 100.0, 11))
+        # A finished export is handed out right away
+        response = self.client.post(reverse('create-export'), {'format': 'csv'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['id'], detail['id'])
+        self.assertEqual(response['Location'], reverse('export-detail', args=[detail['id']]))
+        sheet = self.client.get(reverse('download-balance-sheet'))
+        self.assertEqual(self.download(response), b''.join(sheet.streaming_content))
+
+    def test_gzip_and_jsonl_exports(self):
+        plain = self.download(self.export(format='csv'))
+        self.assertEqual(gzip.decompress(self.download(self.export(format='csv.gz'))), plain)
+
+        lines = [json.loads(line) for line in self.download(self.export(format='jsonl')).splitlines()]
+        self.assertEqual([line['type'] for line in lines], ['share'] * 6 + ['expense'] * 3)
+        self.assertEqual(lines[0], {
+            'type': 'share', 'user_id': self.user1.id, 'user': 'User One', 'description': 'Expense 0',
+            'total_amount': '30.00', 'split_method': 'equal', 'date': '2024-01-10', 'amount': '15.00', 'percentage': '50.00',
+        })
+        self.assertEqual(lines[-1]['paid_by'], self.user1.id)
+
+    def test_user_and_date_filters(self):
+        response = self.export(format='jsonl', user=self.user2.id, date_from='2024-02-01', date_to='2024-03-31')
+        lines = [json.loads(line) for line in self.download(response).splitlines()]
+        self.assertEqual({line['user_id'] for line in lines if line['type'] == 'share'}, {self.user2.id})
+        self.assertEqual([line['description'] for line in lines if line['type'] == 'expense'], ['Expense 1', 'Expense 2'])
+
+        response = self.export(date_from='2024-03-01', date_to='2024-02-01')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_identical_requests_share_a_job_until_expenses_change(self):
+        first = self.export(format='csv').json()
+        with self.assertNumQueries(5):  # Three for the data state, the job lookup and its reload
+            second = self.client.post(reverse('create-export'), {'format': 'csv'}, format='json')
+        self.assertEqual(second.json()['id'], first['id'])
+        other = self.export(format='jsonl').json()
+        self.assertNotEqual(other['id'], first['id'])
+
+        # Renaming a user changes the sheet too
+        self.user1.name = 'Renamed'
+        self.user1.save()
+        renamed = self.export(format='jsonl').json()
+        self.assertNotEqual(renamed['id'], other['id'])
+
+        self.create_expense('Expense 3', '30.00', paid_by=self.user1)
+        third = self.export(format='csv').json()
+        self.assertNotEqual(third['id'], first['id'])
+        # The older artifact of the same export is deleted
+        self.assertEqual(ExportJob.objects.get(id=first['id']).status, 'expired')
+        self.assertEqual(set(os.listdir(self.directory)), {f"export-{third['id']}.csv", f"export-{renamed['id']}.jsonl"})
+
+    def test_queued_job_is_shared_and_stale_job_replaced(self):
+        # Without running the on-commit hooks the job stays queued
+        first = self.client.post(reverse('create-export'), {'format': 'csv'}, format='json')
+        self.assertEqual(first.status_code, status.HTTP_202_ACCEPTED)
+        second = self.client.post(reverse('create-export'), {'format': 'csv'}, format='json')
+        self.assertEqual(second.json()['id'], first.json()['id'])
+
+        response = self.client.get(reverse('export-download', args=[first.json()['id']]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        # The worker died: the job stops standing in for new requests
+        ExportJob.objects.filter(id=first.json()['id']).update(updated_at=timezone.now() - datetime.timedelta(hours=1))
+        third = self.export(format='csv')
+        self.assertNotEqual(third.json()['id'], first.json()['id'])
+        self.assertEqual(third.json()['status'], 'done')
+        self.assertEqual(ExportJob.objects.get(id=first.json()['id']).status, 'failed')
+
+    def test_sendfile_and_missing_exports(self):
+        response = self.export(format='csv.gz')
+        job = ExportJob.objects.get(id=response.json()['id'])
+        with override_settings(EXPENSES_EXPORT_SENDFILE_HEADER='X-Accel-Redirect'):
+            download = self.client.get(response.json()['download'])
+        self.assertEqual(download['X-Accel-Redirect'], f'/protected-exports/{job.file_name}')
+        self.assertEqual(download['Content-Type'], 'application/gzip')
+        self.assertEqual(download.content, b'')
+
+        self.assertEqual(self.client.get(reverse('export-detail', args=[9999])).status_code, status.HTTP_404_NOT_FOUND)
+        os.remove(export_path(job))
+        self.assertEqual(self.client.get(reverse('export-detail', args=[job.id])).json()['status'], 'expired')
+        self.assertNotEqual(self.export(format='csv.gz').json()['id'], job.id)
+
+# Test case for the export worker threads
+@override_settings(EXPENSES_EXPORT_WORKERS=2)
+class ExportWorkerTest(TransactionTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        user = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        expense = Expenses.objects.create(description='Dinner', total_amount=1000, split_method='equal')
+        ExpenseShare.objects.create(expense=expense, user=user, amount=1000, percentage=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export_runs_in_a_worker_thread(self):
+        with override_settings(EXPENSES_EXPORT_DIR=self.directory):
+            job, created = start_export({'format': 'csv'})
+            self.assertTrue(created)
+            # Queued when it was created, outside of any transaction
+            for _ in range(200):
+                job.refresh_from_db()
+                if job.status == 'done':
+                    break
+                time.sleep(0.01)
+        self.assertEqual(job.status, 'done')
+        self.assertTrue(os.path.exists(os.path.join(self.directory, job.file_name)))
@@ -0,0 +1,83 @@
+import datetime
+from decimal import Decimal
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ErrorDetail
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+from .. import renderers
+from ..fast_serializers import expense_rows, share_rows, serialize_expenses, serialize_shares
+from ..models import User, Expenses, ExpenseShare
+from ..renderers import FastJSONRenderer
+from ..serializers import ExpenseSerializer, ExpenseShareSerializer
+
+# Test case for the read-only listing serializers
+class FastSerializerTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+        expenses = [
+            ('Dinner', 'equal', 3000, self.user1, [(self.user1, 1500, None), (self.user2, 1500, None)]),
+            ('Café \u2028 "trip"', 'percentage', 1001, None, [(self.user2, 334, '33.33'), (self.user1, 667, '66.67')]),
+            ('Taxi', 'exact', 750, self.user2, [(self.user1, 750, None)]),
+        ]
+        for index, (description, split_method, total, payer, shares) in enumerate(expenses):
+            expense = Expenses.objects.create(
+                description=description, total_amount=total, split_method=split_method,
+                paid_by=payer,
+            )
+            # `date` is set on creation, older dates have to be written afterwards
+            expense.date = datetime.date(2024, 1, 3 - index)
+            expense.save()
+            for user, amount, percentage in shares:
+                ExpenseShare.objects.create(expense=expense, user=user, amount=amount, percentage=percentage)
+
+    def test_expenses_match_model_serializer(self):
+        expenses = Expenses.objects.prefetch_related('shares').order_by('date', 'id')
+        expected = JSONRenderer().render(ExpenseSerializer(expenses, many=True).data)
+        actual = FastJSONRenderer().render(serialize_expenses(expense_rows().order_by('date', 'id')))
+        self.assertEqual(actual, expected)
+
+    def test_shares_match_model_serializer(self):
+        shares = ExpenseShare.objects.filter(user=self.user1).select_related('expense').order_by('expense__date', 'id')
+        expected = JSONRenderer().render(ExpenseShareSerializer(shares, many=True).data)
+        rows = share_rows().filter(user=self.user1).order_by('expense__date', 'id')
+        actual = FastJSONRenderer().render(serialize_shares(rows))
+        self.assertEqual(actual, expected)
+
+    def test_listing_query_count(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('overall-expenses'))
+        self.assertEqual(len(response.json()['results']), 3)
+        self.assertEqual(response.json()['results'][0]['description'], 'Taxi')
+
+# Test case for the orjson-backed renderer
+class FastJSONRendererTest(TestCase):
+
+    data = {
+        'amount': Decimal('12.30'),
+        'when': datetime.datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+        'day': datetime.date(2024, 5, 1),
+        'text': 'naïve \u2028 \u2029 "quoted" \x01',
+        'error': ErrorDetail('Invalid cursor.', code='invalid'),
+        'lazy': gettext_lazy('This field is required.'),
+        'numbers': (1, 2.5, None, True),
+        3: 'non string key',
+    }
+
+    def test_matches_stdlib_renderer(self):
+        self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_falls_back_without_orjson(self):
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_indent_uses_stdlib_renderer(self):
+        rendered = FastJSONRenderer().render({'a': 1}, 'application/json; indent=2')
+        self.assertEqual(rendered, b'{\n  "a": 1\n}')
@@ -0,0 +1,131 @@
+import csv
+import io
+
+from django.db.models import F
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..models import Group, GroupMembership, Expenses, ExpenseShare
+from ..seeding import seed_dataset
+from .base import ExpenseTestMixin
+
+# Test case for expense groups and the group-scoped endpoints
+class GroupViewsTest(ExpenseTestMixin, APITestCase):
+
+    user_count = 4
+
+    def setUp(self):
+        super().setUp()
+        response = self.client.post(reverse('create-group'), {
+            'name': 'Trip', 'members': [self.users[0].id, self.users[1].id, self.users[2].id, self.users[0].id],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.group = response.data['id']
+        self.other = Group.objects.create(name='Household')
+        GroupMembership.objects.create(group=self.other, user=self.users[3])
+
+    def test_group_members(self):
+        response = self.client.get(reverse('group-detail', args=[self.group]))
+        self.assertEqual((response.data['name'], response.data['members']), ('Trip', [user.id for user in self.users[:3]]))
+        response = self.client.post(reverse('group-members', args=[self.group]), {'user': self.users[3].id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['members']), 4)
+        response = self.client.post(reverse('group-members', args=[self.group]), {'user': self.users[3].id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(reverse('group-detail', args=[9999])).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_only_members_share_group_expenses(self):
+        response = self.post_expense(self.expense_data('Dinner', '30.00', self.users[:2], group=self.group, paid_by=self.users[3]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['errors']['group'], [f'Users {self.users[3].id} are not members of this group.'])
+
+        expense = self.create_expense('Dinner', '30.00', self.users[:3], group=self.group, paid_by=self.users[0])
+        self.assertEqual(expense.group_id, self.group)
+        self.assertEqual(set(ExpenseShare.objects.values_list('group_id', flat=True)), {self.group})
+
+    def test_group_expenses_are_paginated_within_the_group(self):
+        for index in range(5):
+            self.create_expense(f'Trip {index}', '10.00', self.users[:2], group=self.group)
+        self.create_expense('Rent', '10.00', self.users[3:], group=self.other.id)
+        self.create_expense('Global', '10.00', self.users[:2])
+
+        url = reverse('group-expenses', args=[self.group])
+        with self.assertNumQueries(3):  # The group check, the page and its shares
+            response = self.client.get(url, {'page_size': 3})
+        descriptions = [expense['description'] for expense in response.data['results']]
+        response = self.client.get(response.data['next'])
+        descriptions += [expense['description'] for expense in response.data['results']]
+        self.assertEqual(descriptions, [f'Trip {index}' for index in range(5)])
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(self.client.get(reverse('group-expenses', args=[9999])).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_group_balances(self):
+        self.create_expense('Dinner', '30.00', self.users[:3], group=self.group, paid_by=self.users[0])
+        self.create_expense('Taxi', '10.00', self.users[:2], group=self.group, paid_by=self.users[1])
+        self.create_expense('Global', '99.00', self.users[:2], paid_by=self.users[1])
+        self.client.post(reverse('group-members', args=[self.group]), {'user': self.users[3].id}, format='json')
+
+        response = self.client.get(reverse('group-balances', args=[self.group]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['members'], [
+            {'user': self.users[0].id, 'total_owed': '15.00', 'total_paid': '30.00', 'net_balance': '15.00', 'share_count': 2},
+            {'user': self.users[1].id, 'total_owed': '15.00', 'total_paid': '10.00', 'net_balance': '-5.00', 'share_count': 2},
+            {'user': self.users[2].id, 'total_owed': '10.00', 'total_paid': '0.00', 'net_balance': '-10.00', 'share_count': 1},
+            {'user': self.users[3].id, 'total_owed': '0.00', 'total_paid': '0.00', 'net_balance': '0.00', 'share_count': 0},
+        ])
+
+    def test_group_balance_sheet(self):
+        self.create_expense('Dinner', '30.00', self.users[:3], group=self.group)
+        self.create_expense('Rent', '10.00', self.users[3:], group=self.other.id)
+        response = self.client.get(reverse('group-balance-sheet', args=[self.group]))
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="balance_sheet_group_{self.group}.csv"')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        shares = [row for row in rows if len(row) == 7 and row[1] == 'Dinner']
+        self.assertEqual([(row[0], row[2], row[5], row[6]) for row in shares], [
+            ('User One', '30.00', '10.00', '33.34'), ('User Two', '30.00', '10.00', '33.33'), ('User Three', '30.00', '10.00', '33.33'),
+        ])
+        self.assertFalse(any('Rent' in row or 'User Four' in row for row in rows))
+
+    def test_group_balance_sheet_lists_former_members(self):
+        self.create_expense('Dinner', '30.00', self.users[:3], group=self.group)
+        GroupMembership.objects.filter(group_id=self.group, user=self.users[2]).delete()
+        response = self.client.get(reverse('group-balance-sheet', args=[self.group]))
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row[0] for row in rows if len(row) == 7 and row[1] == 'Dinner'], ['User One', 'User Two', 'User Three'])
+        self.assertEqual(len(self.client.get(reverse('group-balances', args=[self.group])).data['members']), 3)
+
+    def test_batch_resolves_groups_once(self):
+        expenses = [
+            {'description': f'Trip {index}', 'total_amount': '10.00', 'split_method': 'equal', 'group': self.group,
+             'shares': [{'user': self.users[0].id}, {'user': self.users[1].id}]}
+            for index in range(10)
+        ]
+        # Users, groups, the group's members, expense insert, share insert, two ledger statements,
+        # one upsert per daily rollup, the change feed insert and the savepoint
+        with self.assertNumQueries(12):
+            response = self.client.post(reverse('create-expense-batch'), {'expenses': expenses}, format='json')
+        self.assertEqual(response.data['created'], 10)
+
+    def test_moving_an_expense_moves_its_shares(self):
+        self.create_expense('Dinner', '30.00', self.users[:2], group=self.group)
+        expense = Expenses.objects.get()
+        expense.group = None
+        expense.save()
+        self.assertFalse(ExpenseShare.objects.filter(group__isnull=False).exists())
+        # Shares written outside the write path copy the group of their expense
+        manual = Expenses.objects.create(description='Manual', total_amount=100, split_method='exact', group=self.other)
+        ExpenseShare.objects.create(expense=manual, user=self.users[3], amount=100)
+        self.assertEqual(ExpenseShare.objects.get(user=self.users[3]).group_id, self.other.id)
+
+# Test case for seeded datasets with groups
+class SeedGroupsTest(TestCase):
+
+    def test_expenses_stay_within_their_group(self):
+        seed_dataset(40, 200, groups=4)
+        self.assertEqual(Group.objects.count(), 4)
+        self.assertEqual(GroupMembership.objects.count(), 40)
+        self.assertFalse(Expenses.objects.filter(group__isnull=True).exists())
+        self.assertFalse(ExpenseShare.objects.exclude(group=F('expense__group')).exists())
+        outsiders = ExpenseShare.objects.exclude(user__group_memberships__group=F('group'))
+        self.assertFalse(outsiders.exists())
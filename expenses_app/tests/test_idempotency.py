@@ -0,0 +1,169 @@
+import datetime
+import io
+import threading
+from unittest import skipUnless
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from ..idempotency import ReplayCache, replay_cache
+from ..models import User, Expenses, ExpenseShare, IdempotencyKey
+
+
+def expense_data(user1, user2, description='Dinner'):
+    return {
+        'description': description, 'total_amount': '100.00', 'split_method': 'equal',
+        'paid_by': user1.id, 'shares': [{'user': user1.id}, {'user': user2.id}],
+    }
+
+
+# Test case for the Idempotency-Key header of the expense creation endpoints
+class IdempotencyTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        replay_cache.clear()
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+        self.data = expense_data(self.user1, self.user2)
+
+    def post(self, data, key, name='create-expense'):
+        return self.client.post(reverse(name), data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retries_get_the_first_response(self):
+        first = self.post(self.data, 'key-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        # Served from memory without a query, then from the table with a single one
+        with self.assertNumQueries(0):
+            retry = self.post(self.data, 'key-1')
+        replay_cache.clear()
+        with self.assertNumQueries(1):
+            self.post(self.data, 'key-1')
+        self.assertEqual((retry.status_code, retry.json()), (status.HTTP_201_CREATED, first.json()))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual((Expenses.objects.count(), ExpenseShare.objects.count()), (1, 2))
+
+        # Other keys, and requests without one, create expenses of their own
+        self.assertNotIn('Idempotent-Replayed', self.post(self.data, 'key-2').headers)
+        self.client.post(reverse('create-expense'), self.data, format='json')
+        self.assertEqual(Expenses.objects.count(), 3)
+
+    def test_keys_are_bound_to_their_request(self):
+        self.post(self.data, 'key-1')
+        response = self.post(dict(self.data, total_amount='90.00'), 'key-1')
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        # The same body in another key order is the same request
+        self.assertEqual(self.post(dict(reversed(self.data.items())), 'key-1')['Idempotent-Replayed'], 'true')
+        # Keys are per endpoint
+        response = self.post({'expenses': [self.data]}, 'key-1', 'create-expense-batch')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Expenses.objects.count(), 2)
+        self.assertEqual(self.post(self.data, 'k' * 256).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batches_and_rejected_requests_are_replayed(self):
+        batch = {'expenses': [self.data, dict(self.data, paid_by=9999)], 'mode': 'best_effort'}
+        first = self.post(batch, 'batch-1', 'create-expense-batch')
+        self.assertEqual(first.status_code, status.HTTP_207_MULTI_STATUS)
+        retry = self.post(batch, 'batch-1', 'create-expense-batch')
+        self.assertEqual((retry.status_code, retry.json()), (status.HTTP_207_MULTI_STATUS, first.json()))
+        self.assertEqual(Expenses.objects.count(), 1)
+
+        invalid = dict(self.data, shares=[])
+        first = self.post(invalid, 'invalid-1')
+        self.assertEqual(first.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post(invalid, 'invalid-1').json(), first.json())
+
+    @override_settings(EXPENSES_IDEMPOTENCY_WAIT_SECONDS=0)
+    def test_requests_running_elsewhere(self):
+        # A request of another process claimed the key and is still running
+        self.post(self.data, 'key-1')
+        row = IdempotencyKey.objects.get(key='key-1')
+        replay_cache.clear()
+        IdempotencyKey.objects.filter(pk=row.pk).update(status_code=None, response=None)
+        response = self.post(self.data, 'key-1')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        # It died: its claim is taken over once it is old enough
+        with self.settings(EXPENSES_IDEMPOTENCY_LOCK_SECONDS=30):
+            IdempotencyKey.objects.filter(pk=row.pk).update(claimed_at=timezone.now() - datetime.timedelta(seconds=31))
+            response = self.post(self.data, 'key-1')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(self.post(self.data, 'key-1')['Idempotent-Replayed'], 'true')
+
+    def test_keys_expire(self):
+        self.post(self.data, 'key-1')
+        self.post(self.data, 'key-2')
+        replay_cache.clear()
+        IdempotencyKey.objects.filter(key='key-1').update(expires_at=timezone.now())
+        self.assertNotIn('Idempotent-Replayed', self.post(self.data, 'key-1').headers)
+        self.assertEqual(Expenses.objects.count(), 3)
+
+        IdempotencyKey.objects.filter(key='key-2').update(expires_at=timezone.now())
+        output = io.StringIO()
+        call_command('purge_idempotency_keys', stdout=output)
+        self.assertIn('Deleted 1 expired', output.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['key-1'])
+
+
+# Test case for duplicates sent at the same time
+@skipUnless(connection.vendor == 'sqlite', "Relies on the shared in-memory SQLite test database")
+class ConcurrentDuplicatesTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        replay_cache.clear()
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+
+    def test_a_single_insert(self):
+        data = expense_data(self.user1, self.user2)
+        barrier = threading.Barrier(4)
+        responses = []
+
+        def post():
+            try:
+                barrier.wait()
+                response = APIClient().post(reverse('create-expense'), data, format='json', HTTP_IDEMPOTENCY_KEY='key-1')
+                responses.append((response.status_code, response.json()['id']))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=post) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(Expenses.objects.count(), 1)
+        self.assertEqual(responses, [(status.HTTP_201_CREATED, Expenses.objects.get().id)] * 4)
+
+
+# Test case for the locks duplicates of this process wait on
+class KeyLockTest(SimpleTestCase):
+
+    def test_only_duplicates_wait(self):
+        cache = ReplayCache()
+        done = {}
+
+        def take(*keys):
+            for key in keys:
+                with cache.key_lock('create-expense', key):
+                    done[key] = True
+
+        with cache.key_lock('create-expense', 'key-1'):
+            duplicate = threading.Thread(target=take, args=('key-1',))
+            others = threading.Thread(target=take, args=[f'key-{n}' for n in range(2, 200)])
+            duplicate.start()
+            others.start()
+            others.join(5)
+            self.assertEqual(len(done), 198)
+            self.assertTrue(duplicate.is_alive())
+        duplicate.join()
+        self.assertEqual(len(done), 199)
+        self.assertEqual(cache.key_locks, {})
@@ -0,0 +1,143 @@
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from ..importing import Checkpoint, ItemValidator, import_expenses, load_user_emails, new_state
+from ..ledger import LEDGER_FIELDS, compute_balances
+from ..models import User, Expenses, ExpenseShare, UserBalance
+from ..serializers import ExpenseSerializer
+
+ITEMS = [
+    {"description": "Dinner", "total_amount": "30.00", "split_method": "equal", "date": "2019-05-01",
+     "paid_by": "a@example.com", "shares": [{"user": "a@example.com"}, {"user": "b@example.com"}, {"user": "c@example.com"}]},
+    {"description": "Taxi, \"late\"\nnight", "total_amount": "25.50", "split_method": "exact", "date": "2019-05-02",
+     "shares": [{"user": "a@example.com", "amount": "10.50"}, {"user": "b@example.com", "amount": "15.00"}]},
+    {"description": "Unknown user", "total_amount": "10.00", "split_method": "equal",
+     "shares": [{"user": "nobody@example.com"}]},
+    {"description": "Rent", "total_amount": "1000.00", "split_method": "percentage", "date": "2019-06-01",
+     "paid_by": "c@example.com", "shares": [{"user": "b@example.com", "percentage": "40"}, {"user": "c@example.com", "percentage": "60"}]},
+    {"description": "Bad split", "total_amount": "10.00", "split_method": "percentage",
+     "shares": [{"user": "a@example.com", "percentage": "40"}]},
+]
+
+
+def csv_lines(items):
+    # The items as CSV rows, one per share
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['expense', 'description', 'total_amount', 'split_method', 'date', 'paid_by', 'user', 'amount', 'percentage'])
+    for index, item in enumerate(items):
+        for share in item['shares']:
+            writer.writerow([
+                index, item['description'], item['total_amount'], item['split_method'], item.get('date', ''),
+                item.get('paid_by', ''), share['user'], share.get('amount', ''), share.get('percentage', ''),
+            ])
+    return output.getvalue()
+
+# Test case for the streaming expense import
+class ImportExpensesTest(TestCase):
+
+    def setUp(self):
+        for name in 'abc':
+            User.objects.create(email=f'{name}@example.com', name=name.upper(), mobile_number='1234567890')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', newline='') as f:
+            f.write(content)
+        return path
+
+    def write_jsonl(self, items):
+        return self.write('history.jsonl', ''.join(json.dumps(item) + '\n' for item in items))
+
+    def import_file(self, path, **options):
+        output = io.StringIO()
+        call_command('import_expenses', path, stdout=output, **options)
+        return output.getvalue()
+
+    def snapshot(self):
+        emails = dict(User.objects.values_list('id', 'email'))
+        return sorted(
+            (share.expense.description, share.expense.total_amount, share.expense.split_method, share.expense.date,
+             emails.get(share.expense.paid_by_id), emails[share.user_id], share.amount, share.percentage)
+            for share in ExpenseShare.objects.select_related('expense')
+        )
+
+    def test_jsonl_import(self):
+        errors = os.path.join(self.directory, 'errors.jsonl')
+        output = self.import_file(self.write_jsonl(ITEMS), errors=errors)
+        self.assertIn('Imported 3 expenses and 7 shares from 5 records', output)
+
+        rent = Expenses.objects.get(description='Rent')
+        self.assertEqual(rent.date, datetime.date(2019, 6, 1))
+        self.assertEqual(rent.paid_by.email, 'c@example.com')
+        self.assertEqual(sorted(rent.shares.values_list('amount', flat=True)), [40000, 60000])
+        stored = {row['user_id']: {field: row[field] for field in LEDGER_FIELDS} for row in UserBalance.objects.values('user_id', *LEDGER_FIELDS)}
+        self.assertEqual(stored, compute_balances())
+
+        with open(errors) as f:
+            rejected = [json.loads(line) for line in f]
+        self.assertEqual([error['record'] for error in rejected], [3, 5])
+        self.assertIn("nobody@example.com", rejected[0]['errors']['shares']['0']['user'][0])
+        self.assertEqual(rejected[1]['errors'], {"non_field_errors": ["Total percentage must equal 100%."]})
+
+    def test_csv_import_matches_jsonl(self):
+        self.import_file(self.write_jsonl(ITEMS))
+        expected = self.snapshot()
+        Expenses.objects.all().delete()
+        self.import_file(self.write('history.csv', csv_lines(ITEMS)), workers=2, batch_size=2)
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_resume_after_crash(self):
+        path = self.write('history.csv', csv_lines(ITEMS))
+        checkpoint = Checkpoint(path + '.checkpoint')
+        batches = import_expenses(path, 'csv', new_state(), checkpoint=checkpoint, batch_size=2)
+        next(batches)
+        # The process dies after the first batch committed
+        batches.close()
+        self.assertEqual(Expenses.objects.count(), 2)
+
+        with self.assertRaises(CommandError):
+            self.import_file(path)
+        output = self.import_file(path, resume=True)
+        self.assertIn('Imported 3 expenses and 7 shares from 5 records', output)
+        self.assertEqual(Expenses.objects.count(), 3)
+        self.assertIn('already imported', self.import_file(path, resume=True))
+
+    def test_checkpoint_of_a_batch_committing(self):
+        path = self.write_jsonl(ITEMS[:2])
+        checkpoint = Checkpoint(path + '.checkpoint')
+        state = new_state()
+        for state, _ in import_expenses(path, 'jsonl', state, batch_size=1):
+            break
+        expense = Expenses.objects.get()
+        # Written while the batch was committing; whether it committed decides where to resume
+        checkpoint.save(new_state(), pending={'expenses': [[expense.id, expense.description]], 'state': state})
+        self.assertEqual(checkpoint.load(), state)
+        expense.delete()
+        self.assertEqual(checkpoint.load(), new_state())
+
+    def test_same_split_rules_as_serializer(self):
+        users = load_user_emails()
+        validator = ItemValidator(users)
+        for item in (ITEMS[4], {**ITEMS[1], "total_amount": "30.00"}, {**ITEMS[0], "shares": [{"user": "a@example.com", "amount": "1"}]}):
+            _, errors = validator.validate(item)
+            api_item = {
+                **item,
+                "paid_by": users.get(item.get("paid_by")),
+                "shares": [{**share, "user": users[share["user"]]} for share in item["shares"]],
+            }
+            serializer = ExpenseSerializer(data=api_item, context={'split_method': item['split_method']})
+            self.assertFalse(serializer.is_valid())
+            self.assertEqual(json.loads(json.dumps(errors)), json.loads(json.dumps(serializer.errors)))
@@ -0,0 +1,55 @@
+import re
+
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from ..metrics import metrics_registry
+from ..models import User, Expenses, ExpenseShare
+
+# Test case for the request instrumentation middleware and the metrics endpoint
+class RequestMetricsTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics_registry.reset()
+        self.user = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        expense = Expenses.objects.create(description='Lunch', total_amount=2000, split_method='equal')
+        ExpenseShare.objects.create(expense=expense, user=self.user, amount=2000, percentage=100)
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('overall-expenses'))
+        timing = response['Server-Timing']
+        # 2 validator queries, the page and its shares
+        self.assertIn('db;desc="4 queries";dur=', timing)
+        self.assertRegex(timing, r'render;dur=\d+\.\d\d')
+        self.assertRegex(timing, r'total;dur=\d+\.\d\d')
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('user-detail', args=[self.user.id]))
+        self.client.get(reverse('user-detail', args=[self.user.id]))
+        self.client.get(reverse('user-detail', args=[12345]))
+        response = self.client.get(reverse('metrics'))
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        labels = 'route="user-detail",method="GET"'
+        self.assertIn(f'expenses_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3', body)
+        self.assertIn(f'expenses_request_duration_seconds_count{{{labels}}} 3', body)
+        self.assertIn(f'expenses_request_latency_seconds{{{labels},quantile="0.99"}}', body)
+        self.assertIn(f'expenses_responses_total{{{labels},status="200"}} 2', body)
+        self.assertIn(f'expenses_responses_total{{{labels},status="404"}} 1', body)
+        # The second request was served from the response cache
+        queries = re.search(rf'expenses_db_queries_total{{{labels}}} (\d+)', body)
+        self.assertEqual(int(queries.group(1)), 2)
+
+    @override_settings(EXPENSES_MAX_QUERIES_PER_REQUEST=3)
+    def test_requests_over_the_query_limit_are_logged(self):
+        with self.assertLogs('expenses_app.middleware', 'WARNING') as logs:
+            self.client.get(reverse('overall-expenses'))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('4 queries', logs.output[0])
+        self.assertIn('expenses_app_expenseshare', logs.output[0])
+
+    def test_fast_requests_are_not_logged(self):
+        with self.assertNoLogs('expenses_app.middleware', 'WARNING'):
+            self.client.get(reverse('user-balance', args=[self.user.id]))
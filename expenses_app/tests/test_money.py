@@ -0,0 +1,50 @@
+import numpy as np
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from ..models import ExpenseShare
+from ..money import allocate, format_minor, format_minor_array, to_minor
+from .base import ExpenseTestMixin
+
+# Test case for the minor unit helpers
+class MoneyTest(SimpleTestCase):
+
+    def test_allocate_sums_exactly(self):
+        self.assertEqual(allocate(100000, [1, 1, 1]), [33334, 33333, 33333])
+        self.assertEqual(allocate(1001, [3333, 3333, 3334]), [334, 333, 334])
+        self.assertEqual(allocate(5, [1, 1, 1, 1, 1, 1]), [1, 1, 1, 1, 1, 0])
+        self.assertEqual(allocate(-100, [1, 1, 1]), [-33, -33, -34])
+        self.assertEqual(allocate(10000, [0, 0]), [5000, 5000])
+        for total in range(0, 2000, 7):
+            self.assertEqual(sum(allocate(total, [17, 5, 31, 1])), total)
+
+    def test_decimal_conversions(self):
+        self.assertEqual(to_minor('12.34'), 1234)
+        self.assertEqual(to_minor(7), 700)
+        self.assertEqual(format_minor(-5), '-0.05')
+        values = np.array([0, 5, -5, 1234, -100, 99, -123456789], dtype=np.int64)
+        self.assertEqual(format_minor_array(values), [format_minor(value) for value in values])
+
+# Test case for splits stored as integer minor units
+class SplitRemainderTest(ExpenseTestMixin, APITestCase):
+
+    def split(self, split_method, total_amount, shares):
+        # The shares of an expense of every user
+        expense = self.create_expense('Groceries', total_amount, self.users, split_method=split_method, shares=shares)
+        return list(ExpenseShare.objects.filter(expense=expense).order_by('id'))
+
+    def test_equal_split_distributes_the_remainder(self):
+        shares = self.split('equal', '100.00', [{}, {}, {}])
+        self.assertEqual([share.amount for share in shares], [3334, 3333, 3333])
+        self.assertEqual(sum(share.percentage for share in shares), 100)
+
+        response = self.client.get(reverse('user-expenses', args=[self.users[0].id]))
+        self.assertEqual(response.json()['results'][0]['amount'], '33.34')
+
+    def test_percentage_split_sums_to_the_total(self):
+        shares = self.split('percentage', '10.01', [{'percentage': '33.33'}, {'percentage': '33.33'}, {'percentage': '33.34'}])
+        self.assertEqual([share.amount for share in shares], [334, 333, 334])
+
+    def test_exact_split_percentages_sum_to_100(self):
+        shares = self.split('exact', '30.00', [{'amount': '10.00'}, {'amount': '10.00'}, {'amount': '10.00'}])
+        self.assertEqual([str(share.percentage) for share in shares], ['33.34', '33.33', '33.33'])
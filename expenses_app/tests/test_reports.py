@@ -0,0 +1,153 @@
+import datetime
+
+import numpy as np
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..ledger import rebuild_daily_totals
+from ..models import User, Expenses, ExpenseShare, DailyUserTotal, DailySplitMethodTotal
+from ..reports import _columns
+
+# Test case for the vectorized report endpoints
+class ReportViewsTest(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+        self.user3 = User.objects.create(email='user3@example.com', name='User Three', mobile_number='1234567892')
+        expenses = [
+            {
+                'description': 'Dinner', 'total_amount': 300, 'split_method': 'equal', 'paid_by': self.user1.id,
+                'shares': [{'user': self.user1.id}, {'user': self.user2.id}, {'user': self.user3.id}],
+            },
+            {
+                'description': 'Ride', 'total_amount': 150, 'split_method': 'exact', 'paid_by': self.user2.id,
+                'shares': [{'user': self.user1.id, 'amount': 50}, {'user': self.user3.id, 'amount': 100}],
+            },
+            {
+                'description': 'Party', 'total_amount': 80.5, 'split_method': 'percentage',
+                'shares': [{'user': self.user3.id, 'percentage': 100}],
+            },
+        ]
+        response = self.client.post(reverse('create-expense-batch'), {'expenses': expenses}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.data)
+
+    def test_user_totals(self):
+        response = self.client.get(reverse('report-user-totals'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        totals = {row['user']: row for row in response.data['users']}
+        self.assertEqual(totals[self.user1.id], {
+            'user': self.user1.id, 'total_owed': '150.00', 'total_paid': '300.00', 'net_balance': '150.00', 'share_count': 2,
+        })
+        self.assertEqual(totals[self.user3.id]['total_owed'], '280.50')
+        self.assertEqual(totals[self.user3.id]['net_balance'], '-200.00')
+
+    def test_pairwise_debts_are_netted(self):
+        response = self.client.get(reverse('report-pairwise-debts'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(response.data['debts'], key=lambda debt: (debt['from_user'], debt['to_user'])), [
+            {'from_user': self.user2.id, 'to_user': self.user1.id, 'amount': '50.00'},
+            {'from_user': self.user3.id, 'to_user': self.user1.id, 'amount': '100.00'},
+            {'from_user': self.user3.id, 'to_user': self.user2.id, 'amount': '100.00'},
+        ])
+
+    def test_split_method_breakdown(self):
+        response = self.client.get(reverse('report-split-methods'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['split_methods'], [
+            {'split_method': 'equal', 'expense_count': 1, 'total_amount': '300.00', 'share_count': 3},
+            {'split_method': 'percentage', 'expense_count': 1, 'total_amount': '80.50', 'share_count': 1},
+            {'split_method': 'exact', 'expense_count': 1, 'total_amount': '150.00', 'share_count': 2},
+        ])
+
+    def test_columns_keep_rows_whole(self):
+        columns = _columns(ExpenseShare.objects.all(), 'expense_id', 'user_id', Coalesce(F('amount'), Value(0)))
+        self.assertEqual(columns.dtype, np.int64)
+        self.assertEqual(
+            sorted(map(tuple, columns.T.tolist())),
+            sorted(ExpenseShare.objects.values_list('expense_id', 'user_id', 'amount')),
+        )
+        self.assertEqual(_columns(ExpenseShare.objects.none(), 'expense_id', 'user_id').shape, (2, 0))
+
+# Test case for the period summary report
+class PeriodSummaryTest(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+        expenses = [
+            ('2024-07-29', 'equal', '10.00'),   # Monday
+            ('2024-08-04', 'equal', '20.00'),   # Sunday of the same week
+            ('2024-08-05', 'exact', '30.00'),
+            ('2024-10-01', 'equal', '40.00'),   # After Q3
+        ]
+        for day, split_method, total_amount in expenses:
+            shares = [{'user': self.user1.id}, {'user': self.user2.id}]
+            if split_method == 'exact':
+                shares = [{'user': self.user1.id, 'amount': total_amount}]
+            response = self.client.post(reverse('create-expense'), {
+                'description': day, 'total_amount': total_amount, 'split_method': split_method, 'shares': shares,
+            }, format='json')
+            expense = Expenses.objects.get(id=response.data['id'])
+            expense.date = datetime.date.fromisoformat(day)
+            expense.save()
+
+    def summary(self, **params):
+        response = self.client.get(reverse('report-summary'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return response.data['rows']
+
+    def test_spend_per_user_per_month(self):
+        self.assertEqual(self.summary(**{'from': '2024-07-01', 'to': '2024-09-30'}), [
+            {'period': '2024-07-01', 'user': self.user1.id, 'total': '5.00', 'count': 1},
+            {'period': '2024-07-01', 'user': self.user2.id, 'total': '5.00', 'count': 1},
+            {'period': '2024-08-01', 'user': self.user1.id, 'total': '40.00', 'count': 2},
+            {'period': '2024-08-01', 'user': self.user2.id, 'total': '10.00', 'count': 1},
+        ])
+        self.assertEqual(self.summary(user=self.user2.id, granularity='week'), [
+            {'period': '2024-07-29', 'user': self.user2.id, 'total': '15.00', 'count': 2},
+            {'period': '2024-09-30', 'user': self.user2.id, 'total': '20.00', 'count': 1},
+        ])
+
+    def test_totals_by_split_method(self):
+        self.assertEqual(self.summary(group_by='split_method', granularity='week', to='2024-09-30'), [
+            {'period': '2024-07-29', 'split_method': 'equal', 'total': '30.00', 'count': 2},
+            {'period': '2024-08-05', 'split_method': 'exact', 'total': '30.00', 'count': 1},
+        ])
+        self.assertEqual(len(self.summary(group_by='split_method', granularity='day')), 4)
+
+    def test_daily_totals_follow_every_write(self):
+        def rollups():
+            return (
+                sorted(DailyUserTotal.objects.values_list('date', 'user_id', 'archived', 'total', 'count')),
+                sorted(DailySplitMethodTotal.objects.values_list('date', 'split_method', 'archived', 'total', 'count')),
+            )
+
+        # Edits and deletes outside the write path recompute the days they touch
+        share = ExpenseShare.objects.filter(user=self.user2, date='2024-08-04').get()
+        share.amount = 1500
+        share.save()
+        Expenses.objects.get(description='2024-10-01').delete()
+        expense = Expenses.objects.get(description='2024-07-29')
+        expense.date = datetime.date(2024, 8, 4)
+        expense.save()
+        self.assertEqual(self.summary(**{'from': '2024-07-01'}), [
+            {'period': '2024-08-01', 'user': self.user1.id, 'total': '45.00', 'count': 3},
+            {'period': '2024-08-01', 'user': self.user2.id, 'total': '20.00', 'count': 2},
+        ])
+        self.assertEqual(self.summary(group_by='split_method', granularity='day'), [
+            {'period': '2024-08-04', 'split_method': 'equal', 'total': '30.00', 'count': 2},
+            {'period': '2024-08-05', 'split_method': 'exact', 'total': '30.00', 'count': 1},
+        ])
+
+        # ... and leave the rollups as a rebuild from the tables would
+        maintained = rollups()
+        rebuild_daily_totals()
+        self.assertEqual(rollups(), maintained)
+
+    def test_invalid_parameters(self):
+        for params in ({'granularity': 'year'}, {'from': '2024-09-01', 'to': '2024-08-01'}, {'group_by': 'split_method', 'user': 1}):
+            response = self.client.get(reverse('report-summary'), params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,148 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import skipUnless
+
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test import Client, SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from ..models import User
+from ..routers import (
+    STICKY_COOKIE, LeastRecentlyUsedSelector, ReplicaRouter, RoundRobinSelector, Routing, current_routing,
+)
+
+REPLICA = 'replica'
+
+
+# Test-only stand-in for replication between two SQLite databases: `replicate` copies
+# the primary into the replica file with the SQLite backup API. In between, the replica
+# lags behind like a real one would.
+class SQLiteReplication:
+
+    def __init__(self, primary, replica):
+        self.primary = primary
+        self.replica = replica
+
+    def replicate(self):
+        # Django's connection to the replica would keep reading its old snapshot
+        connections[self.replica].close()
+        connections[self.primary].ensure_connection()
+        target = sqlite3.connect(connections.settings[self.replica]['NAME'])
+        try:
+            connections[self.primary].connection.backup(target)
+        finally:
+            target.close()
+
+
+# Test case for reads from a replica and read-your-writes stickiness
+@skipUnless(connection.vendor == 'sqlite', "The replication stand-in copies SQLite databases")
+@override_settings(EXPENSES_READ_REPLICAS=[REPLICA], EXPENSES_REPLICA_STICKY_SECONDS=5)
+class ReplicaRoutingTest(TransactionTestCase):
+    # The primary and the replica registered below
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # A second SQLite file, registered as the replica for the duration of the tests.
+        # It is not a test database: every test starts by replicating the primary into it.
+        cls.directory = tempfile.mkdtemp()
+        connections.settings[REPLICA] = dict(
+            connections.settings['default'], NAME=os.path.join(cls.directory, 'replica.sqlite3'),
+        )
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+        self.replication = SQLiteReplication('default', REPLICA)
+        self.replication.replicate()
+        self.writer = Client()
+        self.reader = Client()
+
+    def create_expense(self):
+        response = self.writer.post(reverse('create-expense'), {
+            'description': 'Dinner', 'total_amount': '100.00', 'split_method': 'equal', 'paid_by': self.user1.id,
+            'shares': [{'user': self.user1.id}, {'user': self.user2.id}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response
+
+    def owed(self, client):
+        return client.get(reverse('user-balance', args=[self.user2.id])).data['total_owed']
+
+    def test_reads_go_to_the_replica(self):
+        self.create_expense()
+        # The replica has not caught up with the write yet
+        self.assertEqual(self.owed(self.reader), '0.00')
+        self.replication.replicate()
+        self.assertEqual(self.owed(self.reader), '50.00')
+
+    def test_writers_read_their_own_writes(self):
+        response = self.create_expense()
+        self.assertEqual(response.cookies[STICKY_COOKIE]['max-age'], 5)
+        self.assertEqual(self.owed(self.writer), '50.00')
+        # Once the cookie expires the writer reads from the replica again
+        del self.writer.cookies[STICKY_COOKIE]
+        self.assertEqual(self.owed(self.writer), '0.00')
+        # Failed writes do not make the client sticky
+        response = self.reader.post(reverse('create-expense'), {'description': 'Broken'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    def test_streamed_balance_sheet_reads_from_the_replica(self):
+        self.create_expense()
+        response = self.reader.get(reverse('download-balance-sheet'))
+        self.assertNotIn(b'Dinner', b''.join(response.streaming_content))
+        response.close()
+        self.replication.replicate()
+        response = self.reader.get(reverse('download-balance-sheet'))
+        self.assertIn(b'Dinner', b''.join(response.streaming_content))
+        response.close()
+
+
+# Test case for the replica selection and the router itself
+@override_settings(EXPENSES_READ_REPLICAS=['replica1', 'replica2'], EXPENSES_REPLICA_SELECTION='least_recently_used')
+class ReplicaRouterTest(SimpleTestCase):
+
+    def test_round_robin(self):
+        selector = RoundRobinSelector(['replica1', 'replica2'])
+        self.assertEqual([selector.acquire() for _ in range(3)], ['replica1', 'replica2', 'replica1'])
+
+    def test_least_recently_used(self):
+        selector = LeastRecentlyUsedSelector(['replica1', 'replica2'])
+        self.assertEqual([selector.acquire(), selector.acquire()], ['replica1', 'replica2'])
+        selector.release('replica2')
+        # replica1 is still serving its request
+        self.assertEqual(selector.acquire(), 'replica2')
+        selector.release('replica2')
+        selector.release('replica1')
+        self.assertEqual(selector.acquire(), 'replica2')
+
+    def test_one_replica_per_request_until_it_writes(self):
+        router = ReplicaRouter()
+        routing = Routing()
+        token = current_routing.set(routing)
+        try:
+            # Reads outside an eligible request stay on the primary
+            self.assertIsNone(router.db_for_read(User))
+            routing.allowed = True
+            self.assertEqual([router.db_for_read(User), router.db_for_read(User)], ['replica1', 'replica1'])
+            self.assertEqual(router.db_for_write(User), 'default')
+            self.assertIsNone(router.db_for_read(User))
+        finally:
+            current_routing.reset(token)
+        routing.release()
+        self.assertEqual(router.selector(['replica1', 'replica2']).in_flight, {'replica1': 0, 'replica2': 0})
+        self.assertIs(router.allow_migrate('replica1', 'expenses_app'), False)
+        self.assertIsNone(router.allow_migrate('default', 'expenses_app'))
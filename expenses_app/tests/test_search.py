@@ -0,0 +1,99 @@
+import datetime
+from unittest import mock
+
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..archive import close_period
+from ..search import SEARCHES, fts5_query, parse_query, tsquery
+from .base import ExpenseTestMixin
+
+# Test case for the full-text search over the expense descriptions
+class ExpenseSearchTest(ExpenseTestMixin, APITestCase):
+
+    def search(self, expected_status=status.HTTP_200_OK, **params):
+        response = self.client.get(reverse('expense-search'), params)
+        self.assertEqual(response.status_code, expected_status)
+        return response.data
+
+    def found(self, **params):
+        return [expense['description'] for expense in self.search(**params)['results']]
+
+    def test_words_and_prefixes(self):
+        self.create_expense('Dinner in Paris')
+        self.create_expense('Dinner at the café')
+        self.create_expense('Taxi to the airport')
+        self.assertEqual(self.found(q='paris'), ['Dinner in Paris'])
+        # Every word must match, whatever the case and punctuation
+        self.assertEqual(self.found(q='DINNER, café!'), ['Dinner at the café'])
+        self.assertEqual(sorted(self.found(q='din*')), ['Dinner at the café', 'Dinner in Paris'])
+        self.assertEqual(self.found(q='din'), [])
+        data = self.search(q='taxi')
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(data['results'][0]['shares'][0]['amount'], '50.00')
+
+    def test_ranking(self):
+        self.create_expense('Wine tasting')
+        self.create_expense('Groceries and a bottle of wine for the dinner party')
+        self.create_expense('Wine')
+        self.assertEqual(self.found(q='wine'), ['Wine', 'Wine tasting', 'Groceries and a bottle of wine for the dinner party'])
+        self.assertEqual(self.found(q='wine', page_size=1), ['Wine'])
+        # Every match is ranked, however many newer ones there are
+        for _ in range(5):
+            self.create_expense('Groceries and a bottle of wine for the dinner party')
+        self.assertEqual(self.found(q='wine', page_size=2), ['Wine', 'Wine tasting'])
+        self.assertEqual(self.found(q='wine', user=self.user1.id, date_from='2000-01-01', page_size=2), ['Wine', 'Wine tasting'])
+
+    def test_unsupported_databases(self):
+        with mock.patch.dict(SEARCHES, clear=True):
+            data = self.search(status.HTTP_501_NOT_IMPLEMENTED, q='wine')
+        self.assertIn('not supported', data['errors'])
+
+    def test_index_follows_updates_and_deletions(self):
+        expense = self.create_expense('Lunch')
+        expense.description = 'Brunch'
+        expense.save()
+        self.assertEqual((self.found(q='lunch'), self.found(q='brunch')), ([], ['Brunch']))
+        expense.delete()
+        self.assertEqual(self.found(q='brunch'), [])
+
+        # Bulk inserts of the batch endpoint are indexed as well
+        response = self.client.post(reverse('create-expense-batch'), {'expenses': [{
+            'description': 'Museum tickets', 'total_amount': '30.00', 'split_method': 'equal',
+            'shares': [{'user': self.user1.id}],
+        }]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.found(q='museum'), ['Museum tickets'])
+
+    def test_filters(self):
+        self.create_expense('Hotel in Rome', users=[self.user1, self.user2], date=datetime.date(2024, 3, 1))
+        self.create_expense('Hotel in Oslo', users=[self.user1, self.user3], date=datetime.date(2024, 5, 1))
+        self.assertEqual(self.found(q='hotel', user=self.user3.id), ['Hotel in Oslo'])
+        self.assertEqual(self.found(q='hotel', user=self.user1.id, date_to='2024-04-01'), ['Hotel in Rome'])
+        self.assertEqual(self.found(q='hotel', date_from='2024-04-01', date_to='2024-06-01'), ['Hotel in Oslo'])
+
+    def test_archived_expenses(self):
+        self.create_expense('Old rent', date=datetime.date(2024, 1, 10))
+        self.create_expense('New rent')
+        with self.captureOnCommitCallbacks(execute=True):
+            close_period(datetime.date(2024, 1, 31))
+        self.assertEqual(self.found(q='rent'), ['New rent'])
+        self.assertEqual(self.found(q='rent', include_archived=True), ['New rent', 'Old rent'])
+        data = self.search(q='old', include_archived=True, user=self.user2.id)
+        self.assertEqual(data['results'][0]['shares'][1]['user'], self.user2.id)
+
+    def test_invalid_queries(self):
+        self.assertIn('q', self.search(status.HTTP_400_BAD_REQUEST)['errors'])
+        self.assertIn('q', self.search(status.HTTP_400_BAD_REQUEST, q='*"()')['errors'])
+        self.search(status.HTTP_400_BAD_REQUEST, q='rent', date_from='2024-02-01', date_to='2024-01-01')
+        self.search(status.HTTP_400_BAD_REQUEST, q='rent', page_size=0)
+
+    def test_queries_cannot_inject_search_syntax(self):
+        terms = parse_query('Café OR "taxi" NEAR(din*)')
+        self.assertEqual(terms, [('café', False), ('or', False), ('taxi', False), ('near', False), ('din', True)])
+        self.assertEqual(
+            fts5_query(terms, user_id=7),
+            'description : "café" AND description : "or" AND description : "taxi" AND description : "near" '
+            'AND description : "din"* AND users : "7"',
+        )
+        self.assertEqual(tsquery(terms), 'café & or & taxi & near & din:*')
@@ -29,7 +29,7 @@ class ExpenseShareSerializerTest(TestCase):
 
     def setUp(self):
         self.user = User.objects.create(email='test@example.com', name='Test User', mobile_number='1234567890')
-        self.expense = Expenses.objects.create(description='Test Expense', total_amount=1000, split_method='exact', date='2023-01-01')
+        self.expense = Expenses.objects.create(description='Test Expense', total_amount=100000, split_method='exact', date='2023-01-01')
 
     def test_valid_expense_share_serializer(self):
         share_data = {
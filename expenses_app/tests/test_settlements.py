@@ -0,0 +1,57 @@
+import random
+
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..models import User, UserBalance
+from ..settlements import settle
+from .base import ExpenseTestMixin
+
+# Test case for the greedy settlement algorithm
+class SettleTest(SimpleTestCase):
+
+    def test_transfers_clear_every_balance(self):
+        rng = random.Random(7)
+        user_ids = list(range(1, 501))
+        cents = [rng.randint(-50000, 50000) for _ in user_ids[:-1]]
+        cents.append(-sum(cents))  # Net balances always sum to zero
+        transfers = settle(user_ids, cents)
+
+        remaining = dict(zip(user_ids, cents))
+        for debtor, creditor, amount in transfers:
+            self.assertGreater(amount, 0)
+            remaining[debtor] += amount
+            remaining[creditor] -= amount
+        self.assertTrue(all(amount == 0 for amount in remaining.values()))
+        self.assertLess(len(transfers), len(user_ids))
+
+    def test_largest_debtor_pays_largest_creditor(self):
+        self.assertEqual(settle([1, 2, 3], [-300, 100, 200]), [(1, 3, 200), (1, 2, 100)])
+
+# Test case for payer tracking and the settlements endpoint
+class SettlementsViewTest(ExpenseTestMixin, APITestCase):
+
+    def test_settlements(self):
+        expense = self.create_expense('Dinner', 300, self.users, paid_by=self.user1)
+        self.assertEqual(expense.paid_by_id, self.user1.id)
+        self.create_expense('Ride', 60, [self.user3], paid_by=self.user2, split_method='exact', shares=[{'amount': 60}])
+        # Expenses without a payer do not affect who owes whom
+        self.create_expense('Unpaid', 1000, [self.user3])
+
+        # The ledger holds integer cents
+        balances = dict(UserBalance.objects.values_list('user_id', 'net_balance'))
+        self.assertEqual(balances, {self.user1.id: 20000, self.user2.id: -4000, self.user3.id: -16000})
+        self.assertEqual(UserBalance.objects.get(user=self.user1).total_paid, 30000)
+
+        response = self.client.get(reverse('settlements'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['transfers'], [
+            {'from_user': self.user3.id, 'to_user': self.user1.id, 'amount': '160.00'},
+            {'from_user': self.user2.id, 'to_user': self.user1.id, 'amount': '40.00'},
+        ])
+
+    def test_unknown_payer(self):
+        response = self.post_expense(self.expense_data('Dinner', 100, [self.user1], paid_by=User(id=9999)))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('paid_by', response.data['errors'])
@@ -0,0 +1,286 @@
+import csv
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock, skipUnless
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from ..archive import close_period
+from ..changes import encode_token
+from ..checks import check_shard_databases
+from ..ledger import compute_balances
+from ..models import User, Group, Expenses, ExpenseShare, UserBalance, ArchivedExpense, ArchivedExpenseShare
+from ..routers import ShardRouter
+from ..seeding import flush_dataset, seed_dataset
+from ..sharding import SHARD_ID_SPAN, expense_shard, group_shard, shard_for, use_shard
+from .base import ExpenseTestMixin
+
+SHARDS = ['default', 'shard1']
+
+
+# Test case for expenses spread over two SQLite databases
+@skipUnless(connection.vendor == 'sqlite', "The second shard is a temporary SQLite file")
+@override_settings(EXPENSES_SHARDS=SHARDS, EXPENSES_CHANGES_SETTLE_SECONDS=0)
+class ShardingTest(ExpenseTestMixin, TransactionTestCase):
+    # The default database and the shard registered below
+    databases = '__all__'
+    # Consecutive ids: one user per shard
+    user_count = 2
+
+    @classmethod
+    def setUpClass(cls):
+        # A second SQLite file, registered as the shard for the duration of the tests
+        cls.directory = tempfile.mkdtemp()
+        connections.settings['shard1'] = dict(
+            connections.settings['default'], NAME=os.path.join(cls.directory, 'shard1.sqlite3'),
+        )
+        super().setUpClass()
+        call_command('migrate', database='shard1', verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['shard1'].close()
+        del connections['shard1']
+        del connections.settings['shard1']
+        shutil.rmtree(cls.directory)
+
+    def create_expenses(self):
+        # Four expenses alternating between the shards, in date order
+        payers = [self.user1, self.user2, self.user1, self.user2]
+        return [
+            self.create_expense(f'Expense {index}', paid_by=payer, date=datetime.date(2024, 1, 1 + index))
+            for index, payer in enumerate(payers)
+        ]
+
+    def get(self, name, *args, **params):
+        response = self.client.get(reverse(name, args=args), params)
+        self.assertEqual(response.status_code, 200, getattr(response, 'data', None))
+        return response
+
+    def test_writes_go_to_the_shard_of_the_payer(self):
+        expenses = self.create_expenses()
+        self.assertEqual({expense._state.db for expense in expenses}, set(SHARDS))
+        for expense in expenses:
+            alias = expense._state.db
+            self.assertEqual(ExpenseShare.objects.using(alias).filter(expense_id=expense.id).count(), 2)
+            # Ids are handed out from the range of the shard
+            self.assertEqual(expense.id // SHARD_ID_SPAN, SHARDS.index(alias))
+        # Every shard keeps the ledger of its own expenses
+        for alias in SHARDS:
+            self.assertEqual(UserBalance.objects.using(alias).get(user=self.user1).total_owed, 10000)
+        # Users are copied to the other shard, and so are their changes
+        self.user1.name = 'User 1'
+        self.user1.save()
+        self.assertEqual(User.objects.using('shard1').get(id=self.user1.id).name, 'User 1')
+
+    def test_bulk_upserted_users_are_copied(self):
+        user = {'email': 'user3@example.com', 'name': 'User Three', 'mobile_number': '1234567892'}
+        response = self.client.post(reverse('bulk-upsert-users'), {
+            'users': [user, {'email': 'user1@example.com', 'name': 'User 1', 'mobile_number': '1234567890'}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        copies = User.objects.using('shard1').order_by('id').values_list('name', flat=True)
+        self.assertEqual(list(copies), ['User 1', 'User Two', 'User Three'])
+
+    def test_group_expenses_stay_on_the_shard_of_the_group(self):
+        response = self.client.post(reverse('create-group'), {
+            'name': 'Trip', 'members': [self.user1.id, self.user2.id],
+        }, content_type='application/json')
+        group_id = response.data['id']
+        self.assertTrue(Group.objects.using('shard1').filter(id=group_id).exists())
+        for index, payer in enumerate([self.user1, self.user2]):
+            expense = self.create_expense(f'Trip {index}', paid_by=payer, date=datetime.date(2024, 2, 1 + index), group=group_id)
+            self.assertEqual(expense._state.db, group_shard(group_id))
+
+        data = self.get('group-expenses', group_id).data
+        self.assertEqual([expense['description'] for expense in data['results']], ['Trip 0', 'Trip 1'])
+        members = self.get('group-balances', group_id).data['members']
+        self.assertEqual([member['total_paid'] for member in members], ['100.00', '100.00'])
+        sheet = b''.join(self.get('group-balance-sheet', group_id).streaming_content).decode()
+        self.assertEqual(sheet.count('Trip'), 6)
+
+    def test_listings_merge_the_shards(self):
+        expenses = self.create_expenses()
+        data = self.get('overall-expenses', page_size=3).data
+        self.assertEqual([expense['id'] for expense in data['results']], [expense.id for expense in expenses[:3]])
+        self.assertEqual([share['amount'] for share in data['results'][1]['shares']], ['50.00', '50.00'])
+        data = self.client.get(data['next']).data
+        self.assertEqual(([expense['id'] for expense in data['results']], data['next']), ([expenses[3].id], None))
+
+        data = self.get('user-expenses', self.user2.id).data
+        self.assertEqual([share['description'] for share in data['results']], [f'Expense {index}' for index in range(4)])
+        balance = self.get('user-balance', self.user1.id).data
+        self.assertEqual((balance['total_owed'], balance['expense_count'], balance['net_balance']), ('200.00', 4, '0.00'))
+
+    def test_balance_sheet_merges_the_shards(self):
+        expenses = self.create_expenses()
+        response = self.get('download-balance-sheet')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        individual = [row[:2] for row in rows if len(row) == 7 and row[0] != 'User']
+        # Every user's shares in expense id order, whatever their shard
+        ordered = sorted(expenses, key=lambda expense: expense.id)
+        self.assertEqual(individual, [
+            [user.name, expense.description] for user in (self.user1, self.user2) for expense in ordered
+        ])
+        overall = [row[0] for row in rows if len(row) == 4 and row[0] != 'Description']
+        self.assertEqual(overall, [expense.description for expense in ordered])
+
+    def test_batches_span_the_shards(self):
+        expense = {
+            'description': 'Taxi', 'total_amount': '30.00', 'split_method': 'equal',
+            'shares': [{'user': self.user1.id}, {'user': self.user2.id}],
+        }
+        batch = [dict(expense, paid_by=self.user1.id), dict(expense, paid_by=self.user2.id)]
+        response = self.client.post(reverse('create-expense-batch'), {'expenses': batch}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        ids = [result['id'] for result in response.data['results']]
+        shards = [SHARDS.index(shard_for(user.id)) for user in (self.user1, self.user2)]
+        self.assertEqual([expense_id // SHARD_ID_SPAN for expense_id in ids], shards)
+
+        # Nothing is written on any shard when an item is invalid
+        response = self.client.post(reverse('create-expense-batch'), {
+            'expenses': batch + [dict(expense, paid_by=9999)],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(sum(Expenses.objects.using(alias).count() for alias in SHARDS), 2)
+
+    def test_reports_settlements_and_search_span_the_shards(self):
+        self.create_expense('Dinner in Paris', '100.00', paid_by=self.user1, date=datetime.date(2024, 1, 1))
+        self.create_expense('Dinner in Rome', '40.00', paid_by=self.user2, date=datetime.date(2024, 1, 2))
+        transfers = self.get('settlements').data['transfers']
+        self.assertEqual(transfers, [{'from_user': self.user2.id, 'to_user': self.user1.id, 'amount': '30.00'}])
+        users = self.get('report-user-totals').data['users']
+        self.assertEqual([(user['total_paid'], user['share_count']) for user in users], [('100.00', 2), ('40.00', 2)])
+        summary = self.get('report-summary', group_by='split_method').data['rows']
+        self.assertEqual([(row['total'], row['count']) for row in summary], [('140.00', 2)])
+        results = self.get('expense-search', q='dinner').data['results']
+        self.assertEqual(sorted(expense['description'] for expense in results), ['Dinner in Paris', 'Dinner in Rome'])
+
+    def test_period_close_runs_on_every_shard(self):
+        self.create_expenses()
+        debts = self.get('report-pairwise-debts').data
+        split_methods = self.get('report-split-methods').data
+        output = io.StringIO()
+        call_command('close_period', '2024-01-02', stdout=output)
+        self.assertEqual(output.getvalue().count('archived 1 expenses'), 2)
+        data = self.get('overall-expenses', include_archived='true').data
+        self.assertEqual(len(data['results']), 4)
+        users = self.get('report-user-totals').data['users']
+        self.assertEqual([user['share_count'] for user in users], [4, 4])
+        self.assertEqual(self.get('report-pairwise-debts').data, debts)
+        self.assertEqual(self.get('report-split-methods').data, split_methods)
+
+    def test_period_close_on_the_second_shard(self):
+        self.create_expenses()
+        # The shard holds two of the four expenses; the older one is archived
+        first, second = Expenses.objects.using('shard1').order_by('date')
+        # The archive copy and delete run on the shard's own connection
+        default, shard = CaptureQueriesContext(connections['default']), CaptureQueriesContext(connections['shard1'])
+        with default, shard, use_shard('shard1'):
+            period = close_period(first.date)
+        self.assertEqual((period.expense_count, period.share_count), (1, 2))
+        archived_table = ArchivedExpense._meta.db_table
+        self.assertTrue(any(archived_table in query['sql'] for query in shard.captured_queries))
+        self.assertFalse(any(archived_table in query['sql'] for query in default.captured_queries))
+        self.assertEqual(list(ArchivedExpense.objects.using('shard1').values_list('id', flat=True)), [first.id])
+        self.assertEqual(ArchivedExpenseShare.objects.using('shard1').count(), 2)
+        self.assertEqual(list(Expenses.objects.using('shard1').values_list('id', flat=True)), [second.id])
+        # The default shard keeps its open period
+        self.assertEqual(ArchivedExpense.objects.using('default').count(), 0)
+        self.assertEqual(Expenses.objects.using('default').count(), 2)
+
+    def sync(self, user, **params):
+        return self.get('user-changes', user.id, **params).data
+
+    def test_change_feed_spans_the_shards(self):
+        token = self.sync(self.user2)['token']
+        expenses = self.create_expenses()
+        # One change per page, from both shards (setting the date is a second change)
+        changed, since = [], token
+        while True:
+            data = self.sync(self.user2, since=since, page_size=1)
+            changed += [row['expense'] for row in data['changed']]
+            since = data['token']
+            if not data['has_more']:
+                break
+        self.assertEqual(len(changed), 2 * len(expenses))
+        self.assertEqual(set(changed), {expense.id for expense in expenses})
+        self.assertEqual(self.sync(self.user2, since=since)['changed'], [])
+
+        deleted = expenses[1]
+        deleted_id = deleted.id
+        deleted.delete()
+        data = self.sync(self.user2, since=since)
+        self.assertEqual((data['changed'], data['deleted']), ([], [deleted_id]))
+        # Tokens of another shard layout have to resync
+        response = self.client.get(reverse('user-changes', args=[self.user2.id]), {'since': encode_token([0])})
+        self.assertEqual(response.status_code, 410)
+
+    def test_seeding_and_imports_write_to_the_shards(self):
+        flush_dataset()
+        users, expenses, shares = seed_dataset(6, 40, seed=1)
+        self.assertEqual(sum(Expenses.objects.using(alias).count() for alias in SHARDS), expenses)
+        self.assertTrue(all(Expenses.objects.using(alias).exists() for alias in SHARDS))
+        self.assertEqual(User.objects.using('shard1').count(), users)
+        for alias in SHARDS:
+            with use_shard(alias):
+                ledger = {row.pop('user'): row for row in UserBalance.objects.values('user', 'total_owed', 'total_paid')}
+                self.assertEqual(
+                    {user_id: {'total_owed': row['total_owed'], 'total_paid': row['total_paid']} for user_id, row in compute_balances().items()},
+                    ledger,
+                )
+
+        payers = list(User.objects.order_by('id')[:2])
+        path = os.path.join(self.directory, 'import.jsonl')
+        with open(path, 'w') as f:
+            for index, payer in enumerate(payers):
+                f.write(json.dumps({
+                    'description': f'Imported {index}', 'total_amount': '10.00', 'split_method': 'equal',
+                    'date': '2019-05-01', 'paid_by': payer.email, 'shares': [{'user': user.email} for user in payers],
+                }) + '\n')
+        call_command('import_expenses', path, stdout=io.StringIO())
+        for payer in payers:
+            alias = shard_for(payer.id)
+            expense = Expenses.objects.using(alias).get(description__startswith='Imported', paid_by=payer)
+            self.assertEqual((expense.date, expense.id // SHARD_ID_SPAN), (datetime.date(2019, 5, 1), SHARDS.index(alias)))
+            self.assertEqual(ExpenseShare.objects.using(alias).filter(expense=expense).count(), 2)
+
+    def test_unsupported_shard_databases_fail_the_checks(self):
+        self.assertEqual(check_shard_databases(None), [])
+        with mock.patch.object(connections['shard1'], 'vendor', 'mysql'):
+            errors = check_shard_databases(None)
+        self.assertEqual([(error.id, error.obj) for error in errors], [('expenses_app.E001', 'shard1')])
+        self.assertIn('not supported on mysql', errors[0].msg)
+
+
+# Test case for the placement of expenses and the router
+@override_settings(EXPENSES_SHARDS=SHARDS)
+class ShardRouterTest(SimpleTestCase):
+
+    def test_placement(self):
+        group, payer, user = Group(id=3), User(id=4), User(id=5)
+        self.assertEqual(expense_shard({'group': group, 'paid_by': payer}), 'shard1')
+        self.assertEqual(expense_shard({'group': None, 'paid_by': payer}), 'default')
+        self.assertEqual(expense_shard({'paid_by': None, 'shares': [{'user': user}]}), 'shard1')
+
+    def test_routing(self):
+        router = ShardRouter()
+        # Users stay on the default database, the default shard is left to the next router
+        with use_shard('shard1'):
+            self.assertEqual((router.db_for_read(Expenses), router.db_for_write(UserBalance)), ('shard1', 'shard1'))
+            self.assertIsNone(router.db_for_read(User))
+        with use_shard('default'):
+            self.assertIsNone(router.db_for_write(Expenses))
+        expense = Expenses()
+        expense._state.db = 'shard1'
+        self.assertEqual(router.db_for_read(ExpenseShare, instance=expense), 'shard1')
+        self.assertIsNone(router.db_for_read(ExpenseShare))
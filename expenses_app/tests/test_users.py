@@ -0,0 +1,102 @@
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from ..models import User, Expenses
+from ..users import user_cache
+
+
+def user_data(index, name=None):
+    return {'email': f'user{index}@example.com', 'name': name or f'User {index}', 'mobile_number': f'12345678{index:02d}'}
+
+
+# Test case for the bulk user upsert endpoint
+class BulkUpsertTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+
+    def upsert(self, users, expected_status=status.HTTP_200_OK):
+        response = self.client.post(reverse('bulk-upsert-users'), {'users': users}, format='json')
+        self.assertEqual(response.status_code, expected_status)
+        return response.data
+
+    def test_creates_and_updates_by_email(self):
+        data = self.upsert([user_data(1), user_data(2)])
+        self.assertEqual((data['created'], data['updated']), (2, 0))
+        ids = [user['id'] for user in data['users']]
+        self.assertEqual(ids, list(User.objects.order_by('email').values_list('id', flat=True)))
+        detail = reverse('user-detail', args=[ids[0]])
+        self.assertEqual(self.client.get(detail).data['name'], 'User 1')
+
+        # Existing users keep their id, whatever their position in the batch
+        data = self.upsert([user_data(3), user_data(1, 'Renamed')])
+        self.assertEqual((data['created'], data['updated']), (1, 1))
+        self.assertEqual(data['users'][1], {'id': ids[0], **user_data(1, 'Renamed')})
+        self.assertEqual(User.objects.count(), 3)
+        # Cached responses of the updated users are invalidated
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upsert([user_data(1, 'Renamed again')])
+        self.assertEqual(self.client.get(detail).data['name'], 'Renamed again')
+
+    def test_runs_a_constant_number_of_queries(self):
+        self.upsert([user_data(index) for index in range(10)])
+        with CaptureQueriesContext(connection) as queries:
+            self.upsert([user_data(index) for index in range(40)])
+        self.assertLessEqual(len(queries), 5)
+        self.assertEqual(User.objects.count(), 40)
+
+    def test_invalid_batches(self):
+        self.upsert([], status.HTTP_400_BAD_REQUEST)
+        errors = self.upsert([user_data(1), user_data(1, 'Again')], status.HTTP_400_BAD_REQUEST)['errors']
+        self.assertIn('user1@example.com', str(errors['users']))
+        errors = self.upsert([user_data(1), {'email': 'not an email', 'name': 'X'}], status.HTTP_400_BAD_REQUEST)['errors']
+        self.assertEqual(set(errors['users'][1]), {'email', 'mobile_number'})
+        self.assertFalse(User.objects.exists())
+
+
+# Test case for the user cache of the expense validation
+class UserCacheTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        self.users = [User.objects.create(**user_data(index)) for index in range(3)]
+
+    def create_expense(self, users):
+        return self.client.post(reverse('create-expense'), {
+            'description': 'Dinner', 'total_amount': '90.00', 'split_method': 'equal',
+            'paid_by': users[0].id, 'shares': [{'user': user.id} for user in users],
+        }, format='json')
+
+    def user_queries(self, users):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.create_expense(users)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return sum(1 for query in queries if 'FROM "expenses_app_user"' in query['sql'])
+
+    def test_one_query_per_expense_at_most(self):
+        self.assertEqual(self.user_queries(self.users), 1)
+        self.assertEqual(self.user_queries(self.users), 0)
+        self.assertEqual(self.user_queries(self.users[1:]), 0)
+        self.assertEqual(user_cache.stats()['size'], 3)
+
+    def test_deleted_users_are_forgotten(self):
+        self.user_queries(self.users)
+        User.objects.filter(id=self.users[2].id).delete()
+        response = self.create_expense(self.users)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('does not exist', str(response.data['errors']['shares']))
+        self.assertEqual(Expenses.objects.count(), 1)
+
+    def test_bounded_and_expiring(self):
+        with self.settings(EXPENSES_USER_CACHE_SIZE=2):
+            self.assertEqual(user_cache.in_bulk([user.id for user in self.users]).keys(), {user.id for user in self.users})
+            self.assertEqual(user_cache.stats()['size'], 2)
+        with self.settings(EXPENSES_USER_CACHE_TIMEOUT=0):
+            user_cache.in_bulk([self.users[0].id])
+            with self.assertNumQueries(1):
+                user_cache.in_bulk([self.users[0].id])
@@ -1,6 +1,8 @@
+from django.core.cache import cache
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
+from ..metrics import metrics_registry
 from ..models import User, Expenses, ExpenseShare
 
 # Test case for creating a user
@@ -30,15 +32,16 @@ class UserCreateViewTest(APITestCase):
 class ExpenseAPITestCase(APITestCase):
 
     def setUp(self):
+        cache.clear()  # Cached responses outlive the test transaction
         # Create test users
         self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
         self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
         self.user3 = User.objects.create(email='user3@example.com', name='User Three', mobile_number='1234567892')
         
         # Create a test expense with equal split
-        self.expense1 = Expenses.objects.create(description='Test Expense 1', total_amount=1000, split_method='equal', date='2023-01-01')
-        ExpenseShare.objects.create(expense=self.expense1, user=self.user1, amount=500, percentage=50)
-        ExpenseShare.objects.create(expense=self.expense1, user=self.user2, amount=500, percentage=50)
+        self.expense1 = Expenses.objects.create(description='Test Expense 1', total_amount=100000, split_method='equal', date='2023-01-01')
+        ExpenseShare.objects.create(expense=self.expense1, user=self.user1, amount=50000, percentage=50)
+        ExpenseShare.objects.create(expense=self.expense1, user=self.user2, amount=50000, percentage=50)
 
     def test_create_expense_equal_split(self):
         url = reverse('create-expense')  # Adjust the URL name based on your URL patterns
@@ -136,6 +139,148 @@ class ExpenseAPITestCase(APITestCase):
         url = reverse('download-balance-sheet')  # Adjust the URL name based on your URL patterns
         self.client.force_authenticate(user=self.user1)  # Authenticate the request
         response = self.client.get(url)  # Make a GET request to download the balance sheet
-        print('Download Balance Sheet Response data:', response.content)
+        content = b''.join(response.streaming_content)  # The balance sheet is streamed
+        print('Download Balance Sheet Response data:', content)
         self.assertEqual(response.status_code, status.HTTP_200_OK)  # Check if the request is successful
         self.assertTrue(response['Content-Type'], 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')  # Check if the response is an Excel file
+
+    def test_download_balance_sheet_layout(self):
+        url = reverse('download-balance-sheet')
+        metrics_registry.reset()
+        # Three lookups for the ETag / Last-Modified validators (two index-only MAX queries
+        # and the user table version), then users, shares and expenses are each read with
+        # a single query
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+            content = b''.join(response.streaming_content).decode()
+        # The header is sent before the rows are read; the metrics count them all
+        self.assertIn('db;desc="3 queries"', response['Server-Timing'])
+        self.assertEqual(metrics_registry.routes['download-balance-sheet', 'GET'].queries, 6)
+        expected = [
+            'Individual Expenses',
+            '',
+            'User,Description,Total_Amount,Split_Method,Date,Share_Amount,Share_Percentage',
+            'User One,Test Expense 1,1000.00,equal,%s,500.00,50.00' % self.expense1.date,
+            '',
+            'User Two,Test Expense 1,1000.00,equal,%s,500.00,50.00' % self.expense1.date,
+            '',
+            '',  # User Three has no expenses
+            '',
+            'Overall Expenses',
+            'Description,Total_Amount,Split_Method,Date',
+            'Test Expense 1,1000.00,equal,%s' % self.expense1.date,
+        ]
+        self.assertEqual(content.splitlines(), expected)
+
+# Test case for keyset pagination of the expense listings
+class ExpensePaginationTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()  # Cached responses outlive the test transaction
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+        for i in range(5):
+            expense = Expenses.objects.create(description=f'Expense {i}', total_amount=10000, split_method='equal')
+            ExpenseShare.objects.create(expense=expense, user=self.user1, amount=5000, percentage=50)
+            ExpenseShare.objects.create(expense=expense, user=self.user2, amount=5000, percentage=50)
+
+    def collect_pages(self, url, page_size):
+        # Follow the `next` links and return every page
+        pages = []
+        while url:
+            response = self.client.get(url, {'page_size': page_size} if not pages else None)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data['results'])
+            url = response.data['next']
+        return pages
+
+    def test_overall_expenses_pages(self):
+        pages = self.collect_pages(reverse('overall-expenses'), 2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        descriptions = [expense['description'] for page in pages for expense in page]
+        self.assertEqual(descriptions, [f'Expense {i}' for i in range(5)])
+        self.assertEqual(len(pages[0][0]['shares']), 2)
+
+    def test_user_expenses_pages(self):
+        pages = self.collect_pages(reverse('user-expenses', args=[self.user1.id]), 3)
+        self.assertEqual([len(page) for page in pages], [3, 2])
+        self.assertEqual(pages[1][-1]['description'], 'Expense 4')
+
+    def test_page_query_count_is_constant(self):
+        url = reverse('overall-expenses')
+        # Two validator lookups, one query for the expenses and one for their shares
+        with self.assertNumQueries(4):
+            self.client.get(url, {'page_size': 5})
+        url = reverse('user-expenses', args=[self.user1.id])
+        # One validator lookup, one query for the user and one for the page of shares
+        with self.assertNumQueries(3):
+            self.client.get(url, {'page_size': 5})
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('overall-expenses'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+# Test case for the batch expense endpoint
+class ExpenseBatchCreateViewTest(APITestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create(email='user1@example.com', name='User One', mobile_number='1234567890')
+        self.user2 = User.objects.create(email='user2@example.com', name='User Two', mobile_number='1234567891')
+        self.url = reverse('create-expense-batch')
+
+    def expense(self, description, **extra):
+        data = {
+            'description': description,
+            'total_amount': 100,
+            'split_method': 'equal',
+            'shares': [{'user': self.user1.id}, {'user': self.user2.id}],
+        }
+        data.update(extra)
+        return data
+
+    def test_create_batch(self):
+        expenses = [self.expense(f'Expense {i}') for i in range(10)]
+        expenses.append(self.expense('Exact', split_method='exact', shares=[
+            {'user': self.user1.id, 'amount': 70},
+            {'user': self.user2.id, 'amount': 30},
+        ]))
+        # Users, expense insert, share insert, two ledger statements, one upsert per daily
+        # rollup and the change feed insert, plus the transaction savepoint
+        with self.assertNumQueries(10):
+            response = self.client.post(self.url, {'expenses': expenses}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 11)
+        self.assertEqual(Expenses.objects.count(), 11)
+        self.assertEqual(ExpenseShare.objects.count(), 22)
+        exact = ExpenseShare.objects.get(expense__description='Exact', user=self.user1)
+        self.assertEqual(exact.amount, 7000)
+        self.assertEqual(exact.percentage, 70)
+
+    def test_all_or_nothing_rejects_whole_batch(self):
+        expenses = [
+            self.expense('Valid'),
+            self.expense('Unknown user', shares=[{'user': 9999}]),
+        ]
+        response = self.client.post(self.url, {'expenses': expenses}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([result['status'] for result in response.data['results']], ['skipped', 'error'])
+        self.assertIn('shares', response.data['results'][1]['errors'])
+        self.assertEqual(Expenses.objects.count(), 0)
+
+    def test_best_effort_keeps_valid_items(self):
+        expenses = [
+            self.expense('Valid'),
+            self.expense('Bad percentage', split_method='percentage', shares=[
+                {'user': self.user1.id, 'percentage': 60},
+                {'user': self.user2.id, 'percentage': 60},
+            ]),
+        ]
+        response = self.client.post(self.url, {'mode': 'best_effort', 'expenses': expenses}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([result['status'] for result in response.data['results']], ['created', 'error'])
+        self.assertEqual(list(Expenses.objects.values_list('description', flat=True)), ['Valid'])
+
+    def test_invalid_payload(self):
+        response = self.client.post(self.url, {'mode': 'sometimes', 'expenses': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data['errors'].keys()), {'mode', 'expenses'})
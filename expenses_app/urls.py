@@ -1,14 +1,41 @@
 from django.urls import path
 from .views import (
-    UserCreateView, UserDetailView, ExpenseCreateView,
-    UserExpensesView, OverallExpensesView, DownloadBalanceSheet
+    UserCreateView, UserBulkUpsertView, UserDetailView, ExpenseCreateView,
+    UserExpensesView, UserChangesView, OverallExpensesView, ExpenseSearchView, DownloadBalanceSheet,
+    ExpenseBatchCreateView, UserBalanceView, SettlementsView,
+    UserTotalsReportView, PairwiseDebtsReportView, SplitMethodReportView, SummaryReportView,
+    ExportCreateView, ExportDetailView, ExportDownloadView,
+    GroupCreateView, GroupDetailView, GroupMembersView, GroupExpensesView,
+    GroupBalancesView, GroupBalanceSheetView,
+    CacheStatsView, MetricsView,
 )
 
 urlpatterns = [
     path('users/', UserCreateView.as_view(), name='create-user'),
+    path('users/bulk/', UserBulkUpsertView.as_view(), name='bulk-upsert-users'),
     path('users/<int:pk>/', UserDetailView.as_view(), name='user-detail'),
+    path('users/<int:pk>/balance/', UserBalanceView.as_view(), name='user-balance'),
     path('expenses/', ExpenseCreateView.as_view(), name='create-expense'),
+    path('expenses/batch/', ExpenseBatchCreateView.as_view(), name='create-expense-batch'),
     path('expenses/user/<int:user_id>/', UserExpensesView.as_view(), name='user-expenses'),
+    path('expenses/user/<int:user_id>/changes/', UserChangesView.as_view(), name='user-changes'),
     path('expenses/overall/', OverallExpensesView.as_view(), name='overall-expenses'),
+    path('expenses/search/', ExpenseSearchView.as_view(), name='expense-search'),
     path('users/download-balance-sheet/', DownloadBalanceSheet.as_view(), name='download-balance-sheet'),
+    path('groups/', GroupCreateView.as_view(), name='create-group'),
+    path('groups/<int:pk>/', GroupDetailView.as_view(), name='group-detail'),
+    path('groups/<int:pk>/members/', GroupMembersView.as_view(), name='group-members'),
+    path('groups/<int:pk>/expenses/', GroupExpensesView.as_view(), name='group-expenses'),
+    path('groups/<int:pk>/balances/', GroupBalancesView.as_view(), name='group-balances'),
+    path('groups/<int:pk>/balance-sheet/', GroupBalanceSheetView.as_view(), name='group-balance-sheet'),
+    path('exports/', ExportCreateView.as_view(), name='create-export'),
+    path('exports/<int:pk>/', ExportDetailView.as_view(), name='export-detail'),
+    path('exports/<int:pk>/download/', ExportDownloadView.as_view(), name='export-download'),
+    path('settlements/', SettlementsView.as_view(), name='settlements'),
+    path('reports/users/', UserTotalsReportView.as_view(), name='report-user-totals'),
+    path('reports/pairwise/', PairwiseDebtsReportView.as_view(), name='report-pairwise-debts'),
+    path('reports/split-methods/', SplitMethodReportView.as_view(), name='report-split-methods'),
+    path('reports/summary/', SummaryReportView.as_view(), name='report-summary'),
+    path('_cache/', CacheStatsView.as_view(), name='cache-stats'),
+    path('_metrics/', MetricsView.as_view(), name='metrics'),
 ]
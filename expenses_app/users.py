@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from .cache import response_cache
+from .conditional import touch_user_table
+from .models import User
+from .sharding import copy_to_shards, is_sharded
+
+# Users referenced by expenses, and the bulk upsert of the identity provider sync.
+#
+# Expense validation resolves payers and share users through `user_cache`: cached users
+# cost nothing, the others are read with a single query. Only the existence and the id of
+# a user matter there, so entries can only be wrong about deleted users. Saves and
+# deletions in this process drop their entries through the model signals; those made by
+# other processes are seen once entries are EXPENSES_USER_CACHE_TIMEOUT seconds old. At
+# most EXPENSES_USER_CACHE_SIZE users are kept, the least recently used are dropped first.
+
+# Users written, and emails looked up, per statement of a bulk upsert
+UPSERT_CHUNK_SIZE = 500
+
+
+# Bounded LRU of users by id, with expiring entries
+class UserCache:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'EXPENSES_USER_CACHE_SIZE', 10000)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'EXPENSES_USER_CACHE_TIMEOUT', 60)
+
+    def cached(self, user_ids):
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.entries.get(user_id)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    del self.entries[user_id]
+                    continue
+                self.entries.move_to_end(user_id)
+                found[user_id] = entry[0]
+            self.hits += len(found)
+            self.misses += len(user_ids) - len(found)
+        return found
+
+    def add(self, users):
+        expires = time.monotonic() + self.timeout
+        with self.lock:
+            for user in users:
+                self.entries[user.pk] = (user, expires)
+                self.entries.move_to_end(user.pk)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def in_bulk(self, user_ids):
+        # {id: user} of the existing users among `user_ids`, like User.objects.in_bulk, with
+        # at most one query for the users not cached
+        user_ids = set(user_ids)
+        found = self.cached(user_ids)
+        missing = user_ids - found.keys()
+        if missing:
+            loaded = User.objects.in_bulk(missing)
+            self.add(loaded.values())
+            found.update(loaded)
+        return found
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+user_cache = UserCache()
+
+
+def existing_emails(emails):
+    found = set()
+    for start in range(0, len(emails), UPSERT_CHUNK_SIZE):
+        found.update(User.objects.filter(email__in=emails[start:start + UPSERT_CHUNK_SIZE]).values_list('email', flat=True))
+    return found
+
+
+def upsert_users(rows):
+    # Create the users of `rows` (dicts of email, name and mobile number) whose email is
+    # new and update the others, with bulk statements that return the ids of both (SQLite,
+    # PostgreSQL). Returns (users, created emails). Bulk statements send no signals, so the
+    # caches and the shard copies are kept up to date here.
+    emails = [row['email'] for row in rows]
+    with transaction.atomic():
+        created = set(emails) - existing_emails(emails)
+        users = User.objects.bulk_create(
+            [User(**row) for row in rows],
+            update_conflicts=True, unique_fields=['email'], update_fields=['name', 'mobile_number'],
+            batch_size=UPSERT_CHUNK_SIZE,
+        )
+        user_ids = [user.pk for user in users]
+        touch_user_table()
+        response_cache.invalidate_users_on_commit(user_ids)
+        transaction.on_commit(lambda: user_cache.invalidate(user_ids))
+        if is_sharded():
+            transaction.on_commit(lambda: copy_to_shards(User, users))
+    return users, created
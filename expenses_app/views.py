@@ -1,13 +1,37 @@
 from django.shortcuts import render
+from django.urls import reverse
 
 from rest_framework import generics, status, permissions
-from .models import User, Expenses, ExpenseShare
-from .serializers import UserSerializer, ExpenseSerializer, ExpenseShareSerializer
+from django.conf import settings
+from .models import User, Group, GroupMembership, Expenses, UserBalance, ExportJob
+from .serializers import (
+    UserSerializer, UserBulkSerializer, ExpenseSerializer, ExpenseBatchSerializer,
+    UserBalanceSerializer, ExportJobSerializer, GroupSerializer, GroupMemberSerializer,
+    SummaryQuerySerializer, ChangesQuerySerializer, SearchQuerySerializer, include_archived,
+)
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.exceptions import ValidationError
-from django.http import HttpResponse
-import csv
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from .pagination import KeysetPagination
+from .balance_sheet import iter_balance_sheet_rows, stream_csv
+from .ingest import write_batch
+from .settlements import compute_settlements
+from .ledger import user_balance
+from .reports import pairwise_debts, period_summary, split_method_breakdown, user_totals
+from .cache import response_cache
+from .conditional import user_expenses_condition, global_condition, sheet_condition
+from .fast_serializers import (
+    expense_rows, share_rows, archived_expense_rows, archived_share_rows, serialize_expenses, serialize_shares,
+)
+from .metrics import metrics_registry
+from .exports import CONTENT_TYPES, download_name, export_path, refresh, sendfile_location, start_export
+from .groups import group_balances, group_expense_rows, group_sheet_querysets
+from .changes import ChangesExpired, changes_since, encode_token, head
+from .search import search_expenses
+from .idempotency import idempotent
+from .users import upsert_users
+from .sharding import group_shard
 
 # User creation view
 class UserCreateView(generics.CreateAPIView):
@@ -28,6 +52,24 @@ class UserCreateView(generics.CreateAPIView):
         except Exception as e:
             return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# Bulk user upsert view: creates the users whose email is new and updates the others
+class UserBulkUpsertView(APIView):
+
+    def post(self, request):
+        try:
+            serializer = UserBulkSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            users, created = upsert_users(serializer.validated_data['users'])
+            return Response({
+                "created": len(created),
+                "updated": len(users) - len(created),
+                "users": UserSerializer(users, many=True).data,
+            }, status=status.HTTP_200_OK)
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 # User detail view
 class UserDetailView(generics.RetrieveAPIView):
     queryset = User.objects.all()
@@ -35,34 +77,100 @@ class UserDetailView(generics.RetrieveAPIView):
 
     def retrieve(self, request, *args, **kwargs):
         try:
-            # Retrieve user details
-            return super().retrieve(request, *args, **kwargs)
-        except User.DoesNotExist:
+            # Serve the user details from the response cache when possible
+            key = response_cache.key('user-detail', request, user_ids=[kwargs['pk']])
+            data = response_cache.get(key)
+            if data is not None:
+                return Response(data)
+            response = super().retrieve(request, *args, **kwargs)
+            response_cache.set(key, response.data)
+            return response
+        except (User.DoesNotExist, Http404):
             return Response({"errors": "User not found."}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# User balance view
+class UserBalanceView(APIView):
+
+    def get(self, request, pk):
+        try:
+            # Read the user's row from the balance ledger
+            balance = user_balance(pk)
+            if balance is None:
+                # Users without any shares have no ledger row yet
+                if not User.objects.filter(id=pk).exists():
+                    return Response({"errors": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+                balance = UserBalance(user_id=pk)
+            serializer = UserBalanceSerializer(balance)
+            return Response(serializer.data)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 # User expenses view
 class UserExpensesView(APIView):
 
+    @user_expenses_condition
     def get(self, request, user_id):
         try:
-            # Retrieve expenses for a specific user
+            # Serve the page from the response cache when possible
+            key = response_cache.key('user-expenses', request, user_ids=[user_id])
+            data = response_cache.get(key)
+            if data is not None:
+                return Response(data)
+
+            # Retrieve expenses for a specific user, with those of closed periods when asked
             user = User.objects.get(id=user_id)
-            expenses = ExpenseShare.objects.filter(user=user)
-            serializer = ExpenseShareSerializer(expenses, many=True)
-            return Response(serializer.data)
+            querysets = [share_rows().filter(user=user)]
+            if include_archived(request.query_params):
+                querysets.append(archived_share_rows().filter(user=user))
+            paginator = KeysetPagination()
+            page = paginator.paginate_shards(querysets, request, view=self)
+            response = paginator.get_paginated_response(serialize_shares(page))
+            response_cache.set(key, response.data)
+            return response
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except User.DoesNotExist:
             return Response({"errors": "User not found."}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# User expense changes view
+class UserChangesView(APIView):
+
+    def get(self, request, user_id):
+        try:
+            query = ChangesQuerySerializer(data=request.query_params)
+            query.is_valid(raise_exception=True)
+            if not User.objects.filter(id=user_id).exists():
+                return Response({"errors": "User not found."}, status=status.HTTP_404_NOT_FOUND)
+            since = query.validated_data.get('since')
+            if since is None:
+                # No changes yet, only the token to sync from after downloading the listing
+                return Response({'token': encode_token(head()), 'has_more': False, 'changed': [], 'deleted': []})
+            page_size = query.validated_data.get('page_size', getattr(settings, 'EXPENSES_PAGE_SIZE', 100))
+            return Response(changes_since(user_id, since, page_size))
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except ChangesExpired:
+            return Response(
+                {"errors": "This token has expired. Download the listing again and sync from a new token."},
+                status=status.HTTP_410_GONE,
+            )
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 # Expense creation view
 class ExpenseCreateView(generics.CreateAPIView):
     queryset = Expenses.objects.all()
     serializer_class = ExpenseSerializer
 
     def create(self, request, *args, **kwargs):
+        # Retries carrying the Idempotency-Key of an earlier request get its response back
+        return idempotent(request, 'create-expense', lambda: self.create_expense(request))
+
+    def create_expense(self, request):
         try:
             # Get the split method and validate input data
             split_method = request.data.get('split_method')
@@ -77,63 +185,313 @@ class ExpenseCreateView(generics.CreateAPIView):
         except Exception as e:
             return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# Batch expense creation view
+class ExpenseBatchCreateView(APIView):
+
+    def post(self, request):
+        return idempotent(request, 'create-expense-batch', lambda: self.create_batch(request))
+
+    def create_batch(self, request):
+        try:
+            batch = ExpenseBatchSerializer(data=request.data)
+            batch.is_valid(raise_exception=True)
+            mode = batch.validated_data['mode']
+            results = write_batch(batch.validate_items(), mode=mode)
+
+            created = sum(1 for result in results if result['status'] == 'created')
+            failed = sum(1 for result in results if result['status'] == 'error')
+            if created == len(results):
+                response_status = status.HTTP_201_CREATED
+            elif created:
+                response_status = status.HTTP_207_MULTI_STATUS
+            else:
+                response_status = status.HTTP_400_BAD_REQUEST
+            return Response({"mode": mode, "created": created, "failed": failed, "results": results}, status=response_status)
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 # View to get all expenses
 class OverallExpensesView(APIView):
-    
+
+    @global_condition
     def get(self, request):
         try:
-            # Retrieve and serialize all expenses
-            expenses = Expenses.objects.all()
-            serializer = ExpenseSerializer(expenses, many=True)
-            return Response(serializer.data)
+            # Serve the page from the response cache when possible
+            key = response_cache.key('overall-expenses', request)
+            data = response_cache.get(key)
+            if data is not None:
+                return Response(data)
+
+            # Retrieve and serialize one page of expenses with their shares, with those of
+            # closed periods when asked
+            archived = include_archived(request.query_params)
+            querysets = [expense_rows(), archived_expense_rows()] if archived else [expense_rows()]
+            paginator = KeysetPagination()
+            page = paginator.paginate_shards(querysets, request, view=self)
+            response = paginator.get_paginated_response(serialize_expenses(page, include_archived=archived))
+            # New expenses are always appended after the last page, so only full pages
+            # are stable enough to cache without bumping the global version on every write
+            if paginator.has_next:
+                response_cache.set(key, response.data)
+            return response
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to search the expenses by the words of their descriptions
+class ExpenseSearchView(APIView):
+
+    def get(self, request):
+        try:
+            query = SearchQuerySerializer(data=request.query_params)
+            query.is_valid(raise_exception=True)
+            params = query.validated_data
+            page_size = params.get('page_size', getattr(settings, 'EXPENSES_PAGE_SIZE', 100))
+            results = search_expenses(
+                params['q'], params.get('user'), params.get('date_from'), params.get('date_to'),
+                include_archived=params['include_archived'], limit=page_size,
+            )
+            return Response({"count": len(results), "results": results})
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except NotImplementedError as e:
+            return Response({"errors": str(e)}, status=status.HTTP_501_NOT_IMPLEMENTED)
         except Exception as e:
             return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # View to download the balance sheet as a CSV file
 class DownloadBalanceSheet(APIView):
 
+    @sheet_condition
     def get(self, request):
         try:
-            users = User.objects.all()
-            all_expenses = Expenses.objects.all()
-            
-            response = HttpResponse(content_type='text/csv')
+            # Stream the sheet row by row instead of building it in memory
+            rows = iter_balance_sheet_rows(include_archived=include_archived(request.query_params))
+            response = StreamingHttpResponse(stream_csv(rows), content_type='text/csv')
             response['Content-Disposition'] = 'attachment; filename="balance_sheet.csv"'
-            
-            writer = csv.writer(response)
-            # Write individual expenses
-            writer.writerow(['Individual Expenses'])
-            writer.writerow([])
-            writer.writerow(['User', 'Description', 'Total_Amount', 'Split_Method', 'Date', 'Share_Amount', 'Share_Percentage'])
-            
-            for user in users:
-                user_expenses = Expenses.objects.filter(shares__user=user).distinct()
-                for expense in user_expenses:
-                    for share in expense.shares.filter(user=user):
-                        writer.writerow([
-                            user.name,
-                            expense.description, 
-                            expense.total_amount, 
-                            expense.split_method,
-                            expense.date, 
-                            share.amount,
-                            share.percentage
-                        ])
-                writer.writerow([]) 
-                
-            # Write overall expenses
-            writer.writerow([])
-            writer.writerow(['Overall Expenses'])
-            writer.writerow(['Description', 'Total_Amount', 'Split_Method', 'Date'])
-            
-            for expense in all_expenses:
-                writer.writerow([
-                    expense.description, 
-                    expense.total_amount, 
-                    expense.split_method, 
-                    expense.date
-                ])
-            
             return response
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Group creation view
+class GroupCreateView(generics.CreateAPIView):
+    queryset = Group.objects.all()
+    serializer_class = GroupSerializer
+
+    def create(self, request, *args, **kwargs):
+        try:
+            serializer = self.get_serializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            self.perform_create(serializer)
+            headers = self.get_success_headers(serializer.data)
+            return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Group detail view
+class GroupDetailView(generics.RetrieveAPIView):
+    queryset = Group.objects.prefetch_related('members')
+    serializer_class = GroupSerializer
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            return Response({"errors": "Group not found."}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to add a user to a group
+class GroupMembersView(APIView):
+
+    def post(self, request, pk):
+        try:
+            group = Group.objects.get(pk=pk)
+            serializer = GroupMemberSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            _, created = GroupMembership.objects.get_or_create(group=group, user=serializer.validated_data['user'])
+            data = GroupSerializer(group).data
+            return Response(data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Group.DoesNotExist:
+            return Response({"errors": "Group not found."}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to get the expenses of a group
+class GroupExpensesView(APIView):
+
+    def get(self, request, pk):
+        try:
+            if not Group.objects.filter(pk=pk).exists():
+                return Response({"errors": "Group not found."}, status=status.HTTP_404_NOT_FOUND)
+            paginator = KeysetPagination()
+            page = paginator.paginate_queryset(group_expense_rows(pk), request, view=self)
+            return paginator.get_paginated_response(serialize_expenses(page))
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to get the balances of the members of a group within the group
+class GroupBalancesView(APIView):
+
+    def get(self, request, pk):
+        try:
+            if not Group.objects.filter(pk=pk).exists():
+                return Response({"errors": "Group not found."}, status=status.HTTP_404_NOT_FOUND)
+            return Response({"group": pk, "members": group_balances(pk)})
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to download the balance sheet of a group as a CSV file
+class GroupBalanceSheetView(APIView):
+
+    def get(self, request, pk):
+        try:
+            if not Group.objects.filter(pk=pk).exists():
+                return Response({"errors": "Group not found."}, status=status.HTTP_404_NOT_FOUND)
+            rows = iter_balance_sheet_rows(*group_sheet_querysets(pk), shards=[group_shard(pk)])
+            response = StreamingHttpResponse(stream_csv(rows), content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="balance_sheet_group_{pk}.csv"'
+            return response
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to queue an export of the balance sheet, written to a file in the background
+class ExportCreateView(APIView):
+
+    def post(self, request):
+        try:
+            serializer = ExportJobSerializer(data=request.data, context={'request': request})
+            serializer.is_valid(raise_exception=True)
+            # Identical requests over unchanged data get the same job
+            job, _ = start_export(serializer.validated_data)
+            job.refresh_from_db()
+            data = ExportJobSerializer(job, context={'request': request}).data
+            response_status = status.HTTP_200_OK if job.status == 'done' else status.HTTP_202_ACCEPTED
+            return Response(data, status=response_status, headers={'Location': reverse('export-detail', args=[job.id])})
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to get the status and progress of an export
+class ExportDetailView(APIView):
+
+    def get(self, request, pk):
+        try:
+            job = refresh(ExportJob.objects.get(pk=pk))
+            return Response(ExportJobSerializer(job, context={'request': request}).data)
+        except ExportJob.DoesNotExist:
+            return Response({"errors": "Export not found."}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to download the file of a finished export
+class ExportDownloadView(APIView):
+
+    def get(self, request, pk):
+        try:
+            job = refresh(ExportJob.objects.get(pk=pk))
+            if job.status != 'done':
+                return Response({"errors": f"Export is {job.status}."}, status=status.HTTP_409_CONFLICT)
+            header = getattr(settings, 'EXPENSES_EXPORT_SENDFILE_HEADER', None)
+            if header:
+                # The web server sends the file itself
+                response = HttpResponse(content_type=CONTENT_TYPES[job.format])
+                response[header] = sendfile_location(job, header)
+                response['Content-Disposition'] = f'attachment; filename="{download_name(job)}"'
+                return response
+            return FileResponse(
+                open(export_path(job), 'rb'), as_attachment=True,
+                filename=download_name(job), content_type=CONTENT_TYPES[job.format],
+            )
+        except ExportJob.DoesNotExist:
+            return Response({"errors": "Export not found."}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to settle all balances with a minimal list of transfers
+class SettlementsView(APIView):
+
+    def get(self, request):
+        try:
+            transfers = compute_settlements()
+            return Response({"count": len(transfers), "transfers": transfers})
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to report owed, paid and net amounts per user
+class UserTotalsReportView(APIView):
+
+    def get(self, request):
+        try:
+            return Response({"users": user_totals(include_archived(request.query_params))})
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to report who owes whom how much
+class PairwiseDebtsReportView(APIView):
+
+    def get(self, request):
+        try:
+            return Response({"debts": pairwise_debts(include_archived(request.query_params))})
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to report expense totals per split method
+class SplitMethodReportView(APIView):
+
+    def get(self, request):
+        try:
+            return Response({"split_methods": split_method_breakdown(include_archived(request.query_params))})
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to report totals per day, week or month and per user or split method
+class SummaryReportView(APIView):
+
+    def get(self, request):
+        try:
+            serializer = SummaryQuerySerializer(data=request.query_params)
+            serializer.is_valid(raise_exception=True)
+            params = serializer.validated_data
+            rows = period_summary(
+                params.get('from'), params.get('to'), params['granularity'], params['group_by'], params.get('user'),
+                include_archived=params['include_archived'],
+            )
+            return Response({
+                "from": params.get('from'), "to": params.get('to'), "granularity": params['granularity'],
+                "group_by": params['group_by'], "rows": rows,
+            })
+        except ValidationError as e:
+            return Response({"errors": e.detail}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({"errors": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# View to report the response cache hit and miss counters
+class CacheStatsView(APIView):
+
+    def get(self, request):
+        return Response(response_cache.stats())
+
+# View to export the per-route request metrics in the Prometheus text format
+class MetricsView(APIView):
+
+    def get(self, request):
+        return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from expenses_app.database import database_settings, replica_settings, shard_settings
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -41,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'expenses_app.middleware.RequestMetricsMiddleware',
+    'expenses_app.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,13 +79,48 @@ WSGI_APPLICATION = 'expenses_sharing_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# SQLite in BASE_DIR unless configured otherwise with the EXPENSES_DB_* environment
+# variables (see expenses_app.database). Every SQLite connection is switched to WAL with
+# the pragmas of EXPENSES_SQLITE_PRAGMAS when it is opened.
+
 DATABASES = {
+    'default': database_settings(os.environ, BASE_DIR / 'db.sqlite3'),
+}
+# Read replicas ('replica1', ...) listed in EXPENSES_DB_REPLICAS
+DATABASES.update(replica_settings(os.environ, DATABASES['default']))
+# Expense shards ('shard1', ...) listed in EXPENSES_DB_SHARDS
+DATABASES.update(shard_settings(os.environ, DATABASES['default']))
+
+# Safe requests to the API read from one of the replicas, picked 'round_robin' or
+# 'least_recently_used'. Clients read from the primary for EXPENSES_REPLICA_STICKY_SECONDS
+# after a write, which must cover the replication lag.
+DATABASE_ROUTERS = ['expenses_app.routers.ShardRouter', 'expenses_app.routers.ReplicaRouter']
+EXPENSES_READ_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica')]
+EXPENSES_REPLICA_SELECTION = 'round_robin'
+EXPENSES_REPLICA_STICKY_SECONDS = 5
+
+# Expenses are spread over the default database and the shards, each migrated on its own
+# (manage.py migrate --database shard1). Reads spanning the shards query them in parallel
+# on EXPENSES_SHARD_WORKERS threads (default: one per shard). Replicas only serve the
+# default database.
+EXPENSES_SHARDS = ['default', *(alias for alias in DATABASES if alias.startswith('shard'))]
+EXPENSES_SHARD_WORKERS = None
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'expenses',
     }
 }
 
+# Cache used for the read endpoint responses and how long entries live (seconds)
+EXPENSES_CACHE_ALIAS = 'default'
+EXPENSES_CACHE_TIMEOUT = 300
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -124,3 +164,80 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# Django REST framework
+# FastJSONRenderer uses orjson when it is installed and the stdlib encoder otherwise
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'expenses_app.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+
+# Keyset pagination for the expense listing endpoints
+
+EXPENSES_PAGE_SIZE = 100
+EXPENSES_MAX_PAGE_SIZE = 1000
+
+
+# Change feed of the user listings
+# compact_changes keeps this many days of entries; older tokens have to resync
+EXPENSES_CHANGES_RETENTION_DAYS = 30
+# Entries younger than this are held back until earlier transactions had the time to
+# commit theirs. SQLite serializes writers, other databases need a few seconds.
+EXPENSES_CHANGES_SETTLE_SECONDS = 0 if DATABASES['default']['ENGINE'].endswith('sqlite3') else 2
+
+
+# Batch expense ingestion
+
+EXPENSES_BATCH_MAX_SIZE = 5000
+EXPENSES_BATCH_CHUNK_SIZE = 500
+
+# Allow request bodies large enough for a full expense batch
+DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024
+
+
+# Users
+# Users sent at most per bulk upsert, and the in-process cache expense validation resolves
+# users through: at most EXPENSES_USER_CACHE_SIZE users, each kept
+# EXPENSES_USER_CACHE_TIMEOUT seconds (how long users deleted by another process may still
+# be accepted)
+
+EXPENSES_USER_BULK_MAX_SIZE = 5000
+EXPENSES_USER_CACHE_SIZE = 10000
+EXPENSES_USER_CACHE_TIMEOUT = 60
+
+
+# Idempotency keys of the expense creation endpoints
+# Responses are replayed for EXPENSES_IDEMPOTENCY_TTL seconds, the latest
+# EXPENSES_IDEMPOTENCY_CACHE_SIZE of them from memory. Duplicates wait up to
+# EXPENSES_IDEMPOTENCY_WAIT_SECONDS for the first request, whose claim is taken over once
+# it is EXPENSES_IDEMPOTENCY_LOCK_SECONDS old.
+
+EXPENSES_IDEMPOTENCY_TTL = 24 * 3600
+EXPENSES_IDEMPOTENCY_CACHE_SIZE = 10000
+EXPENSES_IDEMPOTENCY_WAIT_SECONDS = 10
+EXPENSES_IDEMPOTENCY_LOCK_SECONDS = 60
+
+
+# Export jobs
+# Files are written by EXPENSES_EXPORT_WORKERS threads (0 writes them in the request)
+
+EXPENSES_EXPORT_DIR = BASE_DIR / 'exports'
+EXPENSES_EXPORT_WORKERS = 2
+# Queued or running exports that made no progress for this many seconds are failed
+EXPENSES_EXPORT_STALE_SECONDS = 600
+# Set to 'X-Accel-Redirect' (nginx, files served under EXPENSES_EXPORT_SENDFILE_URL) or
+# 'X-Sendfile' (Apache, lighttpd) to let the web server send the files
+EXPENSES_EXPORT_SENDFILE_HEADER = None
+EXPENSES_EXPORT_SENDFILE_URL = '/protected-exports/'
+
+
+# Request instrumentation
+# Requests running more queries or taking longer than these limits are logged with their SQL
+
+EXPENSES_MAX_QUERIES_PER_REQUEST = 50
+EXPENSES_SLOW_REQUEST_MS = 1000
+# Number of recent requests per route the latency quantiles are computed over
+EXPENSES_METRICS_WINDOW = 1000